@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+URL dispatch cost per request.
+
+Resolves a mix of SockJS urls, the way a busy server sees them:
+polls and sends of a set of sessions, info requests and iframe
+pages, with 2 and with 200 routes mounted. Paths are resolved with
+the LRU warm ( sessions polling again ) and with every path new.
+
+    python benchmarks/dispatch.py
+    python benchmarks/dispatch.py 200000
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'gevent_sockjs'))
+
+from router import Dispatcher, SockJSRouter, SockJSConnection
+
+def paths(routes, sessions=500):
+    accum = []
+    for i in xrange(sessions):
+        route = routes[i % len(routes)]
+        accum.append('/%s/%03d/s%d/xhr' % (route, i % 1000, i))
+        accum.append('/%s/%03d/s%d/xhr_send' % (route, i % 1000, i))
+        accum.append('/%s/info' % route)
+        accum.append('/%s/iframe.html' % route)
+    return accum
+
+def dispatch(router, dispatcher, path):
+    url = dispatcher.resolve(path)
+    return router.routes[url[1]]
+
+def main(number):
+    print '%-8s %-8s %14s' % ('routes', 'cache', 'ns/request')
+
+    for count in (2, 200):
+        names = ['route%d' % i for i in xrange(count)]
+        SockJSRouter.routes = {}
+        router = SockJSRouter(dict((name, SockJSConnection) for name in names))
+        urls = paths(names)
+
+        for label, size in (('warm', None), ('cold', 1)):
+            dispatcher = Dispatcher(cache_size=size)
+            state = {'i': 0}
+
+            def request():
+                i = state['i'] = (state['i'] + 1) % len(urls)
+                dispatch(router, dispatcher, urls[i])
+
+            elapsed = timeit.timeit(request, number=number)
+            print '%-8d %-8s %14.0f' % (count, label, elapsed / number * 1e9)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
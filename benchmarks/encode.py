@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Message encoding throughput.
+
+Times protocol.encode against the JSON libraries installed, on the
+payloads a SockJS server frames most: short and long ASCII strings,
+a unicode string, one full of characters the spec requires escaped,
+and a batch of ten short strings.
+
+    python benchmarks/encode.py
+    python benchmarks/encode.py 200000
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'gevent_sockjs'))
+
+import protocol
+
+PAYLOADS = [
+    ('short ascii', 'hello world'),
+    ('long ascii', 'x' * 4096),
+    ('unicode', u'caf\xe9 cr\xe8me br\xfbl\xe9e\n' * 8),
+    ('escapes', u'caf\xe9 \u2028 \u200d \ufff0 end' * 8),
+    ('batch of 10', ['message %d' % i for i in xrange(10)]),
+]
+
+def encoders():
+    yield 'protocol', protocol.encode
+
+    for name in ('ujson', 'simplejson', 'json'):
+        try:
+            module = __import__(name)
+        except ImportError:
+            continue
+
+        if name == 'ujson':
+            yield name, module.dumps
+        else:
+            yield name, lambda value, dumps=module.dumps: \
+                dumps(value, separators=(',', ':'))
+
+def main(number):
+    print '%-12s %-12s %14s' % ('payload', 'encoder', 'ops/sec')
+
+    for label, payload in PAYLOADS:
+        for name, encode in encoders():
+            if not isinstance(payload, list) and name != 'protocol':
+                value = [payload]
+            else:
+                value = payload
+
+            elapsed = timeit.timeit(lambda: encode(value), number=number)
+            print '%-12s %-12s %14d' % (label, name, number / elapsed)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
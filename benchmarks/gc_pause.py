@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Worst case SessionPool.gc pause.
+
+Fills a pool with idle sessions whose expiry times are spread over
+a window, then replays a simulated clock one second at a time: each
+second a fraction of the sessions heartbeat ( persist ) and the
+pool is collected. The last second expires every session at once,
+as a mass disconnect would.
+
+Reports the worst and mean time the collector holds the hub ( one
+gc slice ) for each pool size.
+
+    python benchmarks/gc_pause.py
+    python benchmarks/gc_pause.py 100000 1000000
+"""
+
+import os
+import sys
+import gc
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'gevent_sockjs'))
+
+from session import MemorySession
+from sessionpool import SessionPool
+
+# Seconds over which session expiry times are spread
+WINDOW = 60
+
+# Fraction of sessions which heartbeat each simulated second
+ACTIVE = 0.05
+
+# Simulated seconds to replay
+DURATION = 120
+
+def run(size):
+    random.seed(size)
+
+    pool = SessionPool()
+    start = time.time()
+    clock = start
+
+    sessions = []
+    for i in xrange(size):
+        session = MemorySession(None, str(i))
+        session.expires_at = clock + random.uniform(1, WINDOW)
+        pool.add(session)
+        sessions.append(session)
+
+    pauses = []
+    collected = 0
+
+    # Keep CPython's cycle collector, which walks every live object,
+    # out of the measurement.
+    gc.collect()
+    gc.disable()
+
+    for second in xrange(DURATION):
+        clock += 1.0
+
+        # Heartbeat a sample of the sessions, as Session.persist
+        # would, against the simulated clock.
+        for session in random.sample(sessions, int(size * ACTIVE)):
+            if not session.expired:
+                session.expires_at = clock + WINDOW
+                session.pool.touch(session)
+
+        if second == DURATION - 1:
+            for session in sessions:
+                session.expire()
+
+        before = len(pool)
+
+        slices = pool.gc_slices(now=clock)
+        while True:
+            t0 = time.time()
+            try:
+                next(slices)
+            except StopIteration:
+                break
+            finally:
+                pauses.append(time.time() - t0)
+
+        collected += before - len(pool)
+
+    gc.enable()
+    return max(pauses), sum(pauses) / len(pauses), collected
+
+def main(sizes):
+    print '%10s %14s %14s %12s' % ('sessions', 'worst pause', 'mean pause', 'collected')
+    for size in sizes:
+        worst, mean, collected = run(size)
+        print '%10d %12.2fms %12.2fms %12d' % (
+            size, worst * 1000, mean * 1000, collected)
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100000, 1000000]
+    main(sizes)
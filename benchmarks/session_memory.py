@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Bytes per session held in a SessionPool.
+
+Allocates a batch of idle sessions ( created and pooled, never
+sent a message ) and a batch of active ones ( with a queued
+message and a timeout callback ) and reports the resident memory
+growth divided by the number of sessions.
+
+    python benchmarks/session_memory.py
+    python benchmarks/session_memory.py 500000
+"""
+
+import os
+import sys
+import gc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'gevent_sockjs'))
+
+from session import MemorySession
+from sessionpool import SessionPool
+
+def rss():
+    """
+    Resident set size of this process in bytes, Linux only.
+    """
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+def measure(size, active):
+    pool = SessionPool()
+
+    gc.collect()
+    before = rss()
+
+    for i in xrange(size):
+        session = MemorySession(None, '%08x' % i)
+        pool.add(session)
+
+        if active:
+            session.add_message('x')
+            session.link_timeout(lambda s: None)
+            session.timeout
+
+    gc.collect()
+    per_session = float(rss() - before) / size
+
+    for shard in pool.shards:
+        shard.wheel.clear()
+        shard.sessions.clear()
+    return per_session
+
+def main(size):
+    print '%10s %18s' % ('sessions', 'bytes per session')
+    print '%10d %12.0f idle' % (size, measure(size, active=False))
+    print '%10d %12.0f active' % (size, measure(size, active=True))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
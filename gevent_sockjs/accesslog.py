@@ -0,0 +1,200 @@
+"""
+Batched access logging.
+
+pywsgi formats and writes an access log line from the greenlet of
+every request. Here the request only appends a small tuple to the
+server's AccessLog, a greenlet formats whatever has piled up and
+writes it out in one go every ``interval`` seconds.
+
+The buffer holds at most ``size`` records. When the writer can't
+keep up, new records are dropped and counted rather than making
+requests wait for the log.
+
+Records can be sampled by route and status: ``sampling`` maps a
+``(route, status)`` pair, a route name or a status code to the
+fraction of records kept, the most specific match wins. Sampling is
+deterministic, a fraction of 0.25 keeps every fourth record.
+"""
+
+import time
+import gevent
+import simplejson
+
+from collections import deque
+from datetime import datetime
+
+def common(record):
+    """
+    The line pywsgi writes.
+    """
+    when, client, requestline, status, length, duration, route = record
+
+    return '%s - - [%s] "%s" %s %s %s\n' % (
+        client or '-',
+        datetime.fromtimestamp(int(when)),
+        requestline or '',
+        status,
+        length or '-',
+        '%.6f' % duration if duration is not None else '-',
+    )
+
+def json(record):
+    """
+    One JSON object per line.
+    """
+    when, client, requestline, status, length, duration, route = record
+
+    return simplejson.dumps({
+        'time'     : when,
+        'client'   : client,
+        'request'  : requestline,
+        'status'   : int(status),
+        'length'   : length,
+        'duration' : duration,
+        'route'    : route,
+    }) + '\n'
+
+FORMATS = {
+    'common' : common,
+    'json'   : json,
+}
+
+class AccessLog(object):
+    """
+    Server wide access log, written to ``output`` ( anything with a
+    ``write`` method ) in the named ``format``, or by any function
+    of a record returning its line.
+    """
+
+    size = 8192
+    interval = 1.0
+
+    def __init__(self, output=None, format='common', sampling=None,
+            size=None, interval=None):
+        self.output = output
+
+        if isinstance(format, basestring):
+            format = FORMATS[format]
+        self.format = format
+
+        self.sampling = sampling or {}
+        self.credit = {}
+
+        if size is not None:
+            self.size = size
+        if interval is not None:
+            self.interval = interval
+
+        self.records = deque()
+        self.thread = gevent.Greenlet(self._run)
+
+        # Records kept, left out by sampling, dropped on a full
+        # buffer, and written out
+        self.recorded = 0
+        self.sampled_out = 0
+        self.dropped = 0
+        self.written = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def start(self):
+        if not self.thread.started:
+            self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.thread.kill(block=False)
+        self.flush()
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.flush()
+
+    def rate(self, route, status):
+        """
+        The fraction of records kept for a route and status.
+        """
+        sampling = self.sampling
+
+        for key in ((route, status), route, status):
+            if key in sampling:
+                return key, sampling[key]
+
+        return None, 1.0
+
+    def sample(self, route, status):
+        if not self.sampling:
+            return True
+
+        key, rate = self.rate(route, status)
+
+        if rate >= 1.0:
+            return True
+
+        credit = self.credit.get(key, 0.0) + rate
+
+        if credit >= 1.0:
+            self.credit[key] = credit - 1.0
+            return True
+
+        self.credit[key] = credit
+        return False
+
+    def record(self, handler):
+        """
+        Note the response of a handler, called from its greenlet.
+        """
+        status = (handler._orig_status or handler.status or '000').split()[0]
+        route = getattr(handler, 'route_name', None)
+
+        if not status.isdigit():
+            # A socket error in place of the status
+            status = '000'
+
+        if not self.sample(route, int(status)):
+            self.sampled_out += 1
+            return
+
+        if len(self.records) >= self.size:
+            self.dropped += 1
+            return
+
+        client = handler.client_address
+        if isinstance(client, tuple):
+            client = client[0]
+
+        if handler.time_finish:
+            duration = handler.time_finish - handler.time_start
+        else:
+            duration = None
+
+        self.records.append((
+            time.time(),
+            client,
+            handler.requestline,
+            status,
+            handler.response_length,
+            duration,
+            route,
+        ))
+        self.recorded += 1
+
+    def flush(self):
+        """
+        Format and write every buffered record in one write.
+        """
+        records = self.records
+
+        if not records or self.output is None:
+            return
+
+        format = self.format
+        lines = []
+
+        while records:
+            lines.append(format(records.popleft()))
+
+        self.output.write(''.join(lines))
+        self.written += len(lines)
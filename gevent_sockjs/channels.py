@@ -0,0 +1,111 @@
+import gevent
+
+import protocol
+
+class Channel(object):
+    """
+    A named set of subscribed sessions.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.sessions = set()
+
+    def __len__(self):
+        return len(self.sessions)
+
+class ChannelRegistry(object):
+    """
+    Server wide registry of broadcast channels.
+
+    A broadcast serializes its message once into a protocol.Encoded
+    frame and queues that same object into every subscriber's
+    session, the transports splice it into their frames without
+    encoding it again. Subscribers are walked in slices of
+    ``fanout_slice`` sessions, yielding to the hub in between, so a
+    large channel doesn't block other connections.
+    """
+
+    fanout_slice = 1000
+
+    def __init__(self, fanout_slice=None):
+        self.channels = dict()
+
+        # Channel names each subscribed session belongs to
+        self.memberships = dict()
+
+        if fanout_slice is not None:
+            self.fanout_slice = fanout_slice
+
+        self.broadcasts = 0
+        self.deliveries = 0
+
+    def get(self, name):
+        return self.channels.get(name, None)
+
+    def subscribe(self, name, session):
+        channel = self.channels.get(name)
+
+        if channel is None:
+            channel = self.channels[name] = Channel(name)
+
+        channel.sessions.add(session)
+
+        names = self.memberships.get(session)
+        if names is None:
+            names = self.memberships[session] = set()
+
+            # Clean up when the session is closed or killed
+            session.link_timeout(self.unsubscribe_all)
+
+        names.add(name)
+
+    def unsubscribe(self, name, session):
+        channel = self.channels.get(name)
+
+        if channel is not None:
+            channel.sessions.discard(session)
+            if not channel.sessions:
+                del self.channels[name]
+
+        names = self.memberships.get(session)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del self.memberships[session]
+
+    def unsubscribe_all(self, session):
+        for name in list(self.memberships.get(session, ())):
+            self.unsubscribe(name, session)
+
+    def broadcast(self, name, message):
+        """
+        Queue a message into every session subscribed to a channel,
+        returns the number of sessions it was queued for.
+        """
+        channel = self.channels.get(name)
+
+        if channel is None:
+            return 0
+
+        frame = protocol.Encoded(message)
+        subscribers = list(channel.sessions)
+        delivered = 0
+
+        for start in xrange(0, len(subscribers), self.fanout_slice):
+            if start:
+                gevent.sleep(0)
+
+            for session in subscribers[start:start + self.fanout_slice]:
+                # Expired sessions are unsubscribed once they are
+                # killed or collected, until then they are skipped
+                if session.expired:
+                    self.unsubscribe_all(session)
+                    continue
+
+                session.add_message(frame)
+                delivered += 1
+
+        self.broadcasts += 1
+        self.deliveries += delivered
+        return delivered
@@ -0,0 +1,330 @@
+"""
+Compression of outgoing data: gzip or deflate for the HTTP polling
+and streaming responses, and the permessage-deflate extension
+( RFC 7692 ) for websockets.
+
+Both are off unless the server is given their settings::
+
+    sockjs = SockJSServer(('', 8081), router,
+        http_compression=HTTPCompression(min_size=1024),
+        websocket_deflate=PerMessageDeflate(
+            server_no_context_takeover=True,
+        ),
+    )
+
+Bytes in, bytes out and the time spent compressing are counted on
+the server's ``compression_stats``.
+"""
+
+import re
+import time
+import zlib
+import struct
+
+from geventwebsocket.websocket import WebSocketHybi, WebSocketError
+
+class CompressionStats(object):
+    """
+    Counters shared by everything the server compresses.
+    """
+
+    def __init__(self):
+        # Bytes handed to the compressors and bytes they produced
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+        # Seconds spent in zlib, compressing and decompressing
+        self.seconds = 0.0
+
+        # Payloads sent compressed, and those left as they were for
+        # being under the size threshold.
+        self.compressed = 0
+        self.skipped = 0
+
+    def ratio(self):
+        if not self.compressed_bytes:
+            return 1.0
+        return float(self.raw_bytes) / self.compressed_bytes
+
+class Compressor(object):
+    """
+    A zlib stream which flushes after every write, so each frame can
+    be decoded by the client as soon as it arrives.
+    """
+
+    def __init__(self, stats, level, wbits):
+        self.stats = stats
+        self.zlib = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data, flush=zlib.Z_SYNC_FLUSH):
+        start = time.time()
+        out = self.zlib.compress(data) + self.zlib.flush(flush)
+
+        stats = self.stats
+        stats.seconds += time.time() - start
+        stats.raw_bytes += len(data)
+        stats.compressed_bytes += len(out)
+        stats.compressed += 1
+        return out
+
+    def finish(self):
+        return self.compress('', zlib.Z_FINISH)
+
+# HTTP
+# ====
+
+class HTTPCompression(object):
+    """
+    Settings for the Content-Encoding of polling and streaming
+    responses. Polling responses under ``min_size`` bytes are sent
+    as they are, streaming responses are compressed whole.
+    """
+
+    # Window bits selecting each container format in zlib
+    WBITS = {
+        'gzip'    : 16 + zlib.MAX_WBITS,
+        'deflate' : zlib.MAX_WBITS,
+    }
+
+    def __init__(self, min_size=1024, level=6, encodings=('gzip', 'deflate')):
+        self.min_size = min_size
+        self.level = level
+        self.encodings = encodings
+
+    def negotiate(self, accept_encoding):
+        """
+        The first of our encodings the client accepts, or None.
+        """
+        accepted = {}
+
+        for item in accept_encoding.split(','):
+            parts = item.strip().split(';')
+            name = parts[0].strip().lower()
+            quality = 1.0
+
+            for param in parts[1:]:
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+
+            accepted[name] = quality
+
+        for encoding in self.encodings:
+            if accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+
+        return None
+
+    def compressor(self, encoding, stats):
+        return Compressor(stats, self.level, self.WBITS[encoding])
+
+# Websockets
+# ==========
+
+class PerMessageDeflate(object):
+    """
+    Settings for the permessage-deflate websocket extension.
+
+    Context takeover keeps the compression window between messages,
+    better ratios for a window of memory per connection and
+    direction ( up to 2 ** max_window_bits bytes, plus zlib's state ).
+    Messages under ``min_size`` bytes are sent uncompressed.
+    """
+
+    NAME = 'permessage-deflate'
+
+    PARAM = re.compile(r'\s*([^=\s]+)\s*(?:=\s*"?([^"]*)"?)?\s*')
+
+    def __init__(self, level=6, min_size=64, server_no_context_takeover=False,
+            client_no_context_takeover=False, server_max_window_bits=15):
+        self.level = level
+        self.min_size = min_size
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+
+    def negotiate(self, header, stats):
+        """
+        Pick the first permessage-deflate offer in a
+        Sec-WebSocket-Extensions request header we can accept.
+        Returns the response header value and the MessageDeflater
+        of the connection, or None.
+        """
+        for offer in header.split(','):
+            parts = offer.split(';')
+
+            if parts[0].strip().lower() != self.NAME:
+                continue
+
+            params = {}
+            for part in parts[1:]:
+                match = self.PARAM.match(part)
+                if match:
+                    params[match.group(1).lower()] = match.group(2)
+
+            agreed = self.agree(params)
+            if agreed is None:
+                continue
+
+            response = [self.NAME]
+            for key in sorted(agreed):
+                if agreed[key] is True:
+                    response.append(key)
+                else:
+                    response.append('%s=%d' % (key, agreed[key]))
+
+            return '; '.join(response), MessageDeflater(self, agreed, stats)
+
+        return None
+
+    def agree(self, params):
+        agreed = {}
+
+        for key, value in params.iteritems():
+            if key == 'server_no_context_takeover':
+                agreed[key] = True
+            elif key == 'client_no_context_takeover':
+                agreed[key] = True
+            elif key == 'server_max_window_bits':
+                try:
+                    bits = int(value)
+                except (TypeError, ValueError):
+                    return None
+                # zlib can't write raw streams with a 256 byte
+                # window, offers asking for one are declined.
+                if not 9 <= bits <= 15:
+                    return None
+                agreed[key] = bits
+            elif key == 'client_max_window_bits':
+                # We always decompress with the largest window
+                pass
+            else:
+                return None
+
+        if self.server_no_context_takeover:
+            agreed['server_no_context_takeover'] = True
+        if self.client_no_context_takeover:
+            agreed['client_no_context_takeover'] = True
+
+        bits = min(agreed.get('server_max_window_bits', 15),
+            self.server_max_window_bits)
+        if bits < 15:
+            agreed['server_max_window_bits'] = bits
+
+        return agreed
+
+class MessageDeflater(object):
+    """
+    Compressor and decompressor of one websocket connection, as
+    agreed on by its handshake.
+    """
+
+    # Appended by the sender's sync flush, stripped off the wire
+    TAIL = '\x00\x00\xff\xff'
+
+    def __init__(self, settings, agreed, stats):
+        self.stats = stats
+        self.level = settings.level
+        self.min_size = settings.min_size
+
+        self.server_takeover = 'server_no_context_takeover' not in agreed
+        self.client_takeover = 'client_no_context_takeover' not in agreed
+
+        self.wbits = -agreed.get('server_max_window_bits', 15)
+
+        self.compressor = None
+        self.decompressor = None
+
+    def compress(self, data):
+        """
+        The compressed message, or None if it should be sent as is.
+        """
+        if len(data) < self.min_size:
+            self.stats.skipped += 1
+            return None
+
+        if self.compressor is None or not self.server_takeover:
+            self.compressor = Compressor(self.stats, self.level, self.wbits)
+
+        out = self.compressor.compress(data)
+
+        if out.endswith(self.TAIL):
+            out = out[:-4]
+        return out
+
+    def decompress(self, data):
+        if self.decompressor is None or not self.client_takeover:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        start = time.time()
+        out = self.decompressor.decompress(data + self.TAIL)
+        self.stats.seconds += time.time() - start
+        return out
+
+class DeflateWebSocket(WebSocketHybi):
+    """
+    A hybi websocket which compresses the messages it sends and
+    decompresses the ones received with the RSV1 bit set. Adopts
+    the state of the websocket created by the handshake.
+    """
+
+    RSV1 = 0x40
+
+    def __init__(self, websocket, deflater):
+        self.__dict__.update(websocket.__dict__)
+        self.deflater = deflater
+
+        # Whether the message being received is compressed
+        self.inflating = False
+
+    def _parse_header(self, data):
+        if len(data) == 2 and ord(data[0]) & self.RSV1:
+            opcode = ord(data[0]) & 0xf
+
+            # Only the first frame of a data message may carry it
+            if opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+                self.inflating = True
+                data = chr(ord(data[0]) & ~self.RSV1) + data[1]
+
+        return super(DeflateWebSocket, self)._parse_header(data)
+
+    def _receive(self):
+        result = super(DeflateWebSocket, self)._receive()
+
+        if result and self.inflating:
+            self.inflating = False
+            message, is_binary = result
+            result = bytearray(self.deflater.decompress(str(message))), is_binary
+
+        return result
+
+    def send_frame(self, message, opcode):
+        if opcode not in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+            return super(DeflateWebSocket, self).send_frame(message, opcode)
+
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+
+        compressed = self.deflater.compress(message)
+
+        if compressed is None:
+            return super(DeflateWebSocket, self).send_frame(message, opcode)
+
+        if self.socket is None:
+            raise WebSocketError('The connection was closed')
+
+        header = chr(0x80 | self.RSV1 | opcode)
+        length = len(compressed)
+
+        if length < 126:
+            header += chr(length)
+        elif length < (1 << 16):
+            header += chr(126) + struct.pack('!H', length)
+        else:
+            header += chr(127) + struct.pack('!Q', length)
+
+        with self._writelock:
+            self._write(header + compressed)
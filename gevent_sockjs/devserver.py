@@ -24,6 +24,10 @@ import werkzeug.serving
 
 class Echo(SockJSConnection):
 
+    # The protocol tests expect streaming responses to be cycled
+    # after 4KB
+    response_limit = 4096
+
     def on_message(self, message):
         self.send(message)
 
@@ -1,6 +1,13 @@
 class InvalidJSON(Exception):
     pass
 
+class RedisError(Exception):
+    """
+    Error reply from, or lost connection to, a Redis protocol
+    session store.
+    """
+    pass
+
 class Http404(Exception):
 
     def __init__(self, message=None):
@@ -18,6 +25,19 @@ class Http405(Exception):
     def __str__(self):
         return '405: Method Not Allowed'
 
+class Http413(Exception):
+    """
+    Request body larger than the route accepts, raised before the
+    excess is read.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.message = "413: Request Entity Too Large"
+
+    def __str__(self):
+        return self.message
+
 class Http500(Exception):
     """
     Exception for catching exceptions, also has a slot for a
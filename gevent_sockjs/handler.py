@@ -1,10 +1,8 @@
 import uuid
 import sys
-import re
-import datetime
 import time
+import zlib
 import traceback
-from Cookie import SimpleCookie
 
 import gevent
 from gevent.pywsgi import WSGIHandler
@@ -12,6 +10,81 @@ from geventwebsocket.handler import WebSocketHandler
 
 import protocol
 from errors import *
+from writer import FrameWriter
+from compression import DeflateWebSocket
+from router import Dispatcher
+
+class RequestBody(object):
+    """
+    The body of a request, read from the WSGI input in chunks of
+    ``chunk_size`` bytes and never more than ``max_size`` bytes in
+    total. Chunked transfer encoding is undone by the input itself.
+
+    Http413 is raised as soon as the declared Content-Length, or
+    the data actually received, goes over the limit.
+    """
+
+    chunk_size = 8192
+
+    def __init__(self, wsgi_input, environ, max_size=None):
+        self.input = wsgi_input
+        self.max_size = max_size
+        self.received = 0
+
+        try:
+            self.content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            self.content_length = 0
+
+        self.content_type = environ.get('CONTENT_TYPE', '')
+
+        if max_size is not None and self.content_length > max_size:
+            raise Http413(max_size)
+
+    def chunks(self):
+        while True:
+            chunk = self.input.read(self.chunk_size)
+
+            if not chunk:
+                break
+
+            self.received += len(chunk)
+
+            if self.max_size is not None and self.received > self.max_size:
+                raise Http413(self.max_size)
+
+            yield chunk
+
+    def read(self):
+        return ''.join(self.chunks())
+
+class KeepAlive(object):
+    """
+    Keep-alive connections of a server: how many sit idle waiting
+    for their next request, and how many requests came in over a
+    connection which had already served one.
+
+    Once ``max_idle`` connections are idle, responses are sent with
+    ``Connection: close`` until some of them go away.
+    """
+
+    def __init__(self, max_idle=None):
+        self.max_idle = max_idle
+        self.idle = 0
+
+        self.requests = 0
+        self.reused = 0
+
+        # Responses which closed their connection to stay in bounds
+        self.refused = 0
+
+    def full(self):
+        return self.max_idle is not None and self.idle >= self.max_idle
+
+    def reuse_rate(self):
+        if not self.requests:
+            return 0.0
+        return float(self.reused) / self.requests
 
 class SockJSHandler(WSGIHandler):
     """
@@ -23,24 +96,20 @@ class SockJSHandler(WSGIHandler):
     HTTP.
     """
 
-    # Dynamic URLs, urls serving data
-    DYNAMIC_FORMAT = re.compile(r"""
-        ^/(?P<route>[^/]+)/        # sockjs route, alphanumeric not empty
-        (?P<server_id>[^/.]+)/     # load balancer id, alphanumeric not empty, without (.)
-        (?P<session_id>[^/.]+)/    # session id, alphanumeric not empty, without (.)
-        (?P<transport>[^/.]+)$     # transport string, (Example: xhr | jsonp ... )
-        """, re.X)
-
-    # Dynamic URLs, urls serving static pages
-    STATIC_FORMAT = re.compile(r"""
-        ^/(?P<route>[^/]+)(/)?     # sockjs route, alphanumeric not empty
-        (?P<suffix>[^/]+)?$        # url suffix ( Example: / , info, iframe.html )
-    """, re.X)
-
-    RAW_FORMAT = re.compile(r"""
-        ^/(?P<route>[^/]+)/     # sockjs route, alphanumeric not empty
-        websocket$            # url suffix ( Example: / , info, iframe.html )
-    """, re.X)
+    # Requests served on this connection
+    served = 0
+
+    # Whether the response closes the connection with a Connection:
+    # close header, the server has enough idle ones or the request
+    # can't be followed by another.
+    closing = False
+
+    # Name of the route the request resolved to, for the access log
+    route_name = None
+
+    # Whether the response has been logged, responses served by a
+    # mounted router are logged again on the way back out of pywsgi.
+    logged = False
 
     def prep_response(self):
         """
@@ -54,10 +123,58 @@ class SockJSHandler(WSGIHandler):
         self.headers = []
         self.headers_sent = False
 
+        # Headers written from the server's HeaderCache
+        self.cors = False
+        self.cookie = False
+        self.nocache = False
+        self.caching = False
+
         self.result = None
         self.response_use_chunked = False
         self.response_length = 0
 
+    def read_requestline(self):
+        """
+        Count the connection as idle while it waits for its next
+        request.
+        """
+        if not self.served:
+            return super(SockJSHandler, self).read_requestline()
+
+        keepalive = self.server.keepalive
+        keepalive.idle += 1
+        try:
+            return super(SockJSHandler, self).read_requestline()
+        finally:
+            keepalive.idle -= 1
+
+    def log_request(self):
+        if self.logged:
+            return
+        self.logged = True
+
+        access_log = self.server.access_log
+
+        if access_log is None:
+            return super(SockJSHandler, self).log_request()
+
+        access_log.record(self)
+
+    def get_environ(self):
+        environ = super(SockJSHandler, self).get_environ()
+
+        # A SockJSRouter mounted inside another application finds the
+        # connection to write to here.
+        environ['sockjs.handler'] = self
+        return environ
+
+    def start_response(self, status, headers, exc_info=None):
+        if self.closing:
+            headers = headers + [('Connection', 'close')]
+
+        return super(SockJSHandler, self).start_response(status, headers,
+            exc_info)
+
     def raw_headers(self):
         """
         Return the available headers as a string, used for low
@@ -70,55 +187,137 @@ class SockJSHandler(WSGIHandler):
         head.append('%s %s\r\n' % (self.request_version, self.status))
         for header in self.response_headers:
             head.append('%s: %s\r\n' % header)
+        head.extend(self.header_lines())
         head.append('\r\n')
         return ''.join(head)
 
+    def header_lines(self):
+        """
+        The pre-encoded Date, CORS, cookie and cache headers asked
+        for by the enable_* methods.
+        """
+        environ = self.environ
+
+        origin = environ.get('HTTP_ORIGIN', '*') if self.cors else None
+        cookie = environ.get('HTTP_COOKIE', '') if self.cookie else None
+
+        return self.server.header_cache.headers(origin, cookie,
+            self.nocache, self.caching)
+
     def raw_chunk(self, data):
         """
         Return a raw HTTP chunk, hex encoded size.
         """
         return "%x\r\n%s\r\n" % (len(data), data)
 
+    def frame_writer(self, chunked=False, compressor=None):
+        """
+        The FrameWriter of this connection, created on first use and
+        shared by every response written on it.
+        """
+        writer = getattr(self, 'writer', None)
+
+        if writer is None or writer.sock is not self.socket:
+            writer = self.writer = FrameWriter(self.socket)
+
+        writer.chunked = chunked
+        writer.compressor = compressor
+        return writer
+
+    def compressor(self, size=None):
+        """
+        A Compressor for the response body if the server compresses
+        responses, the client accepts it and the body is at least
+        the minimum size ( None for a streamed body ). Adds the
+        Content-Encoding headers.
+        """
+        settings = self.server.http_compression
+
+        if settings is None:
+            return None
+
+        if size is not None and size < settings.min_size:
+            self.server.compression_stats.skipped += 1
+            return None
+
+        encoding = settings.negotiate(self.environ.get('HTTP_ACCEPT_ENCODING', ''))
+
+        if encoding is None:
+            return None
+
+        self.headers += [
+            ('Content-Encoding', encoding),
+            ('Vary', 'Accept-Encoding'),
+        ]
+        return settings.compressor(encoding, self.server.compression_stats)
+
     # Raw write actions
     # -----------------
 
-    def write_text(self, text):
-        self.content_type = ("Content-Type", "text/plain; charset=UTF-8")
+    def write_buffers(self, buffers, content_type=None, status="200 OK"):
+        """
+        Write a whole response whose body is a list of buffers, the
+        headers and body go out in one vectored write without the
+        buffers being joined first.
+        """
+        self.content_type = content_type or \
+            ("Content-Type", "text/plain; charset=UTF-8")
 
-        self.headers += [self.content_type]
-        self.start_response("200 OK", self.headers)
+        length = sum(len(buf) for buf in buffers)
 
-        self.result = [text]
-        self.process_result()
+        compressor = self.compressor(length)
+        if compressor is not None:
+            buffers = [compressor.compress(''.join(buffers), zlib.Z_FINISH)]
+            length = len(buffers[0])
 
-    def write_js(self, text):
-        self.content_type = ("Content-Type",
-                "application/javascript; charset=UTF-8")
+        self.headers += [
+            self.content_type,
+            ("Content-Length", str(length)),
+        ]
+        self.start_response(status, self.headers)
 
-        self.headers += [self.content_type]
-        self.start_response("200 OK", self.headers)
+        writer = self.frame_writer()
+        self.headers_sent = True
+        self.response_length += writer.send([self.raw_headers()] + buffers)
 
-        self.result = [text]
-        self.process_result()
+    def write_raw(self, status, head, body=''):
+        """
+        Write a response whose headers are already encoded, in one
+        write. The status line, Date and Connection headers are added
+        here, they depend on the request and the clock.
+        """
+        header_cache = self.server.header_cache
+        header_cache.tick()
 
-    def write_json(self, json):
-        self.content_type = ("Content-Type", "application/json; charset=UTF-8")
+        buffers = ['%s %s\r\n' % (self.request_version, status),
+            header_cache.date]
 
-        self.headers += [self.content_type]
-        self.start_response("200 OK", self.headers)
+        if self.closing:
+            buffers.append('Connection: close\r\n')
 
-        self.result = [protocol.encode(json)]
+        buffers += [head, '\r\n', body]
+
+        # start_response isn't called, the status is set for the
+        # access log by hand.
+        self.status = self._orig_status = status
+        self.headers_sent = True
+        self.response_length += self.frame_writer().send(buffers)
         self.log_request()
-        self.process_result()
 
-    def write_html(self, html):
-        content_type = ("Content-Type", "text/html; charset=UTF-8")
+    def write_text(self, text):
+        self.write_buffers([text])
+
+    def write_js(self, text):
+        self.write_buffers([text], ("Content-Type",
+                "application/javascript; charset=UTF-8"))
 
-        self.headers += [content_type]
-        self.start_response("200 OK", self.headers)
+    def write_json(self, json):
+        self.write_buffers([protocol.encode(json)],
+            ("Content-Type", "application/json; charset=UTF-8"))
+        self.log_request()
 
-        self.result = [html]
-        self.process_result()
+    def write_html(self, html):
+        self.write_buffers([html], ("Content-Type", "text/html; charset=UTF-8"))
 
     def write_options(self, allowed_methods):
         self.headers += [
@@ -131,11 +330,12 @@ class SockJSHandler(WSGIHandler):
         self.write_nothing()
 
     def write_nothing(self):
+        # No body, so no Content-Length either
         self.start_response("204 NO CONTENT", self.headers)
 
-        self.result = [None]
+        self.headers_sent = True
+        self.response_length += self.frame_writer().send([self.raw_headers()])
         self.log_request()
-        self.process_result()
 
     def greeting(self):
         self.write_text('Welcome to SockJS!\n')
@@ -148,22 +348,29 @@ class SockJSHandler(WSGIHandler):
 
         self.prep_response()
 
-        self.content_type = ("Content-Type", "text/plain; charset=UTF-8")
-        self.headers += [self.content_type]
-
         if cookie:
             self.enable_cookie()
 
-        self.start_response("404 NOT FOUND", self.headers)
+        self.write_buffers([message or '404 Error: Page not found'],
+            status="404 NOT FOUND")
 
-        if message:
-            self.result = [message]
-        else:
-            self.result = ['404 Error: Page not found']
+        self.wsgi_input._discard()
 
-        self.process_result()
+        self.time_finish = time.time()
+        self.log_request()
 
-        self.wsgi_input._discard()
+    def do413(self):
+        """
+        Reject a request body over the route's limit. The rest of
+        the body is left unread, so the connection can't be reused.
+        """
+
+        self.prep_response()
+        self.closing = True
+        self.close_connection = True
+
+        self.write_buffers(['Payload too large.'],
+            status="413 REQUEST ENTITY TOO LARGE")
 
         self.time_finish = time.time()
         self.log_request()
@@ -187,16 +394,11 @@ class SockJSHandler(WSGIHandler):
                 stack_trace = traceback.format_exception(exc_type, exc_value, exc_tb)
                 pretty_trace = str('\n'.join(stack_trace))
 
-            self.start_response("500 INTERNAL SERVER ERROR", self.headers)
-            self.result = [pretty_trace]
+            body = pretty_trace
         else:
-            self.content_type = ("Content-Type", "text/plain; charset=UTF-8")
-            self.headers += [self.content_type]
-
-            self.start_response("500 INTERNAL SERVER ERROR", self.headers)
-            self.result = [message or '500: Interneal Server Error']
+            body = message or '500: Interneal Server Error'
 
-        self.process_result()
+        self.write_buffers([body], status="500 INTERNAL SERVER ERROR")
         self.time_finish = time.time()
         self.log_request()
 
@@ -204,50 +406,28 @@ class SockJSHandler(WSGIHandler):
     # -------------------
 
     def enable_cors(self):
-        origin = self.environ.get("HTTP_ORIGIN", '*')
-
-        self.headers += [
-            ('access-control-allow-origin', origin),
-            ('access-control-allow-credentials', 'true')
-        ]
+        self.cors = True
 
     def enable_nocache(self):
-        self.headers += [
-            ('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0'),
-        ]
+        self.nocache = True
 
     def enable_cookie(self, cookies=None):
         """
         Given a list of cookies, add them to the header.
 
-        If not then add a dummy JSESSIONID cookie.
+        If not then echo the cookies of the request, or add a dummy
+        JSESSIONID cookie.
         """
-        if self.environ.get('HTTP_COOKIE'):
-            cookies = [SimpleCookie(self.environ.get('HTTP_COOKIE'))]
-
         if cookies:
             for cookie in cookies:
                 for morsel in cookie.values():
                     morsel['path'] = '/'
-                    # TODO: fixme
-                    k, v = cookie.output().split(':')[0:2]
-                self.headers += [(k,v)]
+                    self.headers += [('Set-Cookie', morsel.OutputString())]
         else:
-            cookie = SimpleCookie()
-            cookie['JSESSIONID'] = 'dummy'
-            cookie['JSESSIONID']['path'] = '/'
-            k, v = cookie.output().split(':')
-            self.headers += [(k,v)]
+            self.cookie = True
 
     def enable_caching(self):
-        d = datetime.datetime.now() + datetime.timedelta(days=365)
-        s = datetime.timedelta(days=365).total_seconds()
-
-        self.headers += [
-            ('Cache-Control', 'max-age=%d, public' % s),
-            ('Expires', d.strftime('%a, %d %b %Y %H:%M:%S')),
-            ('access-control-max-age', int(s)),
-        ]
+        self.caching = True
 
     def handle_websocket(self, tokens, raw=False):
         handle = WSHandler(
@@ -261,66 +441,111 @@ class SockJSHandler(WSGIHandler):
 
         handle.__dict__.update(self.__dict__)
 
-        return handle.handle_one_response()
+        try:
+            return handle.handle_one_response()
+        finally:
+            # The websocket handler answered, logged and is done with
+            # the connection.
+            self.headers_sent = True
+            self.logged = True
+            self.close_connection = True
 
     def handle_one_response(self):
-        path = self.environ.get('PATH_INFO')
+        keepalive = self.server.keepalive
+        keepalive.requests += 1
+        if self.served:
+            keepalive.reused += 1
+        self.served += 1
+
+        self.closing = keepalive.full()
+        if self.closing:
+            keepalive.refused += 1
+            self.close_connection = True
+
+        self.logged = False
+        router = self.server.router
+
+        # The router is mounted somewhere inside the application,
+        # which gets every request.
+        if router is None:
+            return super(SockJSHandler, self).handle_one_response()
+
+        url = router.dispatcher.resolve(self.environ.get('PATH_INFO'))
+
+        # Anything else goes to the application behind the router
+        if router.app is not None and not router.serves(url):
+            self.route_name = None
+            self.application = router.app
+            return super(SockJSHandler, self).handle_one_response()
+
+        if url is None:
+            self.route_name = None
+            return self.do404()
+
+        return self.dispatch(router, url)
+
+    def dispatch(self, router, url):
+        """
+        Serve a request resolved by the router's Dispatcher, writing
+        straight to the connection.
+        """
         meth = self.environ.get("REQUEST_METHOD")
 
-        self.router = self.server.application
+        self.router = router
         self.session_pool = self.server.session_pool
 
-        # Static URLs
-        # -----------
-
-        static_url = self.STATIC_FORMAT.match(path)
-        dynamic_url = self.DYNAMIC_FORMAT.match(path)
-        raw_url = self.RAW_FORMAT.match(path)
+        kind, route, server, session_uid, transport = url
+        self.route_name = route
 
         # The degenerate raw websocket endpoint
-        if raw_url:
-            tokens = raw_url.groupdict()
-
-            tokens['transport'] = 'rawwebsocket'
-            # An ad-hoc session
-            tokens['session']   = uuid.uuid4()
+        if kind == Dispatcher.RAW:
+            tokens = {
+                'route'     : route,
+                'transport' : 'rawwebsocket',
+                # An ad-hoc session
+                'session'   : uuid.uuid4(),
+            }
 
             return self.handle_websocket(tokens, raw=True)
 
-        elif static_url:
-            tokens = static_url.groupdict()
+        # Static URLs
+        # -----------
 
-            route       = tokens['route']
-            suffix      = tokens['suffix']
+        elif kind == Dispatcher.STATIC:
+            # The suffix takes the transport's place
+            suffix = transport
 
             try:
                 static_serve = self.router.route_static(route, suffix)
-                raw_request_data = self.wsgi_input.readline()
+
+                # Static pages don't take a body, skip it unbuffered
                 self.wsgi_input._discard()
 
                 self.prep_response()
-                static_serve(self, meth, raw_request_data)
+                static_serve(self, meth, None)
 
             except Http404 as e:
                 return self.do404(e.message)
             except Http500 as e:
                 return self.do500(e.stacktrace)
 
-        elif dynamic_url:
-            tokens = dynamic_url.groupdict()
-
-            route       = tokens['route']
-            session_uid = tokens['session_id']
-            server      = tokens['server_id']
-            transport   = tokens['transport']
+        # Dynamic URLs
+        # ------------
 
+        else:
             if transport == 'websocket':
-                return self.handle_websocket(tokens)
+                return self.handle_websocket({
+                    'route'      : route,
+                    'server_id'  : server,
+                    'session_id' : session_uid,
+                    'transport'  : transport,
+                })
 
             try:
                 # Router determines the downlink route as a
                 # function of the given url parameters.
                 downlink = self.router.route_dynamic(
+                    self.server,
                     route,
                     session_uid,
                     server,
@@ -328,24 +553,37 @@ class SockJSHandler(WSGIHandler):
                 )
 
                 # A downlink is some data-dependent connection
-                # to the client taken as a result of a request.
-                raw_request_data = self.wsgi_input.readline()
+                # to the client taken as a result of a request. The
+                # body is handed over unread, the transports which
+                # take one stream it.
+                request_body = RequestBody(
+                    self.wsgi_input,
+                    self.environ,
+                    downlink.conn.max_payload
+                )
 
                 self.prep_response()
-                threads = downlink(self, meth, raw_request_data)
+                threads = downlink(self, meth, request_body)
 
                 gevent.joinall(threads)
 
+                # Whatever is left of a body the transport gave up
+                # on, so the next request on the connection starts
+                # in the right place.
+                try:
+                    self.wsgi_input._discard()
+                except IOError:
+                    self.close_connection = True
+
             except Http404 as e:
                 return self.do404(e.message, cookie=True)
+            except Http413 as e:
+                return self.do413()
             except Http500 as e:
                 return self.do500(e.stacktrace)
             except Exception:
                 return self.do500()
 
-        else:
-            self.do404()
-
 class WSHandler(WebSocketHandler):
     """
     A WSGI-esque handler but the underlying connection is a
@@ -372,6 +610,14 @@ class WSHandler(WebSocketHandler):
         self.response_use_chunked = False
         self.response_length = 0
 
+    def log_request(self):
+        access_log = self.server.access_log
+
+        if access_log is None:
+            return super(WSHandler, self).log_request()
+
+        access_log.record(self)
+
     def bad_request(self):
         """
         Sent if we have invaild Connection headers.
@@ -407,6 +653,36 @@ class WSHandler(WebSocketHandler):
         # Malformed request
         self.bad_request()
 
+    def _handle_hybi(self):
+        """
+        The hybi handshake, with the permessage-deflate extension
+        when the server offers it and the client asks for it.
+        """
+        settings = self.server.websocket_deflate
+        offer = self.environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS')
+
+        self.deflate = None
+        if settings is not None and offer:
+            self.deflate = settings.negotiate(offer,
+                self.server.compression_stats)
+
+        result = super(WSHandler, self)._handle_hybi()
+
+        if result and self.deflate is not None:
+            header, deflater = self.deflate
+            self.websocket = DeflateWebSocket(self.websocket, deflater)
+            self.environ['wsgi.websocket'] = self.websocket
+
+        return result
+
+    def _send_reply(self, status, headers):
+        deflate = getattr(self, 'deflate', None)
+
+        if deflate is not None and status.startswith('101'):
+            headers = headers + [('Sec-WebSocket-Extensions', deflate[0])]
+
+        return super(WSHandler, self)._send_reply(status, headers)
+
     def _handle_websocket(self):
         """
         Slightly overloaded version of gevent websocket handler,
@@ -438,23 +714,26 @@ class WSHandler(WebSocketHandler):
         is more or less identical to HTTP logic instead of
         exposing the WSGI handler we expose the socket.
         """
-        self.router = self.server.application
-
         websocket = environ.get('wsgi.websocket')
         meth = environ.get("REQUEST_METHOD")
 
         # The only mandatory url token
         route       = self.tokens['route']
 
-        session_uid = self.tokens.get('session_id', None)
         server      = self.tokens.get('server_id',  None)
         transport   = self.tokens.get('transport',  None)
 
+        # A websocket session belongs to its connection, the session
+        # id in the url isn't used. Two websockets opened with the
+        # same id get a session each.
+        session_uid = None
+
         # We're no longer dealing with HTTP so throw away
         # anything we received.
         self.wsgi_input._discard()
 
         downlink = self.router.route_dynamic(
+            self.server,
             route,
             session_uid,
             server,
@@ -0,0 +1,141 @@
+"""
+Pre-encoded response headers.
+
+The CORS, cookie and cache headers of a response only depend on
+which of them its transport asks for, the request's Origin and
+JSESSIONID cookie, and the clock. Rather than building them as
+tuples for every response and formatting them again when the head
+is written, HeaderCache keeps each combination as a block of
+``Name: value\\r\\n`` lines ready to be written as is.
+
+The Date and Expires values are the only ones which go stale, they
+are kept out of the cached blocks and rebuilt once a second.
+"""
+
+import re
+import time
+
+from email.utils import formatdate
+
+NOCACHE = 'Cache-Control: no-store, no-cache, must-revalidate, max-age=0\r\n'
+
+# The JSESSIONID cookie of a Cookie request header, the only one
+# echoed back, for the sticky sessions of load balancers.
+JSESSIONID = re.compile(r'(?:^|;)\s*JSESSIONID=\s*"?([^";]*)"?')
+
+def session_cookie(cookie):
+    """
+    The value of the JSESSIONID cookie in a Cookie header, or the
+    dummy one if there is none.
+    """
+    match = JSESSIONID.search(cookie) if cookie else None
+
+    if match is None or not match.group(1).strip():
+        return 'dummy'
+
+    return match.group(1).strip()
+
+class HeaderCache(object):
+    """
+    Server wide cache of header blocks. Blocks are keyed by the
+    headers asked for and the values they echo, ``max_entries``
+    bounds how many distinct origins and session cookies are kept,
+    the cache starts over once it is reached.
+    """
+
+    max_entries = 1024
+
+    # Responses to OPTIONS requests are cached for a year
+    max_age = 365 * 24 * 3600
+
+    def __init__(self, max_entries=None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+
+        self.blocks = {}
+        self.second = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def tick(self, now=None):
+        """
+        Rebuild the time dependent headers if the clock moved on to
+        another second since they were last built.
+        """
+        if now is None:
+            now = time.time()
+
+        second = int(now)
+
+        if second != self.second:
+            self.second = second
+
+            self.date = 'Date: %s\r\n' % formatdate(second, usegmt=True)
+            self.caching = ''.join([
+                'Cache-Control: max-age=%d, public\r\n' % self.max_age,
+                'Expires: %s\r\n' % formatdate(second + self.max_age,
+                    usegmt=True),
+                'access-control-max-age: %d\r\n' % self.max_age,
+            ])
+
+    def headers(self, origin=None, cookie=None, nocache=False, caching=False,
+            now=None):
+        """
+        The header lines of a response: its Date, the cache headers
+        if ``caching`` is set, and its cached block.
+        """
+        self.tick(now)
+
+        head = [self.date]
+
+        if caching:
+            head.append(self.caching)
+
+        head.append(self.block(origin, cookie, nocache))
+        return head
+
+    def block(self, origin=None, cookie=None, nocache=False):
+        """
+        The cached, time independent headers of a response.
+
+        ``origin`` adds the CORS headers allowing that origin, ``*``
+        for any, ``cookie`` the Cookie header of a request whose
+        JSESSIONID is echoed in a Set-Cookie header, ``''`` for the
+        dummy one.
+        """
+        if cookie is not None:
+            cookie = session_cookie(cookie)
+
+        key = (origin, cookie, nocache)
+
+        try:
+            block = self.blocks[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return block
+
+        self.misses += 1
+
+        if len(self.blocks) >= self.max_entries:
+            self.blocks.clear()
+
+        block = self.blocks[key] = self.build(origin, cookie, nocache)
+        return block
+
+    def build(self, origin, session_id, nocache):
+        head = []
+
+        if nocache:
+            head.append(NOCACHE)
+
+        if session_id is not None:
+            head.append('Set-Cookie: JSESSIONID=%s; Path=/\r\n' % session_id)
+
+        if origin is not None:
+            head.append('access-control-allow-origin: %s\r\n' % origin)
+            head.append('access-control-allow-credentials: true\r\n')
+
+        return ''.join(head)
@@ -0,0 +1,129 @@
+"""
+Heartbeats for idle streaming and websocket connections.
+
+Proxies drop connections which stay quiet for too long, a SockJS
+server sends an ``h`` frame down every connection which hasn't sent
+anything for a while. Rather than one timer per connection, the
+server keeps a single scheduler: the connections are filed in a
+TimingWheel by the time their next heartbeat is due, and one
+greenlet walks the buckets as they come up.
+
+The scheduler doesn't write the frames itself, each connection has
+a single writer. It marks the heartbeat as due and wakes the
+session's writer, which sends it. Connections which sent a frame
+since they were filed are put back for a full interval from that
+frame instead.
+"""
+
+import time
+import gevent
+
+from sessionpool import TimingWheel
+
+class Heartbeat(object):
+    """
+    A connection's entry in the scheduler.
+    """
+
+    __slots__ = (
+        'session',
+        'interval',
+        'last_sent',
+        'due',
+        'expires_at',
+        'wheel_slot',
+    )
+
+    def __init__(self, session, interval):
+        self.session = session
+        self.interval = interval
+
+        self.last_sent = time.time()
+        self.due = False
+
+        # Time the next heartbeat is due, and the wheel's bookkeeping
+        self.expires_at = self.last_sent + interval
+        self.wheel_slot = None
+
+    def sent(self):
+        """
+        Called by the writer for every frame it sends.
+        """
+        self.last_sent = time.time()
+        self.due = False
+
+class HeartbeatScheduler(object):
+    """
+    Server wide heartbeat scheduler, ``resolution`` is the width in
+    seconds of the wheel's buckets and the period of its greenlet.
+    """
+
+    resolution = 1.0
+
+    def __init__(self, resolution=None):
+        if resolution is not None:
+            self.resolution = resolution
+
+        self.wheel = TimingWheel(resolution=self.resolution)
+        self.thread = gevent.Greenlet(self._run)
+
+        # Heartbeats marked as due, and the writers woken for them
+        self.due = 0
+        self.woken = 0
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def start(self):
+        if not self.thread.started:
+            self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.thread.kill(block=False)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.resolution)
+            self.run()
+
+    def add(self, session, interval):
+        """
+        File a session to receive heartbeats every ``interval``
+        seconds it stays idle. Returns its Heartbeat.
+        """
+        beat = Heartbeat(session, interval)
+        self.wheel.schedule(beat)
+        return beat
+
+    def remove(self, beat):
+        self.wheel.remove(beat)
+
+    def run(self, now=None):
+        """
+        Handle every heartbeat whose time has come.
+        """
+        if now is None:
+            now = time.time()
+
+        wheel = self.wheel
+        wheel.advance(now)
+
+        beat = wheel.pop_expired()
+
+        while beat is not None:
+            next_due = beat.last_sent + beat.interval
+
+            if next_due > now:
+                # Sent something since, count the interval from there
+                beat.expires_at = next_due
+            else:
+                beat.due = True
+                beat.expires_at = now + beat.interval
+                self.due += 1
+
+                if beat.session.wake():
+                    self.woken += 1
+
+            wheel.schedule(beat)
+            beat = wheel.pop_expired()
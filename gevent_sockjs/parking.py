@@ -0,0 +1,122 @@
+"""
+Parking for long polls.
+
+A poll with nothing to send waits for a message or its timeout.
+Rather than a greenlet and a timer per poll, the handler's greenlet
+parks itself on the session: it is switched back to directly when a
+message is queued or the session is woken, or by the server's
+ParkingLot once its time is up. The timeouts of every parked poll
+share one TimingWheel, turned by a single greenlet, and are only as
+precise as its resolution.
+"""
+
+import time
+import gevent
+
+from gevent.hub import Waiter
+
+from sessionpool import TimingWheel
+
+class Parked(object):
+    """
+    A poll parked on a session.
+    """
+
+    __slots__ = (
+        'waiter',
+        'done',
+        'expires_at',
+        'wheel_slot',
+    )
+
+    def __init__(self, waiter, expires_at):
+        self.waiter = waiter
+        self.done = False
+
+        self.expires_at = expires_at
+        self.wheel_slot = None
+
+    def resume(self, woken):
+        """
+        Switch back to the parked greenlet, once. Safe to call from
+        any greenlet, the switch is made from the hub.
+        """
+        if not self.done:
+            self.done = True
+            gevent.get_hub().loop.run_callback(self.waiter.switch, woken)
+
+    def wake(self):
+        self.resume(True)
+
+class ParkingLot(object):
+    """
+    Server wide timeouts of parked polls, ``resolution`` is the
+    width in seconds of the wheel's buckets and the period of its
+    greenlet.
+    """
+
+    resolution = 0.25
+
+    def __init__(self, resolution=None):
+        if resolution is not None:
+            self.resolution = resolution
+
+        self.wheel = TimingWheel(resolution=self.resolution)
+        self.thread = gevent.Greenlet(self._run)
+
+        # Polls resumed by their session and by their timeout
+        self.woken = 0
+        self.timed_out = 0
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def start(self):
+        if not self.thread.started:
+            self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.thread.kill(block=False)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.resolution)
+            self.run()
+
+    def run(self, now=None):
+        """
+        Resume the parked polls whose timeout has passed.
+        """
+        wheel = self.wheel
+        wheel.advance(time.time() if now is None else now)
+
+        parked = wheel.pop_expired()
+
+        while parked is not None:
+            parked.resume(False)
+            parked = wheel.pop_expired()
+
+    def wait(self, session, timeout):
+        """
+        Park the calling greenlet until ``session`` has a message
+        for it, is woken, or ``timeout`` seconds have passed.
+        Returns whether the session woke it.
+        """
+        parked = Parked(Waiter(), time.time() + timeout)
+        self.wheel.schedule(parked)
+
+        session.listener = parked.wake
+
+        try:
+            woken = parked.waiter.get()
+        finally:
+            session.listener = None
+            self.wheel.remove(parked)
+
+        if woken:
+            self.woken += 1
+        else:
+            self.timed_out += 1
+
+        return woken
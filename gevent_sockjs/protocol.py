@@ -1,6 +1,8 @@
-import hashlib
+import re
+import codecs
+from json.encoder import encode_basestring_ascii
 from errors import *
-from simplejson.decoder import JSONDecodeError
+from simplejson.decoder import JSONDecoder, JSONDecodeError
 
 # -----------
 # Serializer
@@ -50,6 +52,10 @@ CLOSE     = "c"
 MESSAGE   = "a"
 HEARTBEAT = "h\n"
 
+# Prefix of message frames carrying a sequence number, only sent to
+# routes which opt into replay.
+SEQUENCE  = "s"
+
 # ------------------
 
 IFRAME_HTML = """
@@ -71,19 +77,162 @@ IFRAME_HTML = """
 </html>
 """.strip()
 
-IFRAME_MD5 = hashlib.md5(IFRAME_HTML).hexdigest()
+HTMLFILE_HTML = """
+<!doctype html>
+<html><head>
+  <meta http-equiv="X-UA-Compatible" content="IE=edge" />
+  <meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />
+</head><body><h2>Don't panic!</h2>
+  <script>
+    document.domain = document.domain;
+    var c = parent.%s;
+    c.start();
+    function p(d) {c.message(d);};
+    window.onload = function() {c.stop();};
+  </script>
+""".strip()
+
+# Encoding
+# --------
+
+def dumps(value):
+    """
+    Compact JSON with the picked serializer, ujson is compact
+    already and doesn't take separators.
+    """
+    if has_ujson and json is ujson:
+        return json.dumps(value)
+    return json.dumps(value, separators=(',',':'))
+
+# Characters the SockJS spec requires servers to escape in strings,
+# on top of the quote, backslash and control characters JSON itself
+# needs.
+ESCAPABLE_WIDE = re.compile(u'[\u200c-\u200f\u2028-\u202f'
+                            u'\u2060-\u206f\ud800-\udfff\ufff0-\uffff]')
+
+CONTROL_BYTES = ''.join(chr(i) for i in range(0x20))
+ESCAPED_BYTES = CONTROL_BYTES + '"\\'
+
+# Bytes which keep a str from being sent verbatim, str.translate
+# deletes them in one C pass, faster than a regex search on all
+# but the shortest strings.
+UNSAFE_BYTES = ESCAPED_BYTES + ''.join(chr(i) for i in range(0x80, 0x100))
+
+def is_safe(string):
+    return len(string.translate(None, UNSAFE_BYTES)) == len(string)
+
+def quote(string):
+    """
+    A str or unicode as a JSON string literal, UTF-8 encoded.
+
+    Quotes, backslashes and the usual whitespace escapes are done
+    with str.replace on the UTF-8 bytes. Strings holding one of the
+    wide characters the spec lists, or a rarer control character,
+    go through the json module's C escaper instead, which escapes
+    every non-ASCII character: bigger on the wire, but only for
+    those strings.
+    """
+    if isinstance(string, str):
+        if is_safe(string):
+            return '"' + string + '"'
+        string = string.decode('utf-8', 'replace')
+
+    if ESCAPABLE_WIDE.search(string) is None:
+        data = string.encode('utf-8')
+
+        if len(data.translate(None, ESCAPED_BYTES)) == len(data):
+            return '"' + data + '"'
+
+        data = data.replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+
+        if len(data.translate(None, CONTROL_BYTES)) == len(data):
+            return '"' + data + '"'
+
+    return encode_basestring_ascii(string)
+
+def encode_value(value):
+    if isinstance(value, Encoded):
+        return value
+    elif isinstance(value, basestring):
+        return quote(value)
+    return dumps(value)
+
+class Encoded(str):
+    """
+    A message serialized to JSON once, for broadcasting. The same
+    instance is queued into every subscriber's session and spliced
+    into their frames as is.
+    """
+
+    def __new__(cls, value):
+        encoded = str.__new__(cls, encode_value(value))
+
+        # The original message, for transports that don't frame
+        # messages as JSON, and the single message array.
+        encoded._value = value
+        encoded.array = '[' + encoded + ']'
+        return encoded
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Wrap a message which is already JSON, read back from a
+        session store for instance, without decoding it.
+        """
+        encoded = str.__new__(cls, data)
+        encoded._value = UNDECODED
+        encoded.array = '[' + encoded + ']'
+        return encoded
+
+    @property
+    def value(self):
+        # Decoded on first use, only raw websockets need it
+        if self._value is UNDECODED:
+            self._value = json.loads(self)
+        return self._value
+
+UNDECODED = object()
+
+def encode_batch(messages):
+    """
+    A list of messages as a JSON array. Lists of plain ASCII
+    strings, the common case, are checked and joined in one pass.
+    """
+    if not messages:
+        return '[]'
+
+    if len(messages) == 1 and isinstance(messages[0], Encoded):
+        return messages[0].array
+
+    kinds = set(map(type, messages))
+
+    if kinds == STR and is_safe(''.join(messages)):
+        return '["' + '","'.join(messages) + '"]'
+
+    if kinds <= STRINGS or Encoded in kinds:
+        return '[' + ','.join([encode_value(m) for m in messages]) + ']'
+
+    return dumps(messages)
+
+STR = set([str])
+STRINGS = set([str, unicode, Encoded])
 
 def encode(message):
     """
     Python to JSON
+
+    Strings are escaped as the SockJS spec requires, without going
+    through the JSON serializer.
     """
-    # TODO: actually deal with the nuances of escaping and
-    # unicode
-    if isinstance(message, basestring):
-        # Don't both calling json, since its simple
-        msg = '["' + message + '"]'
+    if isinstance(message, list):
+        msg = encode_batch(message)
+    elif isinstance(message, Encoded):
+        msg = message.array
+    elif isinstance(message, basestring):
+        msg = '[' + quote(message) + ']'
     elif isinstance(message, (object, dict, list)):
-        msg = json.dumps(message, separators=(',',':'))
+        msg = dumps(message)
     else:
         raise ValueError("Unable to serialize: %s", str(message))
 
@@ -104,6 +253,218 @@ def decode(data):
 
     return messages
 
+class ArrayDecoder(object):
+    """
+    Incremental decoder for a JSON array of messages, fed the raw
+    request body a chunk at a time. Each feed returns the messages
+    completed so far, only the message still being received is
+    kept buffered.
+
+        decoder = ArrayDecoder()
+        for chunk in body.chunks():
+            for message in decoder.feed(chunk):
+                ...
+        decoder.close()
+
+    A message arriving in pieces is only scanned for the end of its
+    string or the bracket closing it, keeping the nesting depth
+    across chunks, every byte is looked at once. It is decoded once
+    it is complete, so the cost stays linear in the size of the
+    body however it is split.
+
+    Raises InvalidJSON as soon as the data can't be a JSON array,
+    or on close if the array is incomplete.
+    """
+
+    START, FIRST, VALUE, DELIMITER, DONE = range(5)
+
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    # What a value may start with
+    VALUE_START = frozenset(u'"[{-0123456789tfn')
+
+    # The end of a number or a literal
+    SCALAR_END = re.compile(r'[ \t\n\r,\]}]')
+
+    # Structure outside of strings, and inside them
+    STRUCTURE = re.compile(r'["\[\]{}]')
+    STRING_SPECIAL = re.compile(r'["\\]')
+
+    decoder = JSONDecoder()
+
+    def __init__(self):
+        self.state = self.START
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+
+        # Pieces of the value being received, None between values,
+        # and where the scan of it stands.
+        self.pending = None
+        self.scalar = False
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, data, final=False):
+        try:
+            text = self.utf8.decode(data, final)
+        except UnicodeDecodeError:
+            raise InvalidJSON()
+
+        end = len(text)
+        pos = 0
+        messages = []
+
+        while True:
+            if self.pending is not None:
+                stop = self.scan(text, pos, final)
+
+                if stop is None:
+                    if final:
+                        raise InvalidJSON()
+                    self.pending.append(text[pos:])
+                    break
+
+                self.pending.append(text[pos:stop])
+                messages.append(self.decode_pending())
+                pos = stop
+                self.state = self.DELIMITER
+                continue
+
+            pos = self.WHITESPACE.match(text, pos).end()
+
+            if pos == end:
+                break
+
+            state = self.state
+
+            if state == self.START:
+                if text[pos] != '[':
+                    raise InvalidJSON()
+                pos += 1
+                self.state = self.FIRST
+
+            elif state == self.FIRST and text[pos] == ']':
+                pos += 1
+                self.state = self.DONE
+
+            elif state in (self.FIRST, self.VALUE):
+                char = text[pos]
+
+                if char not in self.VALUE_START:
+                    raise InvalidJSON()
+
+                # The scan picks the value up from its first char
+                self.pending = []
+                self.scalar = char not in u'"[{'
+                self.depth = 0
+                self.in_string = False
+                self.escaped = False
+
+            elif state == self.DELIMITER:
+                if text[pos] == ',':
+                    self.state = self.VALUE
+                elif text[pos] == ']':
+                    self.state = self.DONE
+                else:
+                    raise InvalidJSON()
+                pos += 1
+
+            else:
+                # Trailing data after the array
+                raise InvalidJSON()
+
+        return messages
+
+    def scan(self, text, pos, final):
+        """
+        Look for the end of the pending value from ``pos``, returns
+        the index just past it, or None if it goes on past the text.
+        """
+        end = len(text)
+
+        if self.scalar:
+            match = self.SCALAR_END.search(text, pos)
+
+            if match is not None:
+                return match.start()
+
+            # The number or literal may go on in the next chunk
+            return end if final else None
+
+        if self.escaped:
+            if pos == end:
+                return None
+            pos += 1
+            self.escaped = False
+
+        while True:
+            if self.in_string:
+                match = self.STRING_SPECIAL.search(text, pos)
+
+                if match is None:
+                    return None
+
+                pos = match.start()
+
+                if text[pos] == '\\':
+                    if pos + 1 == end:
+                        self.escaped = True
+                        return None
+                    pos += 2
+                    continue
+
+                pos += 1
+                self.in_string = False
+
+                if not self.depth:
+                    return pos
+
+            else:
+                match = self.STRUCTURE.search(text, pos)
+
+                if match is None:
+                    return None
+
+                char = match.group()
+                pos = match.end()
+
+                if char == '"':
+                    self.in_string = True
+                elif char in '[{':
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+
+                    if self.depth < 0:
+                        raise InvalidJSON()
+                    if not self.depth:
+                        return pos
+
+    def decode_pending(self):
+        value = u''.join(self.pending)
+        self.pending = None
+
+        try:
+            message, stop = self.decoder.raw_decode(value)
+        except JSONDecodeError:
+            raise InvalidJSON()
+
+        if stop != len(value):
+            raise InvalidJSON()
+
+        return message
+
+    def close(self):
+        """
+        Signal the end of the data, returns any last messages.
+        """
+        messages = self.feed('', final=True)
+
+        if self.state != self.DONE:
+            raise InvalidJSON()
+
+        return messages
+
 def close_frame(code, reason, newline=True):
     if newline:
         return '%s[%d,"%s"]\n' % (CLOSE, code, reason)
@@ -118,6 +479,22 @@ def message_frame(data):
 
     return ''.join([MESSAGE, data])
 
+def sequenced_frame(seq, data):
+    """
+    A message frame prefixed with the sequence number of its last
+    message batch, ( Example: s12a["x","y"] ).
+    """
+    return ''.join([message_prefix(seq), data])
+
+def message_prefix(seq=None):
+    """
+    The bytes put in front of an encoded message array, for
+    writers which send the frame as separate buffers.
+    """
+    if seq is None:
+        return MESSAGE
+    return ''.join([SEQUENCE, str(seq), MESSAGE])
+
 def enum(*sequential, **named):
     enums = dict(zip(sequential, range(len(sequential))), **named)
     return type('Enum', (), enums)
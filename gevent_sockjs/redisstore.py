@@ -0,0 +1,375 @@
+"""
+Session storage in a networked key-value store speaking the Redis
+protocol, so queued messages outlive the process that accepted them.
+
+Each session's outgoing messages are a list under ``prefix +
+session_id``, of messages serialized once on the way in and handed
+back still serialized, as protocol.Encoded frames. Messages added
+in the same tick of the hub are sent as one pipelined batch from a
+single flushing greenlet, and a session's list is drained in one
+round-trip.
+
+A flush that fails loses its messages, they are counted in
+``RedisStore.lost`` and logged.
+
+Usage::
+
+    store = RedisStore(('127.0.0.1', 6379))
+    sockjs = SockJSServer(('', 8081), router,
+        session_backend=RedisSession,
+        session_store=store,
+    )
+"""
+
+import sys
+import uuid
+from math import ceil
+from contextlib import contextmanager
+
+import gevent
+from gevent import socket
+from gevent.queue import Queue, Empty
+
+import protocol
+from errors import RedisError
+from session import Session
+
+# Wire Protocol
+# =============
+
+def encode_command(args):
+    """
+    Serialize one command in the unified request protocol.
+    """
+    out = ['*%d\r\n' % len(args)]
+
+    for arg in args:
+        if isinstance(arg, unicode):
+            arg = arg.encode('utf-8')
+        elif not isinstance(arg, str):
+            arg = str(arg)
+
+        out.append('$%d\r\n%s\r\n' % (len(arg), arg))
+
+    return ''.join(out)
+
+class RedisConnection(object):
+    """
+    A single connection to the store. Not safe to share between
+    greenlets, check one out of a ConnectionPool instead.
+    """
+
+    def __init__(self, address, timeout=None):
+        self.address = address
+        self.sock = socket.create_connection(address, timeout)
+        self.reader = self.sock.makefile('rb')
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def execute(self, *commands):
+        """
+        Send every command in one write and read back their
+        replies, in order.
+        """
+        self.sock.sendall(''.join(encode_command(args) for args in commands))
+        return [self.read_reply() for args in commands]
+
+    def read_reply(self):
+        line = self.reader.readline()
+
+        if not line.endswith('\r\n'):
+            raise RedisError('Connection closed by the store')
+
+        kind, rest = line[0], line[1:-2]
+
+        if kind == '+':
+            return rest
+        elif kind == '-':
+            # Errors are returned, not raised, so the rest of a
+            # pipeline can still be read off the socket.
+            return RedisError(rest)
+        elif kind == ':':
+            return int(rest)
+        elif kind == '$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        elif kind == '*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self.read_reply() for i in xrange(length)]
+
+        raise RedisError('Unknown reply type %r' % kind)
+
+class ConnectionPool(object):
+    """
+    A bounded pool of connections, opened on demand.
+    """
+
+    def __init__(self, address, size=8, timeout=None):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+
+        self.idle = Queue()
+        self.opened = 0
+
+    def get(self):
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            pass
+
+        if self.opened < self.size:
+            self.opened += 1
+            try:
+                return RedisConnection(self.address, self.timeout)
+            except socket.error as e:
+                self.opened -= 1
+                raise RedisError(str(e))
+
+        return self.idle.get()
+
+    def put(self, conn):
+        self.idle.put(conn)
+
+    def discard(self, conn):
+        self.opened -= 1
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self.get()
+
+        try:
+            yield conn
+        except BaseException:
+            # The connection is in an unknown state, don't reuse it.
+            # This includes a greenlet killed while it waits on a
+            # reply, as a transport's writer is when its client goes.
+            self.discard(conn)
+            raise
+        else:
+            self.put(conn)
+
+    def close(self):
+        while not self.idle.empty():
+            self.discard(self.idle.get_nowait())
+
+class RedisStore(object):
+    """
+    Message storage for RedisSession.
+    """
+
+    # Seconds a session's message list is kept without being
+    # written to.
+    ttl = 60
+
+    def __init__(self, address=('127.0.0.1', 6379), pool_size=8,
+            blocking_pool_size=256, prefix='sockjs:', ttl=None, timeout=None):
+        self.pool = ConnectionPool(address, pool_size, timeout)
+
+        # Blocking pops park a connection for as long as a poll
+        # lasts, they get their own pool so they never hold up the
+        # writes which would wake them.
+        self.blocking_pool = ConnectionPool(address, blocking_pool_size)
+
+        self.prefix = prefix
+
+        if ttl is not None:
+            self.ttl = ttl
+
+        # Commands queued for the next pipelined flush
+        self.pending = []
+        self.flusher = None
+
+        self.round_trips = 0
+
+        # Messages whose flush failed
+        self.lost = 0
+
+    def key(self, session_id):
+        return self.prefix + session_id
+
+    def execute(self, *commands, **kwargs):
+        pool = self.blocking_pool if kwargs.get('blocking') else self.pool
+
+        with pool.connection() as conn:
+            replies = conn.execute(*commands)
+
+        self.round_trips += 1
+        return replies
+
+    def schedule(self, *command):
+        """
+        Queue a write for the next flush. The flush runs once the
+        current greenlet yields to the hub.
+        """
+        self.pending.append(command)
+
+        if self.flusher is None:
+            self.flusher = gevent.spawn(self.flush)
+
+    def flush(self):
+        """
+        Send every queued write as a single pipeline. Consecutive
+        pushes to the same list are merged into one RPUSH.
+        """
+        self.flusher = None
+
+        pending, self.pending = self.pending, []
+
+        if not pending:
+            return
+
+        commands = []
+        touched = set()
+
+        for command in pending:
+            if command[0] == 'RPUSH':
+                touched.add(command[1])
+
+                if commands and commands[-1][:2] == list(command[:2]):
+                    commands[-1].extend(command[2:])
+                    continue
+            else:
+                touched.discard(command[1])
+
+            commands.append(list(command))
+
+        for key in touched:
+            commands.append(['EXPIRE', key, self.ttl])
+
+        # Nobody waits on the flusher, errors stop here
+        try:
+            replies = self.execute(*commands)
+        except (socket.error, RedisError) as e:
+            self.lose(commands, e)
+            return
+
+        for command, reply in zip(commands, replies):
+            if isinstance(reply, RedisError):
+                self.lose([command], reply)
+
+    def lose(self, commands, error):
+        """
+        Count and log the messages of writes which failed.
+        """
+        lost = sum(len(command) - 2 for command in commands
+            if command[0] == 'RPUSH')
+
+        if lost:
+            self.lost += lost
+            sys.stderr.write('RedisStore: %d messages lost, %s\n' %
+                (lost, error))
+
+    def push(self, key, message):
+        self.schedule('RPUSH', key, protocol.encode_value(message))
+
+    def delete(self, key):
+        self.schedule('DEL', key)
+
+    def drain(self, key, timeout=None, block=True):
+        """
+        Atomically read and clear a message list. If it is empty
+        and ``block`` is set, wait up to ``timeout`` seconds ( or
+        forever ) for the first message. Messages come back as the
+        protocol.Encoded frames they were stored as.
+        """
+        replies = self.execute(
+            ('MULTI',),
+            ('LRANGE', key, 0, -1),
+            ('DEL', key),
+            ('EXEC',),
+        )
+
+        result = replies[-1]
+        if isinstance(result, RedisError):
+            raise result
+
+        messages = result[0]
+
+        if not messages and block:
+            # BLPOP takes whole seconds, 0 meaning forever
+            wait = 0 if timeout is None else max(int(ceil(timeout)), 1)
+
+            popped = self.execute(('BLPOP', key, wait), blocking=True)[0]
+            if isinstance(popped, RedisError):
+                raise popped
+
+            if popped is None:
+                return []
+
+            # Pick up anything pushed alongside the first message
+            return [protocol.Encoded.from_json(popped[1])] + \
+                self.drain(key, block=False)
+
+        return [protocol.Encoded.from_json(message) for message in messages]
+
+    def close(self):
+        self.pool.close()
+        self.blocking_pool.close()
+
+class RedisSession(Session):
+    """
+    Session whose outgoing queue lives in a RedisStore, taken from
+    the server's ``session_store``.
+    """
+
+    __slots__ = (
+        'server',
+        'store',
+        'key',
+        'connected',
+    )
+
+    def __init__(self, server, session_id=None):
+        super(RedisSession, self).__init__(server, session_id)
+        self.server = server
+        self.store = server.session_store
+        self.key = self.store.key(self.session_id)
+        self.connected = False
+
+    def generate_uid(self):
+        return str(uuid.uuid4())[:8]
+
+    def add_message(self, msg):
+        self.store.push(self.key, msg)
+
+    def get_messages(self, **kwargs):
+        self.incr_hits()
+        return self.store.drain(self.key, **kwargs)
+
+    def get_batch(self, batching, **kwargs):
+        # Blocking pops only wait whole seconds, sleep through the
+        # window and pick up whatever arrived instead.
+        messages = self.get_messages(**kwargs)
+
+        if messages and batching is not None and batching.window:
+            gevent.sleep(batching.window)
+            messages.extend(self.get_messages(block=False))
+
+        return messages
+
+    def post_delete(self):
+        self.store.delete(self.key)
+
+    def interrupt(self):
+        self.interrupted = True
+        self.kill()
+
+    def kill(self):
+        self.connected = False
+
+        # Expire only once
+        if not self.expired:
+            self.expire()
+            self.signal_timeout()
@@ -1,44 +1,136 @@
-import re
 import transports
 import static
 
 from errors import *
+from session import ReplayBuffer
 
 # Route Tables
 # ============
 
-class RegexRouter(object):
+class Dispatcher(object):
     """
-    A hybrid hash table, regex matching table.
-
-    Tries to do O(1) hash lookup falls back on
-    worst case O(n) regex matching.
+    Resolves request paths to the kind of url they are and its
+    tokens. The path is split once and classified by the number of
+    segments, the route and transport are then looked up in the
+    router's dicts, so the cost doesn't depend on the number of
+    routes mounted.
+
+    Url forms:
+
+        /<route>[/[<suffix>]]                       static page
+        /<route>/websocket                          raw websocket
+        /<route>/<server>/<session>/<transport>     dynamic
+
+    Server id, session id and transport can't contain a ``.``.
+
+    Recently resolved paths are cached, a session polls the same
+    path over and over. The cache is an approximate LRU of up to
+    ``cache_size`` paths in two generations of plain dicts: paths
+    are resolved into the recent one, a hit in the older one moves
+    the path back to the recent one, and once the recent one is
+    full the older one is dropped. Every operation stays a dict
+    lookup, an ordered dict costs more than splitting the path.
     """
-    _re = []
-    _dct = {}
-
-    def __init__(self, dct):
-        for k, v in dct.iteritems():
-            try:
-                self._re.append((re.compile(k),v))
-            except:
-                pass
-            self._dct[k] = v
-
-    def __getitem__(self, k):
-        if self._dct.has_key(k):
-            return self._dct[k]
+
+    STATIC  = 'static'
+    DYNAMIC = 'dynamic'
+    RAW     = 'raw'
+
+    cache_size = 4096
+
+    def __init__(self, cache_size=None):
+        if cache_size is not None:
+            self.cache_size = cache_size
+
+        self.recent = {}
+        self.older = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, path):
+        """
+        Returns ( kind, route, server_id, session_id, transport ),
+        the tokens a kind of url doesn't have are None, or None for
+        a path which isn't a SockJS url. The suffix of a static url
+        takes the place of the transport.
+        """
+        recent = self.recent
+
+        if path in recent:
+            self.hits += 1
+            return recent[path]
+
+        if path in self.older:
+            result = self.older[path]
+            self.hits += 1
         else:
-            for r, v in self._re:
-                if r.match(k):
-                    return v
-        raise KeyError(k)
+            result = self.split(path)
+            self.misses += 1
+
+        if len(recent) >= self.cache_size // 2:
+            self.older = recent
+            self.recent = recent = {}
+
+        recent[path] = result
+        return result
+
+    def split(self, path):
+        if not path:
+            return None
+
+        parts = path.split('/')
+        count = len(parts)
+
+        if parts[0] or not parts[1]:
+            return None
+
+        route = parts[1]
+
+        if count == 2:
+            return (self.STATIC, route, None, None, None)
+
+        if count == 3:
+            suffix = parts[2]
+
+            if suffix == 'websocket':
+                return (self.RAW, route, None, None, None)
+
+            return (self.STATIC, route, None, None, suffix or None)
+
+        if count == 5:
+            server, session, transport = parts[2:]
+
+            if server and session and transport and \
+                    '.' not in server and '.' not in session and \
+                    '.' not in transport:
+                return (self.DYNAMIC, route, server, session, transport)
+
+        return None
+
+static_routes = {
+    None   : static.Greeting,
+    'info' : static.InfoHandler,
+}
+
+# The characters allowed between ``iframe`` and ``.html``
+IFRAME_CHARS = frozenset('0123456789-.abcdefghijklmnopqrstuvwxyz_')
+
+def static_route(suffix):
+    """
+    The handler of a static url suffix, a dict lookup for the fixed
+    ones, a prefix and suffix check for the ``iframe*.html`` pages.
+    """
+    try:
+        return static_routes[suffix]
+    except KeyError:
+        pass
+
+    if suffix.startswith('iframe') and suffix.endswith('.html') and \
+            len(suffix) >= 11 and IFRAME_CHARS.issuperset(suffix[6:-5]):
+        return static.IFrameHandler
 
-static_routes = RegexRouter({
-    None                       : static.Greeting,
-    'info'                     : static.InfoHandler,
-    r'iframe[0-9-.a-z_]*.html' : static.IFrameHandler,
-})
+    raise KeyError(suffix)
 
 
 dynamic_routes = {
@@ -67,6 +159,35 @@ class SockJSConnection(object):
 
     disallowed_transports = tuple()
 
+    # session.QueueLimits for the sessions of this route, None for
+    # the session backend's default.
+    queue_limits = None
+
+    # Number of unacknowledged frames polling sessions of this route
+    # keep for replay, 0 disables sequence numbered frames.
+    replay_window = 0
+
+    # session.Batching of the frames sent to this route's sessions,
+    # or a dict of them by transport name ( Example: 'websocket' ).
+    # None sends every message as soon as it is ready.
+    batching = None
+
+    # Largest request body, in bytes, the send transports of this
+    # route accept, None for no limit.
+    max_payload = 1024 * 1024
+
+    # Bytes a streaming response carries before it is cycled, and
+    # seconds between heartbeats of an idle stream or websocket,
+    # None for the transport's defaults.
+    response_limit = None
+    heartbeat_interval = None
+
+    # The sockjs client script loaded by this route's iframe page
+    sockjs_url = 'http://cdn.sockjs.org/sockjs-0.3.min.js'
+
+    # The server's channels.ChannelRegistry, set by the router
+    channels = None
+
     def __init__(self, session):
         self.session = session
 
@@ -98,8 +219,18 @@ class SockJSConnection(object):
         else:
             raise Exception("Tried to send message over closed session")
 
+    def subscribe(self, channel):
+        self.channels.subscribe(channel, self.session)
+
+    def unsubscribe(self, channel):
+        self.channels.unsubscribe(channel, self.session)
+
     def broadcast(self, channel, message):
-        raise NotImplementedError()
+        """
+        Send a message to every session subscribed to the channel,
+        the message is only encoded once.
+        """
+        return self.channels.broadcast(channel, message)
 
     def close(self):
         if self.session:
@@ -109,15 +240,25 @@ class SockJSConnection(object):
 
 class SockJSRouter(object):
 
-    routes = {}
-
-    def __init__(self, applications):
+    def __init__(self, applications, app=None):
         """
         Set up the routing table for the specific routes attached
         to this server.
+
+        ``app`` is the WSGI application requests outside of the
+        routes are passed on to.
         """
-        for route, connection in applications.iteritems():
-            self.routes[route] = connection
+        self.routes = dict(applications)
+
+        self.dispatcher = Dispatcher()
+        self.app = app
+
+    def serves(self, url):
+        """
+        Whether a url resolved by the Dispatcher is under one of the
+        routes.
+        """
+        return url is not None and url[1] in self.routes
 
     def route_static(self, route, suffix):
         try:
@@ -126,16 +267,17 @@ class SockJSRouter(object):
             raise Http404('No such route')
 
         try:
-            handle_cls = static_routes[suffix]
+            handle_cls = static_route(suffix)
         except KeyError:
             raise Http404('No such static page ' + str(suffix))
 
         return handle_cls(route_handle)
 
-    def route_dynamic(self, route, session_uid, server, transport):
+    def route_dynamic(self, server, route, session_uid, server_id, transport):
         """
         Return the downlink transport to the client resulting
-        from request.
+        from request, with its session from the SockJSServer
+        ``server``.
         """
 
         try:
@@ -155,24 +297,72 @@ class SockJSRouter(object):
         else:
             raise Exception('Could not determine direction')
 
-        session = self.server.get_session(session_uid, \
-            create_if_null)
+        session = server.get_session(session_uid, create_if_null)
 
         if not session:
             raise Http404()
 
+        if conn_cls.queue_limits is not None:
+            session.limits = conn_cls.queue_limits
+
+        if conn_cls.replay_window and session.replay is None:
+            session.replay = ReplayBuffer(conn_cls.replay_window)
+
         # Initialize the transport and call, any side-effectful
         # code is the __init__ method, the communication is
         # invoked by __call__ method.
 
         conn = conn_cls(session)
+        conn.channels = server.channels
         downlink = transport_cls(session, conn)
 
-        if session.is_new:
+        batching = conn.batching
+        if isinstance(batching, dict):
+            batching = batching.get(transport)
+        downlink.batching = batching
+        downlink.heartbeats = server.heartbeats
+        downlink.gauge = server.transport_greenlets
+        downlink.parking = server.parking
+
+        if conn.response_limit is not None:
+            downlink.response_limit = conn.response_limit
+        if conn.heartbeat_interval is not None:
+            downlink.heartbeat_interval = conn.heartbeat_interval
+
+        if session.is_new():
             conn.on_open(session)
-            session.timeout.rawlink(lambda g: conn.on_close())
+            session.link_timeout(lambda s: conn.on_close())
 
         return downlink
 
     def __call__(self, environ, start_response):
-        raise NotImplemented()
+        """
+        WSGI middleware, for a router mounted inside another
+        application. The routes are resolved against PATH_INFO and
+        served inline, anything else is passed on to ``app``.
+
+        The transports write to the connection themselves, streams
+        and websockets included, so the server has to be a
+        SockJSServer, whose handler puts itself in the environ.
+        """
+        url = self.dispatcher.resolve(environ.get('PATH_INFO', ''))
+
+        if not self.serves(url):
+            if self.app is None:
+                start_response('404 NOT FOUND',
+                    [('Content-Type', 'text/plain; charset=UTF-8')])
+                return ['404 Error: Page not found']
+
+            return self.app(environ, start_response)
+
+        handler = environ.get('sockjs.handler')
+
+        if handler is None:
+            start_response('500 INTERNAL SERVER ERROR',
+                [('Content-Type', 'text/plain; charset=UTF-8')])
+            return ['SockJS routes are only served by a SockJSServer']
+
+        handler.dispatch(self, url)
+
+        # The response has been written
+        return []
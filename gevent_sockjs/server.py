@@ -1,6 +1,14 @@
 import session
-from handler import SockJSHandler
+from handler import SockJSHandler, KeepAlive
 from sessionpool import SessionPool
+from channels import ChannelRegistry
+from heartbeat import HeartbeatScheduler
+from parking import ParkingLot
+from transports import GreenletGauge
+from compression import CompressionStats
+from headers import HeaderCache
+from router import SockJSRouter
+from accesslog import AccessLog
 
 from gevent.pywsgi import WSGIServer
 
@@ -18,8 +26,23 @@ class SockJSServer(WSGIServer):
 
         Options:
             listener    : ( address, port )
-            application : The SockJS router instance
+            application : The SockJS router instance, or a WSGI
+                          application the router is mounted in
             trace       : Show stack traces on 500 status code
+            session_backend : Session class, MemorySession by default
+            session_store   : Storage shared by the sessions of an
+                              external backend, see redisstore
+            queue_budget    : Bytes all sessions may hold in their
+                              outgoing queues, unbounded by default
+            http_compression  : compression.HTTPCompression for the
+                                polling and streaming responses
+            websocket_deflate : compression.PerMessageDeflate offered
+                                to websocket clients
+            max_idle_connections : Keep-alive connections left idle
+                                   at once, unbounded by default
+            access_log  : accesslog.AccessLog the requests are logged
+                          to, written to the server's log by default.
+                          False writes a line per request instead
 
         Example::
             sockjs = SockJSServer(('',8081), router)
@@ -27,13 +50,45 @@ class SockJSServer(WSGIServer):
 
         """
         self.trace = kwargs.pop('trace', False)
+        self.session_backend = kwargs.pop('session_backend', self.session_backend)
+        self.session_store = kwargs.pop('session_store', None)
+        queue_budget = kwargs.pop('queue_budget', None)
+        self.http_compression = kwargs.pop('http_compression', None)
+        self.websocket_deflate = kwargs.pop('websocket_deflate', None)
+        self.compression_stats = CompressionStats()
+        self.keepalive = KeepAlive(kwargs.pop('max_idle_connections', None))
+        self.transport_greenlets = GreenletGauge()
+        self.header_cache = HeaderCache()
+        access_log = kwargs.pop('access_log', None)
 
         super(SockJSServer, self).__init__(*args, **kwargs)
-        self.session_pool = SessionPool()
+
+        if access_log is False:
+            self.access_log = None
+        else:
+            self.access_log = access_log or AccessLog()
+
+            if self.access_log.output is None:
+                self.access_log.output = self.log
+            self.access_log.start()
+
+        self.session_pool = SessionPool(max_bytes=queue_budget)
         self.session_pool.start_gc()
 
-        # hack to get the server inside the router
-        self.application.server = self
+        self.channels = ChannelRegistry()
+
+        self.heartbeats = HeartbeatScheduler()
+        self.heartbeats.start()
+
+        self.parking = ParkingLot()
+        self.parking.start()
+
+        # The router, when it is the application itself, is served
+        # directly by the handler.
+        if isinstance(self.application, SockJSRouter):
+            self.router = self.application
+        else:
+            self.router = None
 
     def del_session(self, uid):
         del self.sessions[uid]
@@ -54,6 +109,7 @@ class SockJSServer(WSGIServer):
             self.session_pool.add(session)
         elif session:
             session.incr_hits()
+            session.refresh()
 
         return session
 
@@ -62,5 +118,12 @@ class SockJSServer(WSGIServer):
         Shutdown the server, block to inform the sessions that
         they are closing.
         """
-        self.session_pool.shudown()
-        super(SockJSServer, self).kill()
+        self.session_pool.shutdown()
+        self.heartbeats.stop()
+        self.parking.stop()
+
+        if self.access_log is not None:
+            self.access_log.stop()
+
+        # BaseServer.kill is gone since gevent 1.0
+        self.stop()
@@ -1,9 +1,128 @@
+import time
 import uuid
+from collections import deque
 
+import gevent
 from gevent.queue import Queue, Empty
 from gevent.event import Event
 
-from datetime import datetime, timedelta
+from datetime import timedelta
+
+import protocol
+
+class QueueLimits(object):
+    """
+    Bounds on a session's outgoing message queue and what to do
+    when a new message doesn't fit.
+
+    Overflow policies:
+
+        drop_oldest : Discard queued messages, oldest first, to make room
+        drop_newest : Discard the new message
+        block       : Block the sender until there is room, up to
+                      ``block_timeout`` seconds, then discard the
+                      new message
+        close       : Discard the queue and close the session with a
+                      close frame
+
+    Every discarded message is counted on the session and on the
+    pool's MemoryBudget.
+    """
+
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    BLOCK = 'block'
+    CLOSE = 'close'
+
+    def __init__(self, max_messages=None, max_bytes=None,
+            overflow=DROP_OLDEST, block_timeout=1.0):
+        assert overflow in (self.DROP_OLDEST, self.DROP_NEWEST,
+            self.BLOCK, self.CLOSE)
+
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+
+class Batching(object):
+    """
+    Send side coalescing of outgoing messages. Once a message is
+    ready to go, the frame is held up to ``window`` seconds, or
+    until ``max_bytes`` worth of messages are ready, and everything
+    queued meanwhile goes out as a single array frame.
+    """
+
+    def __init__(self, window=0.005, max_bytes=None):
+        self.window = window
+        self.max_bytes = max_bytes
+
+# Queued to wake a reader without handing it a message
+WAKEUP = object()
+
+# Sent when a session is closed by the ``close`` overflow policy
+OVERFLOW_CLOSE = (3001, "Outgoing queue full")
+
+# Sent when a client acknowledges a frame older than the replay
+# buffer still holds.
+REPLAY_CLOSE = (3002, "Replay window exceeded")
+
+class ReplayBuffer(object):
+    """
+    Ring buffer of the frames sent to a polling session, kept with
+    their sequence numbers until the client acknowledges them, so a
+    poll lost on the network can be resent.
+
+    Frames are the encoded JSON arrays handed to the transport.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.frames = deque()
+
+        # Sequence number of the last frame pushed
+        self.seq = 0
+
+    def push(self, payload):
+        self.seq += 1
+        self.frames.append((self.seq, payload))
+
+        if len(self.frames) > self.size:
+            self.frames.popleft()
+
+        return self.seq
+
+    def ack(self, seq):
+        """
+        Release every frame up to ``seq``. Returns False if frames
+        after it have already been evicted.
+        """
+        frames = self.frames
+
+        while frames and frames[0][0] <= seq:
+            frames.popleft()
+
+        if frames:
+            return seq >= frames[0][0] - 1
+        return True
+
+    def pending(self):
+        """
+        The unacknowledged frames merged into one array, with the
+        sequence number of the last one.
+        """
+        if len(self.frames) == 1:
+            return self.frames[0]
+
+        items = [payload[1:-1] for seq, payload in self.frames]
+        return self.seq, '[' + ','.join(items) + ']'
+
+def message_size(message):
+    """
+    Approximate size of a message on the wire, in bytes.
+    """
+    if isinstance(message, basestring):
+        return len(message)
+    return len(protocol.encode(message))
 
 class Session(object):
     """
@@ -12,16 +131,52 @@ class Session(object):
 
     Subclasses are expected to overload the add_message and
     get_messages to reflect their storage system.
+
+    Sessions are slotted and only allocate their events when
+    something actually waits on them, most sessions in a busy
+    server are idle.
     """
 
+    __slots__ = (
+        'session_id',
+        'expires_at',
+        'expired',
+        'forever',
+        'killed',
+        'interrupted',
+        'network_error',
+        'hits',
+        'heartbeats',
+        'pool',
+        'wheel_slot',
+        'limits',
+        'dropped',
+        'close_reason',
+        'replay',
+        '_locked',
+        '_timeout',
+        '_timeout_links',
+    )
+
+    # Whether wake can interrupt a blocked get_messages, backends
+    # which can't are read with a timeout instead.
+    wakeable = False
+
     # Session's timeout after 5 seconds
     expires = timedelta(seconds=5)
 
+    # Unbounded unless the route sets its own limits
+    default_limits = QueueLimits()
+
     def __init__(self, server, session_id=None):
-        self.expires_at = datetime.now() + self.expires
+        self.expires_at = time.time() + self.expires.total_seconds()
         self.expired = False
         self.forever = False
-        self.session_id = self.generate_uid()
+        self.killed = False
+        self.session_id = session_id or self.generate_uid()
+
+        self.hits = 0
+        self.heartbeats = 0
 
         # Whether this was closed explictly by client vs
         # internally by garbage collection.
@@ -33,9 +188,29 @@ class Session(object):
         # may have been lost, there is not much we can do about it.
         self.network_error = False
 
-        # Async event, use rawlink to string callbacks
-        self.timeout = Event()
-        self.locked = Event()
+        self._locked = False
+
+        # Bounds on the outgoing queue, and the number of messages
+        # discarded because of them.
+        self.limits = self.default_limits
+        self.dropped = 0
+
+        # ( code, reason ) of the close frame sent once the session
+        # has expired.
+        self.close_reason = None
+
+        # ReplayBuffer of a polling session, if its route opted in
+        self.replay = None
+
+        # Async timeout event and its callbacks, both created on
+        # first use.
+        self._timeout = None
+        self._timeout_links = None
+
+        # The SessionPool shard this session is indexed in, and its
+        # bucket in the shard's expiry wheel.
+        self.pool = None
+        self.wheel_slot = None
 
     def generate_uid(self):
         """
@@ -43,6 +218,40 @@ class Session(object):
         """
         return str(uuid.uuid4())
 
+    @property
+    def timeout(self):
+        """
+        Event set when the session times out, use rawlink to string
+        callbacks. Prefer link_timeout which doesn't allocate the
+        event.
+        """
+        if self._timeout is None:
+            self._timeout = Event()
+        return self._timeout
+
+    def link_timeout(self, callback):
+        """
+        Register ``callback(session)`` to be run from the hub once
+        the session times out.
+        """
+        if self._timeout_links is None:
+            self._timeout_links = []
+        self._timeout_links.append(callback)
+
+    def signal_timeout(self):
+        """
+        Set the timeout event and run the linked callbacks.
+        """
+        if self._timeout is not None:
+            self._timeout.set()
+
+        links, self._timeout_links = self._timeout_links, None
+
+        if links:
+            loop = gevent.get_hub().loop
+            for callback in links:
+                loop.run_callback(callback, self)
+
     def persist(self, extension=None, forever=False):
         """
         Bump the time to live of the session by a given amount,
@@ -52,16 +261,26 @@ class Session(object):
 
         if forever:
             self.forever = True
-            return
-
-        # Slide the expirtaion time one more expiration interval
-        # into the future
-        if extension is None:
-            self.expires_at = datetime.now() + self.expires
         else:
-            self.expires_at = datetime.now() + extension
+            # Slide the expirtaion time one more expiration interval
+            # into the future
+            if extension is None:
+                extension = self.expires
 
-        self.forever = False
+            self.expires_at = time.time() + extension.total_seconds()
+            self.forever = False
+
+        if self.pool is not None:
+            self.pool.touch(self)
+
+    def refresh(self):
+        """
+        Slide the expiration time of a live session, called each
+        time a request uses it. Leaves expired sessions expired and
+        forever sessions forever.
+        """
+        if not self.expired and not self.forever:
+            self.persist()
 
     def post_delete(self):
         pass
@@ -77,6 +296,12 @@ class Session(object):
         self.expired = True
         self.forever = False
 
+        if self.pool is not None:
+            self.pool.touch(self)
+
+        # Nothing more will be sent, let the writers see it
+        self.wake()
+
     def incr_hits(self):
         self.hits += 1
 
@@ -91,11 +316,51 @@ class Session(object):
     def add_message(self, msg):
         raise NotImplemented()
 
+    def wake(self):
+        """
+        Make every blocked get_messages return, with no messages if
+        none were queued, and every sender blocked on a full queue
+        look again. Returns whether anything was waiting.
+        """
+        return False
+
     def get_messages(self, **kwargs):
         raise NotImplemented()
 
+    def get_batch(self, batching, **kwargs):
+        """
+        Wait for messages like get_messages, then keep collecting
+        them for the window of ``batching`` if there is one.
+        """
+        messages = self.get_messages(**kwargs)
+
+        if not messages or batching is None or not batching.window:
+            return messages
+
+        deadline = time.time() + batching.window
+        limit = batching.max_bytes
+
+        if limit is not None:
+            size = sum(message_size(msg) for msg in messages)
+
+        while limit is None or size < limit:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            more = self.get_messages(timeout=remaining)
+            if not more:
+                break
+
+            messages.extend(more)
+
+            if limit is not None:
+                size += sum(message_size(msg) for msg in more)
+
+        return messages
+
     def is_locked(self):
-        return self.locked.is_set()
+        return self._locked
 
     def is_network_error(self):
         return self.network_error
@@ -106,11 +371,14 @@ class Session(object):
     def is_interrupted(self):
         return self.interrupted
 
+    def get_close_reason(self):
+        return self.close_reason or (3000, "Go away!")
+
     def lock(self):
-        self.locked.set()
+        self._locked = True
 
     def unlock(self):
-        self.locked.clear()
+        self._locked = False
 
     def __str__(self):
         pass
@@ -119,39 +387,227 @@ class MemorySession(Session):
     """
     In memory session with a outgoing gevent Queue as the message
     store.
+
+    The queue is bounded by the session's QueueLimits and by the
+    MemoryBudget of the pool it belongs to.
     """
 
+    __slots__ = (
+        'server',
+        'connected',
+        'queued_bytes',
+        'listener',
+        '_queue',
+        '_room',
+    )
+
     timer = 10.0
 
+    wakeable = True
+
     def __init__(self, server, session_id=None):
         super(MemorySession, self).__init__(server, session_id)
-        self.session_id = session_id or str(uuid.uuid4())[:8]
         self.server = server
+        self.connected = False
 
-        self.queue = Queue()
+        # Messages are queued as ( message, size ) pairs, sizes are
+        # only computed when some byte limit is set.
+        self.queued_bytes = 0
+        self._queue = None
 
-        self.hits = 0
-        self.heartbeats = 0
-        self.connected = False
+        # Set when messages are taken off the queue, created for
+        # senders blocked by the ``block`` overflow policy.
+        self._room = None
+
+        # Called whenever a message is queued or the session is
+        # woken, lets a transport write without a reader blocked
+        # on the queue.
+        self.listener = None
+
+    def generate_uid(self):
+        return str(uuid.uuid4())[:8]
+
+    @property
+    def queue(self):
+        if self._queue is None:
+            self._queue = Queue()
+        return self._queue
+
+    def queued(self):
+        if self._queue is None:
+            return 0
+        return self._queue.qsize()
+
+    @property
+    def budget(self):
+        if self.pool is not None:
+            return self.pool.budget
+
+    def has_room(self, size, budget):
+        limits = self.limits
+
+        if limits.max_messages is not None:
+            if self.queued() >= limits.max_messages:
+                return False
+
+        if limits.max_bytes is not None:
+            if self.queued_bytes + size > limits.max_bytes:
+                return False
+
+        if budget is not None and not budget.fits(size):
+            return False
+
+        return True
 
     def add_message(self, msg):
-        self.queue.put_nowait(msg)
+        budget = self.budget
+
+        if self.limits.max_bytes is not None or \
+                (budget is not None and budget.max_bytes is not None):
+            size = message_size(msg)
+        else:
+            size = 0
+
+        if not self.has_room(size, budget):
+            if not self.overflow(size, budget):
+                self.drop(1, budget)
+                return
+
+        self.queue.put_nowait((msg, size))
+
+        if size:
+            self.queued_bytes += size
+            if budget is not None:
+                budget.used += size
+
+        if self.listener is not None:
+            self.listener()
+
+    def wake(self):
+        woken = False
+
+        if self._room is not None:
+            self._room.set()
+
+        if self._queue is not None:
+            # One marker for each reader
+            for i in xrange(len(self._queue.getters)):
+                self._queue.put_nowait((WAKEUP, 0))
+                woken = True
+
+        if self.listener is not None:
+            self.listener()
+            woken = True
+
+        return woken
+
+    def could_fit(self, size, budget):
+        """
+        Whether a message of ``size`` bytes would fit once the whole
+        queue is taken off.
+        """
+        if self.limits.max_bytes is not None and size > self.limits.max_bytes:
+            return False
+
+        if budget is not None and budget.max_bytes is not None:
+            if budget.used - self.queued_bytes + size > budget.max_bytes:
+                return False
+
+        return True
+
+    def overflow(self, size, budget):
+        """
+        Apply the overflow policy for a message of ``size`` bytes
+        which doesn't fit, return whether it can now be queued.
+        """
+        policy = self.limits.overflow
+
+        # Nothing to make room for, it wouldn't fit in an empty queue
+        if policy != QueueLimits.CLOSE and not self.could_fit(size, budget):
+            return False
+
+        if policy == QueueLimits.DROP_OLDEST:
+            while self.queued() and not self.has_room(size, budget):
+                msg, oldest = self._queue.get_nowait()
+                if msg is not WAKEUP:
+                    self.release(oldest, budget)
+                    self.drop(1, budget)
+
+        elif policy == QueueLimits.BLOCK:
+            timeout = gevent.Timeout(self.limits.block_timeout)
+            timeout.start()
+
+            try:
+                while not self.expired and not self.has_room(size, budget):
+                    if self._room is None:
+                        self._room = Event()
+
+                    self._room.clear()
+                    self._room.wait()
+            except gevent.Timeout as t:
+                if t is not timeout:
+                    raise
+            finally:
+                timeout.cancel()
+
+        elif policy == QueueLimits.CLOSE:
+            self.close_reason = OVERFLOW_CLOSE
+
+            # Free the queue straight away, it won't be read
+            while self.queued():
+                msg, queued = self._queue.get_nowait()
+                if msg is not WAKEUP:
+                    self.release(queued, budget)
+                    self.drop(1, budget)
+
+            self.kill()
+            return False
+
+        return self.has_room(size, budget)
+
+    def release(self, size, budget):
+        if size:
+            self.queued_bytes -= size
+            if budget is not None:
+                budget.used -= size
+
+    def drop(self, count, budget):
+        self.dropped += count
+        if budget is not None:
+            budget.dropped += count
 
     def get_messages(self, **kwargs):
         self.incr_hits()
 
-        if self.queue.empty():
+        queue = self.queue
+        accum = []
+
+        if queue.empty():
             try:
-                return self.queue.get(**kwargs)
+                accum.append(queue.get(**kwargs))
             except Empty:
                 return []
         else:
-            accum = []
-            try:
-                while not self.queue.empty():
-                    accum.append(self.queue.get_nowait())
-            finally:
-                return accum
+            accum.append(queue.get_nowait())
+
+        # Stop short of the next wake up marker, it is another
+        # reader's.
+        while not queue.empty() and queue.peek_nowait()[0] is not WAKEUP:
+            accum.append(queue.get_nowait())
+
+        budget = self.budget
+        messages = []
+
+        for msg, size in accum:
+            if msg is WAKEUP:
+                continue
+            self.release(size, budget)
+            messages.append(msg)
+
+        if self._room is not None:
+            self._room.set()
+
+        return messages
 
     def interrupt(self):
         """
@@ -167,5 +623,5 @@ class MemorySession(Session):
 
         # Expire only once
         if not self.expired:
-            self.expired = True
-            self.timeout.set()
+            self.expire()
+            self.signal_timeout()
@@ -1,24 +1,349 @@
-import uuid
+import time
 import gevent
 
-from heapq import heappush, heappop
-from datetime import datetime
+from math import ceil
+from collections import deque
+
+class TimingWheel(object):
+    """
+    A hierarchical timing wheel used as the session expiry index.
+
+    Level 0 has ``slots`` buckets each ``resolution`` seconds wide,
+    every level above it is ``slots`` times coarser. Items are kept
+    in plain sets and remember the set they live in, so scheduling,
+    rescheduling and removal are all O(1) regardless of how many
+    items are in the wheel.
+
+    Advancing the wheel only visits the buckets whose time has come;
+    an item in a coarser level is cascaded down once when its bucket
+    is reached, then handed back on the tick it actually expires.
+    Items count as scheduled until they are popped off an expired
+    bucket, so they can still be rescheduled or removed in between.
+
+    Items are expected to carry an ``expires_at`` timestamp ( in
+    seconds since the epoch ) and a ``wheel_slot`` attribute which
+    the wheel uses for bookkeeping.
+    """
+
+    def __init__(self, resolution=1.0, slots=64, levels=4, now=None):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+
+        # Width of a bucket, in ticks, at each level
+        self.spans = [slots ** level for level in xrange(levels + 1)]
+
+        self.wheels = [
+            [set() for i in xrange(slots)] for level in xrange(levels)
+        ]
+
+        # Items whose deadline is already behind the wheel and items
+        # too far in the future for the top level.
+        self.due = set()
+        self.overflow = set()
+
+        # Buckets detached by advance, waiting to be popped
+        self.expired = deque()
+
+        # The last tick that has been fully processed
+        self.tick = self.to_tick(time.time() if now is None else now)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def to_tick(self, timestamp):
+        return int(timestamp / self.resolution)
+
+    def _place(self, item, deadline):
+        """
+        Drop an item into the bucket responsible for its deadline
+        tick, relative to the current position of the wheel.
+        """
+        delta = deadline - self.tick
+
+        if delta <= 0:
+            slot = self.due
+        elif delta <= self.slots:
+            slot = self.wheels[0][deadline % self.slots]
+        else:
+            slot = self.overflow
+
+            for level in xrange(1, self.levels):
+                span = self.spans[level]
+                block = deadline // span
+
+                # The bucket is cascaded at the start of its block,
+                # which must be reached within one revolution of
+                # this level.
+                if block * span - self.tick <= self.spans[level + 1]:
+                    slot = self.wheels[level][block % self.slots]
+                    break
+
+        slot.add(item)
+        item.wheel_slot = slot
+
+    def schedule(self, item):
+        """
+        Insert an item, or move it if it is already scheduled, into
+        the bucket of its ``expires_at`` timestamp.
+        """
+        if item.wheel_slot is None:
+            self.count += 1
+        else:
+            item.wheel_slot.discard(item)
+
+        deadline = int(ceil(item.expires_at / self.resolution))
+        self._place(item, deadline)
+
+    def expire(self, item):
+        """
+        Flag an item to be handed back on the very next advance.
+        """
+        if item.wheel_slot is None:
+            self.count += 1
+        else:
+            item.wheel_slot.discard(item)
+
+        self.due.add(item)
+        item.wheel_slot = self.due
+
+    def remove(self, item):
+        if item.wheel_slot is not None:
+            item.wheel_slot.discard(item)
+            item.wheel_slot = None
+            self.count -= 1
+
+    def _cascade(self, slot):
+        items = list(slot)
+        slot.clear()
+
+        for item in items:
+            self._place(item, int(ceil(item.expires_at / self.resolution)))
+
+    def advance(self, now=None):
+        """
+        Move the wheel forward to ``now``. The buckets whose deadline
+        has passed are detached as they are, their items are then
+        handed out one at a time by pop_expired, so advancing costs
+        the same however many items expire at once.
+        """
+        target = self.to_tick(time.time() if now is None else now)
+
+        if self.due:
+            self.expired.append(self.due)
+            self.due = set()
+
+        # Nothing in the wheel, jump straight to the target tick
+        if self.count == 0:
+            self.tick = max(self.tick, target)
+
+        while self.tick < target:
+            tick = self.tick + 1
+
+            # Cascade the coarser levels whose bucket begins at this
+            # tick, highest level first so items can fall through
+            # more than one level.
+            if tick % self.spans[self.levels] == 0 and self.overflow:
+                self._cascade(self.overflow)
+
+            for level in xrange(self.levels - 1, 0, -1):
+                span = self.spans[level]
+
+                if tick % span == 0:
+                    slot = self.wheels[level][(tick // span) % self.slots]
+                    if slot:
+                        self._cascade(slot)
+
+            index = tick % self.slots
+            slot = self.wheels[0][index]
+
+            if slot:
+                self.expired.append(slot)
+                self.wheels[0][index] = set()
+
+            self.tick = tick
+
+    def pop_expired(self):
+        """
+        Return an item whose deadline has passed, or None. Returned
+        items are no longer scheduled.
+        """
+        expired = self.expired
+
+        while expired:
+            slot = expired[0]
+
+            if slot:
+                item = slot.pop()
+                item.wheel_slot = None
+                self.count -= 1
+                return item
+
+            expired.popleft()
+
+        return None
+
+    def clear(self):
+        for item in self.items():
+            item.wheel_slot = None
+
+        for wheel in self.wheels:
+            for slot in wheel:
+                slot.clear()
+
+        self.due.clear()
+        self.overflow.clear()
+        self.expired.clear()
+        self.count = 0
+
+    def items(self):
+        accum = list(self.due) + list(self.overflow)
+        for slot in self.expired:
+            accum.extend(slot)
+        for wheel in self.wheels:
+            for slot in wheel:
+                accum.extend(slot)
+        return accum
+
+class MemoryBudget(object):
+    """
+    Bytes queued for delivery across every session of a pool, and
+    the number of messages dropped by the sessions' queue limits.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.dropped = 0
+
+    def fits(self, size):
+        return self.max_bytes is None or self.used + size <= self.max_bytes
+
+class SessionShard(object):
+    """
+    One partition of a SessionPool: a dict of sessions and their
+    expiry wheel. Sessions hold a reference to their shard so they
+    can reindex themselves without going through the pool.
+
+    Sessions persisted forever are kept out of the wheel, in their
+    own set, so shutdown still finds them.
+    """
+
+    def __init__(self, resolution, budget):
+        self.sessions = dict()
+        self.wheel = TimingWheel(resolution=resolution)
+        self.forever = set()
+        self.budget = budget
+
+    def add(self, session):
+        session.pool = self
+        self.sessions[session.session_id] = session
+        self.touch(session)
+
+    def touch(self, session):
+        """
+        Reindex a session after its expiration time or state has
+        changed, called by the session itself.
+        """
+        if session.forever and not session.expired:
+            self.wheel.remove(session)
+            self.forever.add(session)
+            return
+
+        self.forever.discard(session)
+
+        if session.expired:
+            self.wheel.expire(session)
+        else:
+            self.wheel.schedule(session)
+
+    def remove(self, session_id):
+        session = self.sessions.get(session_id, None)
+
+        if session:
+            self.wheel.remove(session)
+            self.forever.discard(session)
+            self.delete(session)
+
+    def delete(self, session):
+        """
+        Drop a session out of the shard. As kill does, its readers
+        are woken and its timeout callbacks run ( which unsubscribe
+        it from its channels ), out of the pool so it isn't
+        reindexed.
+        """
+        del self.sessions[session.session_id]
+
+        session.pool = None
+        session.expire()
+        session.signal_timeout()
+        session.post_delete()
+
+    def collect(self, session, now):
+        # A connection is still open on it, its time starts again
+        # once the connection lets go
+        if session.is_locked() and not session.expired:
+            session.persist()
+            return
+
+        # Session is to be GC'd immedietely
+        if session.expired or session.expires_at <= now:
+            if self.sessions.get(session.session_id) is session:
+                self.delete(session)
+        else:
+            self.touch(session)
 
 class SessionPool(object):
     """
     A garbage collected Session Pool.
 
+    ``max_bytes`` bounds the memory held by the outgoing queues of
+    all sessions in the pool together.
+
+    Sessions are partitioned over a number of shards by session id,
+    each with its own expiry wheel. Garbage collection is
+    incremental: expired sessions are deleted in slices bounded by
+    ``gc_batch`` sessions and ``gc_budget`` seconds, and the
+    collector yields to the hub between slices so a mass expiry
+    doesn't stall I/O.
+
     See: https://github.com/sdiehl/greengoop
     """
     gc_cycle = 10.0
 
-    def __init__(self):
-        self.sessions = dict()
-        self.pool = []
+    # Granularity of session expiry, in seconds
+    gc_resolution = 1.0
+
+    # Upper bound on the work done by one slice of a collection,
+    # in sessions and in seconds.
+    gc_batch = 1000
+    gc_budget = 0.005
+
+    shard_count = 16
+
+    def __init__(self, shards=None, max_bytes=None):
+        self.budget = MemoryBudget(max_bytes)
+        self.shards = [
+            SessionShard(self.gc_resolution, self.budget)
+            for i in xrange(shards or self.shard_count)
+        ]
         self.gcthread = gevent.Greenlet(self._gc_sessions)
 
     def __str__(self):
-        return str(self.sessions.items())
+        return str(self.items())
+
+    def __len__(self):
+        return sum(len(shard.sessions) for shard in self.shards)
+
+    def items(self):
+        accum = []
+        for shard in self.shards:
+            accum.extend(shard.sessions.items())
+        return accum
+
+    def shard(self, session_id):
+        return self.shards[hash(session_id) % len(self.shards)]
 
     def start_gc(self):
         """
@@ -39,33 +364,28 @@ class SessionPool(object):
             self.gc()
 
     def add(self, session):
-        session.cycle = None
-        self.sessions[session.session_id] = session
-
-        if not session.expired:
-            heappush(self.pool, session)
+        self.shard(session.session_id).add(session)
 
     def get(self, session_id):
         """
         Get active sessions by their session id.
         """
-        return self.sessions.get(session_id, None)
+        return self.shard(session_id).sessions.get(session_id, None)
 
     def remove(self, session_id):
-        session = self.sessions.get(session_id, None)
-
-        if session:
-            session.post_delete()
-            del self.sessions[session_id]
+        self.shard(session_id).remove(session_id)
 
     def shutdown(self):
         """
         Manually expire all sessions in the pool.
         """
-        while self.pool:
-            head = heappop(self.pool)
-            head.expired = True
-            head.timeout.set()
+        for shard in self.shards:
+            for session in shard.wheel.items() + list(shard.forever):
+                session.expired = True
+                session.signal_timeout()
+
+            shard.wheel.clear()
+            shard.forever.clear()
 
     def __del__(self):
         """
@@ -74,39 +394,46 @@ class SessionPool(object):
         """
         self.shutdown()
 
-    def gc(self):
+    def gc(self, now=None):
         """
-        Rearrange the heap flagging active sessions with the id
-        of this collection iteration. This data-structure is
-        time-independent so we sessions can be added to and from
-        without the need to lock the pool.
+        Run a full collection, yielding to the hub between slices.
         """
+        for _ in self.gc_slices(now):
+            gevent.sleep(0)
 
-        if len(self.pool) == 0:
-            return
+    def gc_slices(self, now=None):
+        """
+        Advance the expiry wheels to the current time and delete the
+        sessions which fell out of them. Sessions can be added,
+        persisted and expired in between slices without the need to
+        lock the pool.
+
+        This is a generator, each iteration is one slice of the
+        collection. The caller decides how to yield between them.
+        """
+        if now is None:
+            now = time.time()
 
-        current_time = datetime.now()
+        for shard in self.shards:
+            wheel = shard.wheel
+            wheel.advance(now)
 
-        while self.pool:
-            head = self.pool[0]
+            while wheel.expired:
+                deadline = time.time() + self.gc_budget
+                collected = 0
 
-            # Every session is fresh
-            if head.cycle == current_time or head.expires_at > current_time:
-                break
+                for i in xrange(self.gc_batch):
+                    session = wheel.pop_expired()
 
-            head = heappop(self.pool)
+                    if session is None:
+                        break
 
-            # Flag the session with the id of this GC cycle
-            head.cycle = current_time
+                    shard.collect(session, now)
+                    collected += 1
 
-            # Session is to be GC'd immedietely
-            if head.expired:
-                del self.sessions[head.session_id]
-                head.post_delete()
-                continue
+                    if time.time() > deadline:
+                        break
 
-            if not head.forever and head.expires_at < current_time:
-                del self.sessions[head.session_id]
-                head.post_delete()
-            else:
-                heappush(self.pool, head)
+                # The last buckets may turn out empty, no slice then
+                if collected:
+                    yield shard
@@ -1,4 +1,8 @@
+import time
 import random
+import hashlib
+
+from email.utils import formatdate
 
 import protocol
 from errors import *
@@ -35,32 +39,92 @@ class InfoHandler():
         elif request_method == 'OPTIONS':
             handler.write_options(['OPTIONS','GET'])
 
+class IFramePage(object):
+    """
+    The iframe page of a route, rendered once with the route's
+    sockjs_url. Its 200 and 304 responses are kept pre-built, all
+    but the status line, Date and Connection headers which depend
+    on the request and the clock. They are rebuilt every
+    ``refresh`` seconds to move their Expires date forward.
+    """
+
+    max_age = 365 * 24 * 3600
+    refresh = 3600
+
+    def __init__(self, sockjs_url):
+        self.body = protocol.IFRAME_HTML % sockjs_url
+        self.etag = '"%s"' % hashlib.md5(self.body).hexdigest()
+
+        self.built = 0
+        self.ok = None
+        self.not_modified = None
+
+    def matches(self, if_none_match):
+        """
+        Whether an If-None-Match header names our page, compared
+        weakly as RFC 7232 asks for of If-None-Match.
+        """
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == self.etag or tag == '*':
+                return True
+        return False
+
+    def responses(self):
+        now = time.time()
+
+        if now - self.built > self.refresh:
+            caching = [
+                ('Cache-Control', 'max-age=%d, public' % self.max_age),
+                ('Expires', formatdate(now + self.max_age, usegmt=True)),
+                ('access-control-max-age', str(self.max_age)),
+                ('ETag', self.etag),
+            ]
+
+            self.ok = self.render('200 OK', caching + [
+                ('Content-Type', 'text/html; charset=UTF-8'),
+                ('Content-Length', str(len(self.body))),
+            ], self.body)
+            self.not_modified = self.render('304 NOT MODIFIED', caching)
+            self.built = now
+
+        return self.ok, self.not_modified
+
+    @staticmethod
+    def render(status, headers, body=''):
+        """
+        A response as its status, its encoded headers and its body,
+        as write_raw takes them.
+        """
+        head = ''.join(['%s: %s\r\n' % header for header in headers])
+        return status, head, body
+
 class IFrameHandler():
+    # Pages by route, each route renders its own
+    pages = {}
 
     def __init__(self, route):
         self.route = route
 
-    def __call__(self, handler, request_method, raw_request_data):
+    def page(self):
+        page = self.pages.get(self.route)
 
-        if request_method != 'GET':
-            raise Http405()
+        if page is None:
+            page = self.pages[self.route] = IFramePage(self.route.sockjs_url)
 
-        cached = handler.environ.get('HTTP_IF_NONE_MATCH')
+        return page
 
-        # TODO: check this is equal to our MD5
-        if cached:
-            handler.start_response("304 NOT MODIFIED", handler.headers)
-            handler.enable_caching()
+    def __call__(self, handler, request_method, raw_request_data):
 
-            handler.result = [None]
-            handler.process_result()
-            return
+        if request_method != 'GET':
+            raise Http405()
 
-        handler.headers += [
-            ('ETag', protocol.IFRAME_MD5),
-        ]
+        page = self.page()
+        ok, not_modified = page.responses()
 
-        # TODO: actually put this in here
-        html = protocol.IFRAME_HTML % ('http',)
-        handler.enable_caching()
-        handler.write_html(html)
+        if page.matches(handler.environ.get('HTTP_IF_NONE_MATCH', '')):
+            handler.write_raw(*not_modified)
+        else:
+            handler.write_raw(*ok)
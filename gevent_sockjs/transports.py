@@ -1,3 +1,4 @@
+import re
 import socket
 import gevent
 import urllib2
@@ -6,15 +7,110 @@ from socket import error as socketerror
 
 import protocol
 from errors import *
+from session import REPLAY_CLOSE
 
-from geventwebsocket.websocket import Closed, WebSocketError
+from geventwebsocket.websocket import WebSocketError
+
+try:
+    from geventwebsocket.websocket import Closed
+except ImportError:
+    # gevent-websocket 0.3.6 receives None from a closed socket
+    class Closed(Exception):
+        pass
+
+class GreenletGauge(object):
+    """
+    Greenlets spawned by the transports, by transport class: how
+    many are alive now and how many were ever started. A live count
+    which keeps growing while the number of connections doesn't
+    points at greenlets which never exit.
+    """
+
+    def __init__(self):
+        self.live = {}
+        self.spawned = {}
+
+    def spawn(self, name, func, *args):
+        greenlet = gevent.spawn(func, *args)
+
+        self.live[name] = self.live.get(name, 0) + 1
+        self.spawned[name] = self.spawned.get(name, 0) + 1
+
+        greenlet.rawlink(lambda g: self.exited(name))
+        return greenlet
+
+    def exited(self, name):
+        self.live[name] -= 1
+
+    def total(self):
+        return sum(self.live.itervalues())
 
 class BaseTransport(object):
 
+    # session.Batching for outgoing frames, set by the router
+    batching = None
+
+    # The server's GreenletGauge, set by the router
+    gauge = None
+
+    # The server's parking.ParkingLot, set by the router
+    parking = None
+
+    # The server's heartbeat.HeartbeatScheduler, set by the router,
+    # and the seconds without a frame before a heartbeat is sent.
+    heartbeats = None
+    heartbeat_interval = 25.0
+
     def __init__(self, session, conn):
         self.session = session
         self.conn = conn
 
+        # Heartbeat of the connection while its writer runs
+        self.beat = None
+
+    def spawn(self, func, *args):
+        """
+        Start a greenlet for this transport, counted on the gauge.
+        """
+        if self.gauge is None:
+            return gevent.spawn(func, *args)
+        return self.gauge.spawn(self.__class__.__name__, func, *args)
+
+    def start_heartbeats(self):
+        """
+        File the session with the server's heartbeat scheduler.
+        Sessions it can't wake are left out, their writer waits
+        for messages with the heartbeat interval as timeout.
+        """
+        if self.heartbeats is not None and self.session.wakeable:
+            self.beat = self.heartbeats.add(self.session,
+                self.heartbeat_interval)
+
+    def stop_heartbeats(self):
+        if self.beat is not None:
+            self.heartbeats.remove(self.beat)
+            self.beat = None
+
+    def next_batch(self):
+        """
+        Wait for the next batch of outgoing messages. Returns the
+        messages and whether a heartbeat is due instead.
+        """
+        beat = self.beat
+
+        if beat is None:
+            messages = self.session.get_batch(self.batching,
+                timeout=self.heartbeat_interval)
+            return messages, not messages
+
+        messages = self.session.get_batch(self.batching)
+        due = beat.due
+
+        if messages or due:
+            beat.sent()
+
+        return messages, due and not messages
+
     def encode(self, data):
         """
         Wrapper around the protocol's frame encoding.
@@ -27,12 +123,15 @@ class BaseTransport(object):
         """
         return protocol.decode(data)
 
-    def write_frame(self, data):
+    def write_frame(self, prefix, payload):
         """
-        Write the data in a frame specifically for this
-        transport. Deals with the edge cases of formatting the
-        messages for the transports. Things like \n characters
-        and Javascript callback frames.
+        Frame the data specifically for this transport. Deals with
+        the edge cases of formatting the messages for the
+        transports. Things like \n characters and Javascript
+        callback frames.
+
+        Returns the frame as a list of buffers, written out without
+        being joined.
         """
         raise NotImplemented()
 
@@ -53,24 +152,20 @@ class BaseTransport(object):
 class XHRSend(BaseTransport):
     direction = 'send'
 
-    def __call__(self, handler, request_method, raw_request_data):
+    def __call__(self, handler, request_method, request_body):
 
         if request_method == 'OPTIONS':
             handler.write_options(['OPTIONS', 'POST'])
             return []
 
-        if raw_request_data == '':
-            handler.do500(message='Payload expected.')
-            return
-
         try:
-            messages = self.decode(raw_request_data)
+            self.receive(request_body.chunks())
         except InvalidJSON:
-            handler.do500(message='Broken JSON encoding.')
-            return
-
-        for msg in messages:
-            self.conn.on_message(msg)
+            if request_body.received == 0:
+                handler.do500(message='Payload expected.')
+            else:
+                handler.do500(message='Broken JSON encoding.')
+            return []
 
         handler.content_type = ("Content-Type", "text/plain; charset=UTF-8")
         handler.headers = [handler.content_type]
@@ -81,50 +176,57 @@ class XHRSend(BaseTransport):
 
         return []
 
-class JSONPSend(BaseTransport):
+    def receive(self, chunks):
+        """
+        Decode the messages in the body as they arrive, without
+        buffering the raw body, and pass them on to the connection
+        once the whole array is decoded. A send is all or nothing,
+        broken JSON anywhere delivers none of its messages.
+        """
+        decoder = protocol.ArrayDecoder()
+        messages = []
+
+        for chunk in chunks:
+            messages += decoder.feed(chunk)
+
+        messages += decoder.close()
+
+        for msg in messages:
+            self.conn.on_message(msg)
+
+class JSONPSend(XHRSend):
     direction = 'recv'
 
-    def __call__(self, handler, request_method, raw_request_data):
+    FORM_TYPE = 'application/x-www-form-urlencoded'
+
+    def __call__(self, handler, request_method, request_body):
 
         if request_method == 'OPTIONS':
             handler.write_options(['OPTIONS', 'POST'])
             return []
 
+        # Form posts carry the payload url encoded in the ``d``
+        # field, those are read whole, still within the route's
+        # limit. Anything else is the JSON array itself.
+        if request_body.content_type.startswith(self.FORM_TYPE):
+            qs = urlparse.parse_qs(request_body.read())
 
-        qs = urlparse.parse_qs(raw_request_data)
+            if 'd' not in qs:
+                handler.do500(message='Payload expected.')
+                return []
 
-        using_formdata = True
+            chunks = qs['d'][:1]
+        else:
+            chunks = request_body.chunks()
 
-        # Do we have a Payload?
         try:
-            if qs.has_key('d'):
-                using_formdata = True
-                payload = qs['d']
-            else:
-                using_formdata = False
-                payload = raw_request_data
-
-        # todo: more granular exception catching
-        except Exception as e:
-            handler.do500(message='Payload expected.')
-            return
-
-        # Confirm that this at least looks like a JSON array
-        if not using_formdata:
-            if not ('[' in payload and ']' in payload):
+            self.receive(chunks)
+        except InvalidJSON:
+            if request_body.received == 0:
                 handler.do500(message='Payload expected.')
-                return
-
-        try:
-            if using_formdata:
-                messages = self.decode(payload[0])
             else:
-                messages = self.decode(payload)
-        except InvalidJSON:
-            handler.do500(message='Broken JSON encoding.')
-
-        for msg in messages:
-            self.conn.on_message(msg)
+                handler.do500(message='Broken JSON encoding.')
+            return []
 
         handler.content_type = ("Content-Type", "text/plain; charset=UTF-8")
         handler.enable_cookie()
@@ -139,6 +241,9 @@ class PollingTransport(BaseTransport):
     Long polling derivative transports, used for XHRPolling and
     JSONPolling.
 
+    Polls run on the handler's greenlet, which is parked on the
+    session while there is nothing to send.
+
     Subclasses overload the write_frame method for their
     respective serialization methods.
     """
@@ -146,23 +251,89 @@ class PollingTransport(BaseTransport):
 
     TIMING = 5.0
 
+    def wait_batch(self):
+        """
+        The messages queued for the session, parking until some
+        arrive or the poll times out.
+        """
+        session = self.session
+
+        if self.parking is None or not session.wakeable:
+            return session.get_batch(self.batching, timeout=self.TIMING)
+
+        messages = session.get_batch(self.batching, block=False)
+
+        if not messages and self.parking.wait(session, self.TIMING):
+            messages = session.get_batch(self.batching, block=False)
+
+        return messages
+
     def poll(self, handler):
         """
-        Spin lock the thread until we have a message on the
-        gevent queue.
+        Answer the poll with the queued messages, once there are
+        some.
         """
-        messages = self.session.get_messages(timeout=self.TIMING)
-        messages = self.encode(messages)
+        replay = self.session.replay
+        payload = None
+
+        # Resend whatever the client hasn't acknowledged yet, along
+        # with anything queued since, without waiting.
+        if replay is not None and replay.frames:
+            messages = self.session.get_messages(block=False)
+            if messages:
+                replay.push(self.encode(messages))
+
+            seq, payload = replay.pending()
+            prefix = protocol.message_prefix(seq)
+
+        if payload is None:
+            messages = self.wait_batch()
+
+            # Woken up by the session closing
+            if not messages and self.session.is_expired():
+                self.session.unlock()
+                close_error = protocol.close_frame(*self.session.get_close_reason())
+                handler.write_text(close_error)
+                return
+
+            payload = self.encode(messages)
+
+            if replay is not None and messages:
+                prefix = protocol.message_prefix(replay.push(payload))
+            else:
+                prefix = protocol.message_prefix()
 
         self.session.unlock()
 
-        handler.start_response("200 OK", [
-            ("Access-Control-Allow-Origin", "*"),
-            ("Connection", "close"),
-            self.content_type,
-        ])
+        # Sent with a Content-Length, the connection is kept alive
+        # for the next poll.
+        handler.write_buffers(self.write_frame(prefix, payload))
+
+    def acknowledge(self, handler):
+        """
+        Release the replayed frames acknowledged by the ``ack`` query
+        parameter, a poll without one acknowledges everything sent
+        so far. Returns False if frames the client hasn't seen were
+        already evicted from the replay buffer.
+        """
+        replay = self.session.replay
+
+        if replay is None:
+            return True
+
+        qs = urlparse.parse_qs(handler.environ.get('QUERY_STRING', ''))
 
-        handler.write_text(self.write_frame(messages))
+        try:
+            seq = int(qs['ack'][0])
+        except (KeyError, ValueError):
+            seq = replay.seq
+
+        if replay.ack(seq):
+            return True
+
+        self.session.close_reason = REPLAY_CLOSE
+        self.session.kill()
+        return False
 
     def __call__(self, handler, request_method, raw_request_data):
         """
@@ -186,7 +357,7 @@ class PollingTransport(BaseTransport):
             return []
 
         elif self.session.is_expired():
-            close_error = protocol.close_frame(3000, "Go away!")
+            close_error = protocol.close_frame(*self.session.get_close_reason())
             handler.write_text(close_error)
             return []
 
@@ -195,11 +366,17 @@ class PollingTransport(BaseTransport):
             self.session.network_error = True
             handler.write_text(lock_error)
             return []
+
+        elif not self.acknowledge(handler):
+            replay_error = protocol.close_frame(*REPLAY_CLOSE)
+            handler.write_text(replay_error)
+            return []
         else:
             self.session.lock()
-            return [gevent.spawn(self.poll, handler)]
+            self.poll(handler)
+            return []
 
-    def write_frame(self, data):
+    def write_frame(self, prefix, payload):
         raise NotImplemented()
 
 # Polling Transports
@@ -214,26 +391,28 @@ class XHRPolling(PollingTransport):
     TIMING = 2
     content_type = ("Content-Type", "text/html; charset=UTF-8")
 
-    def write_frame(self, data):
-        return protocol.message_frame(data) + '\n'
+    def write_frame(self, prefix, payload):
+        return [prefix, payload, '\n']
 
 class JSONPolling(PollingTransport):
     direction = 'recv'
 
     content_type = ("Content-Type", "text/plain; charset=UTF-8")
 
-    def write_frame(self, data):
-        frame = protocol.json.dumps(protocol.message_frame(data))
-        return """%s(%s);\r\n""" % ( self.callback, frame)
+    def write_frame(self, prefix, payload):
+        # The frame is quoted as a whole, so this one is copied
+        frame = protocol.json.dumps(prefix + payload)
+        return [self.callback, '(', frame, ');\r\n']
 
     def __call__(self, handler, request_method, raw_request_data):
 
         try:
-            callback_param = handler.environ.get("QUERY_STRING").split('=')[1]
+            query = handler.environ.get("QUERY_STRING").split('&')[0]
+            callback_param = query.split('=')[1]
             self.callback = urllib2.unquote(callback_param)
         except IndexError:
             handler.do500(message='"callback" parameter required')
-            return
+            return []
 
         if request_method == 'OPTIONS':
             handler.write_options(['OPTIONS', 'POST'])
@@ -248,155 +427,396 @@ class JSONPolling(PollingTransport):
             handler.write_js(open_frame)
             return []
         elif self.session.is_expired():
-            close_error = protocol.close_frame(3000, "Go away!")
+            close_error = protocol.close_frame(*self.session.get_close_reason())
             handler.write_text(close_error)
             return []
         elif self.session.is_locked():
             lock_error = protocol.close_frame(2010, "Another connection still open")
             handler.write_text(lock_error)
             return []
+        elif not self.acknowledge(handler):
+            replay_error = protocol.close_frame(*REPLAY_CLOSE)
+            handler.write_text(replay_error)
+            return []
         else:
             self.session.lock()
-            return [gevent.spawn(self.poll, handler)]
+            self.poll(handler)
+            return []
+
+# Streaming Transports
+# ====================
+#
+# Hold one response open and stream frames down it.
 
-class XHRStreaming(PollingTransport):
+class StreamingTransport(BaseTransport):
+    """
+    Base of the transports which keep one response open: a single
+    greenlet writes the headers and prelude, the open frame,
+    message batches and heartbeats, all through the connection's
+    FrameWriter. After ``response_limit`` bytes of frames the
+    response is ended and the client reconnects, so the browser
+    can let go of what it has received.
+
+    Subclasses set the content type and prelude and overload
+    write_frame.
+    """
     direction = 'recv'
 
-    TIMING = 2
-    CUTOFF = 10240
+    content_type = ("Content-Type", "application/javascript; charset=UTF-8")
 
-    prelude = 'h' *  2048 + '\n'
+    # Sent once, ahead of the first frame
+    prelude = ''
 
-    def poll(self, handler):
+    # Bytes of frames, not counting the transfer encoding, written
+    # before the response is cycled.
+    response_limit = 128 * 1024
+
+    def start(self, handler):
         """
-        Spin lock the thread until we have a message on the
-        gevent queue.
+        Send the headers and the prelude.
         """
+        handler.enable_cookie()
+        handler.enable_cors()
 
-        writer = handler.socket.makefile()
-        written = 0
+        handler.headers += [self.content_type]
 
-        try:
-            while True:
-                messages = self.session.get_messages(timeout=self.TIMING)
-                messages = self.encode(messages)
+        if self.writer.chunked:
+            handler.headers += [("Transfer-Encoding", "chunked")]
+        else:
+            handler.headers += [('Connection', 'close')]
+            handler.close_connection = True
 
-                frame = protocol.message_frame(messages) + '\n'
-                chunk = handler.raw_chunk(frame)
+        handler.start_response("200 OK", handler.headers)
+        handler.headers_sent = True
 
-                writer.write(chunk)
-                writer.flush()
-                written += len(chunk)
+        self.writer.send([handler.raw_headers()])
 
-                zero_chunk = handler.raw_chunk('')
-                writer.write(zero_chunk)
+        if self.prelude:
+            self.writer.frame(self.prelude)
 
-                if written > self.CUTOFF:
-                    zero_chunk = handler.raw_chunk('')
-                    writer.write(zero_chunk)
-                    break
+    def send_frame(self, prefix, payload=''):
+        """
+        Write one frame, returns its size.
+        """
+        parts = self.write_frame(prefix, payload)
+        self.writer.frame(*parts)
+        return sum(len(part) for part in parts)
 
-        except socket.error:
-            self.session.expire()
+    def send_close(self, code, reason):
+        self.send_frame(protocol.close_frame(code, reason, newline=False))
 
     def stream(self, handler):
-        content_type = ("Content-Type", "application/javascript; charset=UTF-8")
+        session = self.session
 
-        handler.enable_cookie()
-        handler.enable_cors()
+        try:
+            self.start(handler)
+
+            if session.is_new():
+                self.send_frame(protocol.OPEN.strip())
+                self.locked(self.send_messages)
+            elif session.is_network_error():
+                self.send_close(1002, "Connection interrupted")
+            elif session.is_expired():
+                self.send_close(*session.get_close_reason())
+            elif session.is_locked():
+                session.network_error = True
+                self.send_close(2010, "Another connection still open")
+            else:
+                self.locked(self.send_messages)
 
-        # https://groups.google.com/forum/#!msg/sockjs/bl3af2zqc0A/w-o3OK3LKi8J
-        if handler.request_version == 'HTTP/1.1':
+            self.writer.end()
 
-            handler.headers += [
-                content_type,
-                ("Transfer-Encoding", "chunked"),
-                ('Connection', 'keep-alive'),
-            ]
+        except socket.error:
+            session.network_error = True
+            session.expire()
 
-        elif handler.request_version == 'HTTP/1.0':
+    def locked(self, action):
+        self.session.lock()
+        self.start_heartbeats()
+        try:
+            action()
+        finally:
+            self.stop_heartbeats()
+            self.session.unlock()
 
-            handler.headers += [
-                content_type,
-                ('Connection', 'close'),
-            ]
+    def send_messages(self):
+        """
+        Stream message batches, or heartbeats when there is nothing
+        to send, until the response limit is reached or the session
+        closes.
+        """
+        session = self.session
+        written = 0
 
-        # Use very low level api here, since we want more granular
-        # control over our response
+        while written < self.response_limit:
+            if session.is_expired():
+                self.send_close(*session.get_close_reason())
+                break
 
-        handler.start_response("200 OK", handler.headers)
+            messages, heartbeat = self.next_batch()
 
-        headers = handler.raw_headers()
+            if messages:
+                written += self.send_frame(protocol.MESSAGE,
+                    self.encode(messages))
+            elif heartbeat and not session.is_expired():
+                written += self.send_frame(protocol.HEARTBEAT.strip())
 
-        try:
-            writer = handler.socket.makefile()
-            writer.write(headers)
-            writer.flush()
+    def __call__(self, handler, request_method, request_body):
+        if request_method == 'OPTIONS':
+            handler.write_options(['OPTIONS', 'POST'])
+            return []
 
-            prelude_chunk = handler.raw_chunk(self.prelude)
-            open_chunk = handler.raw_chunk('o\n')
+        # One writer for the whole response, chunked over HTTP/1.1
+        self.writer = handler.frame_writer(
+            chunked=handler.request_version == 'HTTP/1.1',
+            compressor=handler.compressor(),
+        )
 
-            writer.write(prelude_chunk)
-            writer.write(open_chunk)
+        return [self.spawn(self.stream, handler)]
 
-            writer.flush()
-            writer.close()
+class XHRStreaming(StreamingTransport):
+    direction = 'recv'
 
-        except socket.error:
-            self.session.expire()
+    prelude = 'h' *  2048 + '\n'
 
-    def __call__(self, handler, request_method, raw_request_data):
-        """
-        """
-        if request_method == 'OPTIONS':
-            handler.write_options(['OPTIONS', 'POST'])
+    def write_frame(self, prefix, payload):
+        return [prefix, payload, '\n']
+
+class HTMLFile(StreamingTransport):
+    """
+    Streaming for old browsers through a hidden iframe: a padded
+    html page followed by one script tag per frame, each calling the
+    parent page's callback.
+    """
+    direction = 'recv'
+
+    content_type = ("Content-Type", "text/html; charset=UTF-8")
+
+    CALLBACK = re.compile(r'^[a-zA-Z0-9_.]+$')
+
+    # IE only starts rendering once it has this much of the page
+    padding = 1024
+
+    def start(self, handler):
+        handler.enable_nocache()
+        super(HTMLFile, self).start(handler)
+
+    def write_frame(self, prefix, payload):
+        frame = protocol.json.dumps(prefix + payload)
+
+        # Keep a message from closing the script tag
+        if '</' in frame:
+            frame = frame.replace('</', '<\\/')
+
+        return ['<script>\np(', frame, ');\n</script>\r\n']
+
+    def __call__(self, handler, request_method, request_body):
+        # The callback is checked once, it is part of the prelude
+        qs = urlparse.parse_qs(handler.environ.get('QUERY_STRING', ''))
+        callback = qs.get('c', [''])[0]
+
+        if not callback:
+            handler.do500(message='"callback" parameter required')
             return []
 
-        return [
-            gevent.spawn(self.stream, handler),
-            gevent.spawn(self.poll, handler),
-        ]
+        if not self.CALLBACK.match(callback):
+            handler.do500(message='invalid "callback" parameter')
+            return []
 
-class HTMLFile(BaseTransport):
-    direction = 'recv'
+        page = protocol.HTMLFILE_HTML % callback
+        self.prelude = page.ljust(self.padding) + '\r\n\r\n'
+
+        return super(HTMLFile, self).__call__(handler, request_method,
+            request_body)
 
 class IFrame(BaseTransport):
     direction = 'recv'
 
-class EventSource(BaseTransport):
-    direction = 'send'
+class EventSource(StreamingTransport):
+    """
+    Server-sent events, one ``data:`` event per frame. Queued
+    messages are batched into a single event.
+    """
+    direction = 'recv'
+
+    content_type = ("Content-Type", "text/event-stream; charset=UTF-8")
+
+    # Opera needs a newline before the first event
+    prelude = '\r\n'
+
+    def start(self, handler):
+        # Requested with GET, it mustn't be cached
+        handler.enable_nocache()
+        super(EventSource, self).start(handler)
+
+    def write_frame(self, prefix, payload):
+        # Frames are JSON encoded, they never contain a line break
+        # which would split the event.
+        return ['data: ', prefix, payload, '\r\n\r\n']
 
 # Socket Transports
 # ==================
 #
 # Provides a bidirectional connection to and from the client.
-# Sending and receiving are split in two different threads.
 
-class WebSocket(BaseTransport):
+class SocketTransport(BaseTransport):
+    """
+    Base of the websocket transports. The handler's greenlet runs
+    the connection: it reads from the socket until the client goes
+    away. Outgoing frames are written by a short lived flush
+    greenlet, started when the session has something for the client
+    ( a message, a due heartbeat or the session closing ) and gone
+    once there is nothing left, so an idle connection holds no
+    greenlet besides the handler's.
+
+    Sessions which can't notify of new messages get a writer
+    greenlet polling them instead.
+
+    Subclasses overload open, put, send_messages, send_heartbeat
+    and send_close.
+    """
     direction = 'bi'
 
-    def poll(self, socket):
+    def __init__(self, session, conn):
+        super(SocketTransport, self).__init__(session, conn)
+        self.socket = None
+        self.flusher = None
+        self.closed = False
+
+    def open(self):
+        """
+        Greet the client, returns False if the connection is over
+        before it started.
+        """
+        return True
+
+    def put(self, socket):
         """
-        Spin lock the thread until we have a message on the
-        gevent queue.
+        Read from the socket until the client goes away.
         """
+        raise NotImplemented()
 
-        while not self.session.expired:
-            messages = self.session.get_messages()
-            messages = self.encode(messages)
+    def send_messages(self, messages):
+        raise NotImplemented()
 
-            socket.send(protocol.message_frame(messages))
+    def send_heartbeat(self):
+        pass
 
-        close_error = protocol.close_frame(3000, "Go away!", newline=False)
-        socket.send(close_error)
+    def send_close(self):
+        self.closed = True
+        self.socket.close()
 
-        # Session expires, so unlock
-        socket.close()
-        self.session.unlock()
+    def notify(self):
+        """
+        Session listener, makes sure a flush greenlet is running.
+        """
+        if self.flusher is None and not self.closed:
+            self.flusher = self.spawn(self.flush)
 
-    def put(self, socket):
+    def flush(self):
+        """
+        Write what the session has for the client, then exit.
+        """
+        session = self.session
+
+        try:
+            while not self.closed:
+                messages = session.get_batch(self.batching, block=False)
+
+                if messages:
+                    self.send_messages(messages)
+                elif self.beat is not None and self.beat.due:
+                    self.send_heartbeat()
+                elif session.is_expired():
+                    self.send_close()
+                else:
+                    break
+
+                if self.beat is not None:
+                    self.beat.sent()
 
-        wsprotocol = socket.protocol
+        except (socketerror, WebSocketError):
+            self.closed = True
+            session.expire()
+        finally:
+            self.flusher = None
+
+    def poll(self):
+        """
+        Writer greenlet for sessions without a listener.
+        """
+        session = self.session
+
+        while not session.is_expired():
+            messages, heartbeat = self.next_batch()
+
+            if messages:
+                self.send_messages(messages)
+            elif heartbeat and not session.is_expired():
+                self.send_heartbeat()
+
+        self.send_close()
+
+    def __call__(self, socket, request_method, raw_request_data):
+        self.socket = socket
+        session = self.session
+
+        if not self.open():
+            return []
+
+        session.lock()
+        self.start_heartbeats()
+
+        if session.wakeable:
+            session.listener = self.notify
+            writer = None
+
+            # Anything queued before the connection was up
+            if session.queued():
+                self.notify()
+        else:
+            writer = self.spawn(self.poll)
+
+        try:
+            self.put(socket)
+        finally:
+            # The client is gone, nothing more to write
+            session.listener = None
+            self.closed = True
+            self.stop_heartbeats()
+
+            if writer is not None:
+                writer.kill(block=False)
+
+            socket.close()
+            session.unlock()
+            session.expire()
+
+        return []
+
+class WebSocket(SocketTransport):
+
+    def open(self):
+        self.socket.send('o')
+
+        if self.session.is_expired():
+            self.send_close()
+            return False
+
+        return True
+
+    def send_messages(self, messages):
+        self.socket.send(protocol.message_frame(self.encode(messages)))
+
+    def send_heartbeat(self):
+        self.socket.send(protocol.HEARTBEAT.strip())
+
+    def send_close(self):
+        close_error = protocol.close_frame(*self.session.get_close_reason(), newline=False)
+        self.socket.send(close_error)
+        super(WebSocket, self).send_close()
+
+    def put(self, socket):
 
         while not self.session.is_expired():
             try:
@@ -417,8 +837,9 @@ class WebSocket(BaseTransport):
             # won't exist so ignore.
             except AttributeError:
                 break
-            #except socketerror:
-                #break
+            # The socket was closed under us, by send_close
+            except socketerror:
+                break
 
             # Hybi = Closed
             # Hixie = None
@@ -438,59 +859,43 @@ class WebSocket(BaseTransport):
 
             self.session.incr_hits()
 
-        # Session expires, so unlock
-        socket.close()
-        self.session.unlock()
-        self.session.expire()
-
-    def __call__(self, socket, request_method, raw_request_data):
-
-        socket.send('o')
+class RawWebSocket(SocketTransport):
 
+    def open(self):
         if self.session.is_expired():
-            close_error = protocol.close_frame(3000, "Go away!", newline=False)
-            socket.send(close_error)
-            socket.close()
-            return []
-        #elif self.session.is_locked():
-            #lock_error = protocol.close_frame(2010, "Another connection still open")
-            #socket.send(lock_error)
-            #socket.close()
-            #return []
-
-        self.session.lock()
-
-        return [
-            gevent.spawn(self.poll, socket),
-            gevent.spawn(self.put, socket),
-        ]
-
-class RawWebSocket(BaseTransport):
-    direction = 'bi'
-
-    def poll(self, socket):
-
-        while not self.session.is_expired():
-            messages = self.session.get_messages()
-
-            for message in messages:
-                # TODO: this is a hack because the rest of the
-                # transports actually use framing and this is the
-                # one abberation. But it works...
-                if len(message) == 1:
-                    socket.send(message[0])
-                else:
-                    socket.send(message)
-
-        socket.close()
+            self.send_close()
+            return False
+
+        return True
+
+    def start_heartbeats(self):
+        # No heartbeat frames on a raw websocket
+        pass
+
+    def send_messages(self, messages):
+        for message in messages:
+            # Broadcasts arrive already JSON encoded, raw
+            # websockets want the message itself.
+            if isinstance(message, protocol.Encoded):
+                message = message.value
+
+            # TODO: this is a hack because the rest of the
+            # transports actually use framing and this is the
+            # one abberation. But it works...
+            if len(message) == 1:
+                self.socket.send(message[0])
+            else:
+                self.socket.send(message)
 
     def put(self, socket):
 
         while not self.session.is_expired():
             # Just read atomic strings and do what the connection
             # wants.
-
-            message = socket.receive() # blocking
+            try:
+                message = socket.receive() # blocking
+            except socketerror:
+                break
 
             if isinstance(message, Closed) or message is None:
                 break
@@ -498,16 +903,3 @@ class RawWebSocket(BaseTransport):
             self.conn.on_message([message])
 
             self.session.incr_hits()
-
-        socket.close()
-
-    def __call__(self, socket, request_method, raw_request_data):
-
-        if self.session.is_expired():
-            socket.close()
-            return []
-
-        return [
-            gevent.spawn(self.poll, socket),
-            gevent.spawn(self.put, socket),
-        ]
@@ -0,0 +1,98 @@
+"""
+Vectored writes of frames to a connection's socket.
+
+A frame on the wire is a handful of pieces: the HTTP chunk header,
+the frame prefix, the encoded payload and a trailer. Rather than
+concatenating them, each a full copy of the payload, the writer
+keeps them as separate buffers and hands the list to a single
+``sendmsg`` call, the socket level equivalent of ``writev``.
+"""
+
+class FrameWriter(object):
+    """
+    Writes lists of buffers to a socket in one vectored call. One
+    writer is kept per connection by the handler, ``chunked`` is
+    set for the response being written.
+
+    Sockets without ``sendmsg`` ( those of Python 2 ) get the
+    buffers joined once and sent with ``sendall``, still a single
+    copy of the payload instead of one per framing step.
+
+    With a ``compressor`` set the frames, not the headers, are
+    compressed as one stream which is finished by ``end``.
+    """
+
+    def __init__(self, sock, chunked=False, compressor=None):
+        self.sock = sock
+        self.chunked = chunked
+        self.compressor = compressor
+
+        self.sendmsg = getattr(sock, 'sendmsg', None)
+
+        self.written = 0
+        self.writes = 0
+
+    def send(self, buffers):
+        """
+        Send every buffer in the list, in order.
+        """
+        if self.sendmsg is None:
+            data = ''.join(buffers)
+            self.sock.sendall(data)
+            size = len(data)
+        else:
+            size = self.sendmsg_all(buffers)
+
+        self.written += size
+        self.writes += 1
+        return size
+
+    def sendmsg_all(self, buffers):
+        """
+        sendmsg until the whole vector is out, a short write leaves
+        the rest of the vector to resend from where it stopped.
+        """
+        buffers = [memoryview(buf) for buf in buffers if buf]
+        total = sum(len(buf) for buf in buffers)
+        remaining = total
+
+        while remaining:
+            sent = self.sendmsg(buffers)
+            remaining -= sent
+
+            while sent:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers[0])
+                    buffers.pop(0)
+                else:
+                    buffers[0] = buffers[0][sent:]
+                    sent = 0
+
+        return total
+
+    def frame(self, *parts):
+        """
+        Write one frame made of ``parts``, wrapped in an HTTP chunk
+        if the response is chunked. Returns the bytes written.
+        """
+        if self.compressor is not None:
+            parts = [self.compressor.compress(''.join(parts))]
+
+        if not self.chunked:
+            return self.send(parts)
+
+        size = sum(len(part) for part in parts)
+        return self.send(['%x\r\n' % size] + list(parts) + ['\r\n'])
+
+    def end(self):
+        """
+        Terminate a chunked response.
+        """
+        if self.compressor is not None:
+            tail = self.compressor.finish()
+            self.compressor = None
+            if tail:
+                self.frame(tail)
+
+        if self.chunked:
+            self.send(['0\r\n\r\n'])
@@ -5,8 +5,10 @@ version='0.1dev'
 
 install_requires = [
     'setuptools',
-    'gevent',
-    'gevent-websocket',
+    'gevent>=1.1,<1.2',
+    # compression.DeflateWebSocket extends the internals of its
+    # hybi websocket
+    'gevent-websocket==0.3.6',
 ]
 
 tests_require = install_requires + ['nose']
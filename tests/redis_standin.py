@@ -0,0 +1,130 @@
+"""
+A tiny in-process stand-in for a Redis server, enough of the
+protocol for gevent_sockjs.redisstore: PING, RPUSH, LRANGE, DEL,
+EXPIRE, BLPOP and MULTI/EXEC.
+
+Every command received is logged, so tests can check how writes
+were batched.
+"""
+
+import gevent
+from gevent.server import StreamServer
+
+def reply(value):
+    if value is None:
+        return '$-1\r\n'
+    elif isinstance(value, bool):
+        return ':%d\r\n' % int(value)
+    elif isinstance(value, (int, long)):
+        return ':%d\r\n' % value
+    elif isinstance(value, list):
+        return '*%d\r\n' % len(value) + ''.join(reply(v) for v in value)
+    elif isinstance(value, Status):
+        return '+%s\r\n' % value.text
+    elif isinstance(value, Exception):
+        return '-ERR %s\r\n' % value
+    return '$%d\r\n%s\r\n' % (len(value), value)
+
+class Status(object):
+    def __init__(self, text):
+        self.text = text
+
+OK = Status('OK')
+QUEUED = Status('QUEUED')
+
+class RedisStandin(object):
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+        self.log = []
+        self.connections = 0
+
+        self.server = StreamServer(('127.0.0.1', 0), self.handle)
+
+    @property
+    def address(self):
+        return self.server.address
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
+
+    def handle(self, sock, address):
+        self.connections += 1
+        reader = sock.makefile('rb')
+        transaction = None
+
+        while True:
+            command = self.read_command(reader)
+            if command is None:
+                break
+
+            self.log.append(command)
+            name = command[0].upper()
+
+            if name == 'MULTI':
+                transaction = []
+                sock.sendall(reply(OK))
+            elif name == 'EXEC':
+                results = [self.run(c) for c in transaction]
+                transaction = None
+                sock.sendall(reply(results))
+            elif transaction is not None:
+                transaction.append(command)
+                sock.sendall(reply(QUEUED))
+            else:
+                sock.sendall(reply(self.run(command)))
+
+        sock.close()
+
+    def read_command(self, reader):
+        line = reader.readline()
+        if not line:
+            return None
+
+        assert line[0] == '*'
+        args = []
+
+        for i in xrange(int(line[1:])):
+            length = int(reader.readline()[1:])
+            args.append(reader.read(length + 2)[:-2])
+
+        return args
+
+    def run(self, command):
+        name, args = command[0].upper(), command[1:]
+
+        if name == 'PING':
+            return Status('PONG')
+        elif name == 'RPUSH':
+            values = self.data.setdefault(args[0], [])
+            values.extend(args[1:])
+            return len(values)
+        elif name == 'LRANGE':
+            values = self.data.get(args[0], [])
+            start, stop = int(args[1]), int(args[2])
+            return values[start:None if stop == -1 else stop + 1]
+        elif name == 'DEL':
+            return int(self.data.pop(args[0], None) is not None)
+        elif name == 'EXPIRE':
+            self.ttls[args[0]] = int(args[1])
+            return int(args[0] in self.data)
+        elif name == 'BLPOP':
+            key, timeout = args[0], int(args[1])
+            waited = 0.0
+
+            while not self.data.get(key):
+                if timeout and waited >= timeout:
+                    return None
+                gevent.sleep(0.01)
+                waited += 0.01
+
+            value = self.data[key].pop(0)
+            if not self.data[key]:
+                del self.data[key]
+            return [key, value]
+
+        return Exception('unknown command %s' % name)
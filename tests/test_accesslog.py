@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Batched, sampled access logging.
+"""
+import unittest2 as unittest
+import simplejson
+import nose
+
+from StringIO import StringIO
+
+from gevent_sockjs.accesslog import AccessLog
+
+class Response(object):
+    """
+    The parts of a handler the access log reads.
+    """
+
+    client_address = ('127.0.0.1', 5000)
+    requestline = 'POST /echo/a/b/xhr HTTP/1.1'
+    response_length = 2
+    time_start = 10.0
+    time_finish = 10.5
+
+    def __init__(self, status='200 OK', route='echo'):
+        self._orig_status = self.status = status
+        self.route_name = route
+
+class AccessLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output = StringIO()
+
+    def test_batched(self):
+        log = AccessLog(self.output)
+
+        log.record(Response())
+        log.record(Response('404 NOT FOUND', None))
+
+        self.assertEqual(self.output.getvalue(), '')
+
+        log.flush()
+        lines = self.output.getvalue().splitlines()
+
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('127.0.0.1 - - ['))
+        self.assertTrue(lines[0].endswith(
+            '] "POST /echo/a/b/xhr HTTP/1.1" 200 2 0.500000'))
+        self.assertEqual(log.written, 2)
+        self.assertEqual(len(log), 0)
+
+    def test_json(self):
+        log = AccessLog(self.output, format='json')
+
+        log.record(Response())
+        log.flush()
+
+        record = simplejson.loads(self.output.getvalue())
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['route'], 'echo')
+        self.assertEqual(record['duration'], 0.5)
+
+    def test_full(self):
+        log = AccessLog(self.output, size=2)
+
+        for i in xrange(5):
+            log.record(Response())
+
+        self.assertEqual(log.recorded, 2)
+        self.assertEqual(log.dropped, 3)
+
+    def test_sampling(self):
+        log = AccessLog(self.output, sampling={
+            'echo'         : 0.25,
+            ('echo', 500)  : 1.0,
+            404            : 0,
+        })
+
+        for i in xrange(8):
+            log.record(Response())
+        log.record(Response('500 INTERNAL SERVER ERROR'))
+        log.record(Response('404 NOT FOUND', 'other'))
+
+        self.assertEqual(log.recorded, 3)
+        self.assertEqual(log.sampled_out, 7)
+
+    def test_socket_error(self):
+        log = AccessLog(self.output)
+
+        log.record(Response('socket error: [Errno 32] Broken pipe'))
+        log.flush()
+
+        self.assertTrue('" 000 ' in self.output.getvalue())
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Streaming request bodies and incremental decoding of message arrays.
+"""
+import time
+import httplib
+import unittest2 as unittest
+import gevent.socket
+import nose
+
+from StringIO import StringIO
+
+from gevent_sockjs.errors import Http413, InvalidJSON
+from gevent_sockjs.handler import RequestBody
+from gevent_sockjs.protocol import ArrayDecoder
+from gevent_sockjs.router import SockJSRouter, SockJSConnection
+from gevent_sockjs.server import SockJSServer
+from gevent_sockjs.transports import XHRSend
+
+class ArrayDecoderTest(unittest.TestCase):
+
+    def decode(self, chunks):
+        decoder = ArrayDecoder()
+        messages = []
+        for chunk in chunks:
+            messages += decoder.feed(chunk)
+        return messages + decoder.close()
+
+    def test_whole(self):
+        self.assertEqual(self.decode(['["a", 1, {"b": [2]}, null]']),
+            [u'a', 1, {u'b': [2]}, None])
+
+    def test_empty_array(self):
+        self.assertEqual(self.decode(['[', ' ]']), [])
+
+    def test_byte_at_a_time(self):
+        data = '[ "x\\"y" , 12.5e1, true,"\xc3\xa9" ]\n'
+        self.assertEqual(self.decode(list(data)),
+            [u'x"y', 125.0, True, u'\xe9'])
+
+    def test_messages_as_they_complete(self):
+        decoder = ArrayDecoder()
+        self.assertEqual(decoder.feed('["a", "b'), [u'a'])
+        self.assertEqual(decoder.feed('c", 1'), [u'bc'])
+        self.assertEqual(decoder.feed('0]'), [10])
+        self.assertEqual(decoder.close(), [])
+
+    def test_only_pending_message_buffered(self):
+        decoder = ArrayDecoder()
+        decoder.feed('[')
+        for i in range(1000):
+            decoder.feed('"message %d",' % i)
+        self.assertEqual(decoder.pending, None)
+
+    def test_split_anywhere(self):
+        data = '["a\\"]", [1, {"b": "}"}], -2.5, "\\u00e9", false, "\xc3\xa9"]'
+        expected = self.decode([data])
+
+        for i in range(len(data)):
+            self.assertEqual(self.decode([data[:i], data[i:]]), expected, i)
+
+    # A large message arriving in small chunks is scanned once and
+    # decoded once, not parsed again from its start on every chunk.
+    def test_large_message_linear(self):
+        data = '["' + 'x' * (4 * 1024 * 1024) + '", [' + '1,' * 100000 + '1]]'
+        chunks = [data[i:i + 8192] for i in xrange(0, len(data), 8192)]
+
+        start = time.time()
+        messages = self.decode(chunks)
+
+        self.assertEqual(len(messages[0]), 4 * 1024 * 1024)
+        self.assertEqual(len(messages[1]), 100001)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_invalid(self):
+        for data in ['', '"x"', '["x', '[1,]', '[1] x', '[1 2]', '{}', '["\xff"]',
+                '[x]', '[1}]', '[tru]', '[{"a" 1}]']:
+            self.assertRaises(InvalidJSON, self.decode, [data])
+
+class Connection(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def on_message(self, message):
+        self.messages.append(message)
+
+class ReceiveTest(unittest.TestCase):
+
+    def test_delivered(self):
+        conn = Connection()
+        XHRSend(None, conn).receive(['["a", ', '"b"]'])
+
+        self.assertEqual(conn.messages, [u'a', u'b'])
+
+    # Sends are all or nothing, the client gets a 500 for the lot
+    def test_broken_delivers_nothing(self):
+        conn = Connection()
+        receive = XHRSend(None, conn).receive
+
+        self.assertRaises(InvalidJSON, receive, ['["a", "b"', ', x]'])
+        self.assertEqual(conn.messages, [])
+
+class RequestBodyTest(unittest.TestCase):
+
+    def body(self, data, max_size=None, length=True):
+        environ = {'CONTENT_LENGTH': str(len(data)) if length else ''}
+        return RequestBody(StringIO(data), environ, max_size)
+
+    def test_read(self):
+        data = 'x\n' * 10000
+        self.assertEqual(self.body(data).read(), data)
+
+    def test_chunks(self):
+        body = self.body('x' * 20000)
+        self.assertEqual([len(c) for c in body.chunks()], [8192, 8192, 3616])
+        self.assertEqual(body.received, 20000)
+
+    def test_content_length_over_limit(self):
+        self.assertRaises(Http413, self.body, 'x' * 101, 100)
+
+    def test_stream_over_limit(self):
+        body = self.body('x' * 20000, 10000, length=False)
+        chunks = body.chunks()
+
+        self.assertEqual(len(next(chunks)), 8192)
+        self.assertRaises(Http413, next, chunks)
+
+class Small(SockJSConnection):
+    max_payload = 100
+
+    def on_message(self, message):
+        pass
+
+class TooLargeTest(unittest.TestCase):
+
+    # The rest of the body is left unread, a keep-alive client is
+    # told the connection won't be reused
+    def test_connection_close(self):
+        server = SockJSServer(('127.0.0.1', 0), SockJSRouter({'small': Small}),
+            access_log=False, log=None)
+        server.start()
+
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', server.server_port)
+            conn.sock = gevent.socket.create_connection(
+                ('127.0.0.1', server.server_port))
+
+            conn.request('POST', '/small/000/a/xhr')
+            conn.getresponse().read()
+
+            conn.request('POST', '/small/000/a/xhr_send', '["%s"]' % ('x' * 200))
+            response = conn.getresponse()
+
+            self.assertEqual(response.status, 413)
+            self.assertEqual(response.getheader('connection'), 'close')
+            conn.close()
+        finally:
+            server.stop()
+
+if __name__ == '__main__':
+    nose.main()
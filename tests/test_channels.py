@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Broadcast channels and encode-once frames.
+"""
+import time
+import unittest2 as unittest
+import gevent
+import nose
+
+from gevent_sockjs import protocol
+from gevent_sockjs.channels import ChannelRegistry
+from gevent_sockjs.session import MemorySession
+from gevent_sockjs.sessionpool import SessionPool
+
+class ChannelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.channels = ChannelRegistry(fanout_slice=2)
+        self.sessions = [MemorySession(None) for i in range(5)]
+
+        for session in self.sessions:
+            self.channels.subscribe('news', session)
+
+    # Every subscriber gets the very same encoded frame.
+    def test_broadcast(self):
+        self.assertEqual(self.channels.broadcast('news', {'a': [1, 2]}), 5)
+
+        frames = [session.get_messages()[0] for session in self.sessions]
+        self.assertTrue(all(frame is frames[0] for frame in frames))
+        self.assertEqual(protocol.encode([frames[0]]), '[{"a":[1,2]}]')
+
+    def test_mixed_batch(self):
+        session = self.sessions[0]
+
+        session.add_message('before')
+        self.channels.broadcast('news', 'shared')
+        session.add_message({'after': True})
+
+        self.assertEqual(protocol.encode(session.get_messages()),
+            '["before","shared",{"after":true}]')
+
+    # Fan-out yields to the hub between slices.
+    def test_slices(self):
+        ticks = []
+        ticker = gevent.spawn(lambda: [ticks.append(i) or gevent.sleep(0)
+                                       for i in range(10)])
+
+        gevent.sleep(0)
+        self.channels.broadcast('news', 'x')
+        self.assertTrue(len(ticks) >= 2)
+        ticker.kill()
+
+    def test_unsubscribe_on_close(self):
+        self.sessions[0].kill()
+        gevent.sleep(0)
+
+        self.assertEqual(self.channels.broadcast('news', 'x'), 4)
+        self.assertFalse(self.sessions[0] in self.channels.memberships)
+
+    # Collected sessions leave their channels without waiting for a
+    # broadcast to find them
+    def test_unsubscribe_on_collect(self):
+        pool = SessionPool(shards=1)
+        for session in self.sessions:
+            pool.add(session)
+
+        idle = self.sessions[0]
+        self.channels.subscribe('quiet', idle)
+
+        for session in self.sessions[1:]:
+            session.persist(forever=True)
+
+        pool.gc(time.time() + 10)
+        gevent.sleep(0)
+
+        self.assertFalse(idle in self.channels.memberships)
+        self.assertEqual(len(self.channels.get('news')), 4)
+        self.assertEqual(self.channels.get('quiet'), None)
+
+    def test_unsubscribe_on_remove(self):
+        pool = SessionPool(shards=1)
+        pool.add(self.sessions[0])
+
+        pool.remove(self.sessions[0].session_id)
+        gevent.sleep(0)
+
+        self.assertEqual(len(self.channels.get('news')), 4)
+
+    def test_unknown_channel(self):
+        self.assertEqual(self.channels.broadcast('sports', 'x'), 0)
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+Response compression and permessage-deflate negotiation.
+"""
+import os
+import struct
+import zlib
+import unittest2 as unittest
+import gevent.socket
+import nose
+
+from gevent_sockjs.compression import CompressionStats, HTTPCompression, \
+    PerMessageDeflate
+from gevent_sockjs.router import SockJSRouter, SockJSConnection
+from gevent_sockjs.server import SockJSServer
+
+class HTTPCompressionTest(unittest.TestCase):
+
+    def test_negotiate(self):
+        settings = HTTPCompression()
+
+        self.assertEqual(settings.negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(settings.negotiate('deflate'), 'deflate')
+        self.assertEqual(settings.negotiate('gzip;q=0, deflate'), 'deflate')
+        self.assertEqual(settings.negotiate('*'), 'gzip')
+        self.assertEqual(settings.negotiate('identity'), None)
+        self.assertEqual(settings.negotiate(''), None)
+
+    def test_gzip_stream(self):
+        stats = CompressionStats()
+        compressor = HTTPCompression().compressor('gzip', stats)
+
+        data = compressor.compress('a["x"]\n' * 100) + compressor.finish()
+
+        self.assertEqual(zlib.decompress(data, 16 + zlib.MAX_WBITS), 'a["x"]\n' * 100)
+        self.assertEqual(stats.raw_bytes, 700)
+        self.assertEqual(stats.compressed_bytes, len(data))
+        self.assertTrue(stats.ratio() > 5)
+
+class PerMessageDeflateTest(unittest.TestCase):
+
+    def negotiate(self, offer, **settings):
+        return PerMessageDeflate(**settings).negotiate(offer, CompressionStats())
+
+    def test_plain_offer(self):
+        header, deflater = self.negotiate('permessage-deflate; client_max_window_bits')
+        self.assertEqual(header, 'permessage-deflate')
+
+    def test_parameters(self):
+        header, deflater = self.negotiate(
+            'permessage-deflate; server_max_window_bits=10',
+            client_no_context_takeover=True,
+        )
+        self.assertEqual(header, 'permessage-deflate; '
+            'client_no_context_takeover; server_max_window_bits=10')
+        self.assertEqual(deflater.wbits, -10)
+        self.assertFalse(deflater.client_takeover)
+
+    def test_declined(self):
+        self.assertEqual(self.negotiate('x-webkit-deflate-frame'), None)
+        self.assertEqual(self.negotiate('permessage-deflate; unknown'), None)
+        self.assertEqual(self.negotiate(
+            'permessage-deflate; server_max_window_bits=8'), None)
+
+    # A declined offer falls through to the client's next one
+    def test_fallback_offer(self):
+        header, deflater = self.negotiate(
+            'permessage-deflate; server_max_window_bits=8, permessage-deflate')
+        self.assertEqual(header, 'permessage-deflate')
+
+    def test_roundtrip(self):
+        header, deflater = self.negotiate('permessage-deflate', min_size=10)
+        message = 'a["' + 'hello ' * 50 + '"]'
+
+        first = deflater.compress(message)
+        second = deflater.compress(message)
+
+        # The second message refers back to the first one
+        self.assertTrue(len(second) < len(first))
+
+        inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+        for data in (first, second):
+            self.assertEqual(inflate.decompress(data + '\x00\x00\xff\xff'), message)
+
+        self.assertEqual(deflater.compress('short'), None)
+        self.assertEqual(deflater.stats.skipped, 1)
+
+    def test_no_context_takeover(self):
+        header, deflater = self.negotiate('permessage-deflate',
+            min_size=0, server_no_context_takeover=True)
+        message = 'a["' + 'hello ' * 50 + '"]'
+
+        self.assertEqual(deflater.compress(message), deflater.compress(message))
+
+class Echo(SockJSConnection):
+
+    def on_message(self, message):
+        self.send(message)
+
+HANDSHAKE = (
+    'GET /echo/websocket HTTP/1.1\r\n'
+    'Host: localhost\r\n'
+    'Upgrade: websocket\r\n'
+    'Connection: Upgrade\r\n'
+    'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+    'Sec-WebSocket-Version: 13\r\n'
+    'Sec-WebSocket-Extensions: permessage-deflate\r\n'
+    '\r\n'
+)
+
+class DeflateWebSocketTest(unittest.TestCase):
+    """
+    The extension negotiated by a real server, and a compressed
+    message sent each way over the raw websocket endpoint.
+    """
+
+    def setUp(self):
+        self.server = SockJSServer(('127.0.0.1', 0),
+            SockJSRouter({'echo': Echo}), access_log=False, log=None,
+            websocket_deflate=PerMessageDeflate())
+        self.server.start()
+
+        self.sock = gevent.socket.create_connection(
+            ('127.0.0.1', self.server.server_port))
+        self.sock.settimeout(5)
+        self.rfile = self.sock.makefile('rb')
+
+    def tearDown(self):
+        self.rfile.close()
+        self.sock.close()
+        self.server.stop()
+
+    def handshake(self):
+        self.sock.sendall(HANDSHAKE)
+
+        head = []
+        line = self.rfile.readline()
+        while line not in ('\r\n', ''):
+            head.append(line)
+            line = self.rfile.readline()
+
+        return ''.join(head)
+
+    def send_frame(self, payload, rsv1):
+        """
+        A masked text frame, as clients send them.
+        """
+        mask = os.urandom(4)
+        masked = ''.join(chr(ord(c) ^ ord(mask[i % 4]))
+            for i, c in enumerate(payload))
+
+        header = chr(0x80 | (0x40 if rsv1 else 0) | 0x1)
+        if len(payload) < 126:
+            header += chr(0x80 | len(payload))
+        else:
+            header += chr(0x80 | 126) + struct.pack('!H', len(payload))
+
+        self.sock.sendall(header + mask + masked)
+
+    def read_frame(self):
+        first, second = map(ord, self.rfile.read(2))
+        length = second & 0x7f
+
+        if length == 126:
+            length, = struct.unpack('!H', self.rfile.read(2))
+
+        return first, self.rfile.read(length)
+
+    def test_compressed_echo(self):
+        head = self.handshake()
+
+        self.assertTrue(head.startswith('HTTP/1.1 101'))
+        self.assertTrue('Sec-WebSocket-Extensions: permessage-deflate\r\n'
+            in head)
+
+        message = 'hello ' * 50
+
+        deflate = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = deflate.compress(message) + deflate.flush(zlib.Z_SYNC_FLUSH)
+        self.send_frame(compressed[:-4], rsv1=True)
+
+        # FIN, RSV1 and a text opcode
+        first, payload = self.read_frame()
+        self.assertEqual(first, 0x80 | 0x40 | 0x1)
+        self.assertTrue(len(payload) < len(message))
+
+        inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.assertEqual(inflate.decompress(payload + '\x00\x00\xff\xff'),
+            message)
+
+        # Short messages go both ways uncompressed
+        self.send_frame('hi', rsv1=False)
+        self.assertEqual(self.read_frame(), (0x81, 'hi'))
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Single pass url dispatch.
+"""
+import unittest2 as unittest
+import nose
+
+from gevent_sockjs import static
+from gevent_sockjs.router import Dispatcher, SockJSRouter, SockJSConnection, \
+    static_route
+from gevent_sockjs.server import SockJSServer
+
+STATIC, DYNAMIC, RAW = Dispatcher.STATIC, Dispatcher.DYNAMIC, Dispatcher.RAW
+
+class DispatcherTest(unittest.TestCase):
+
+    def test_static(self):
+        resolve = Dispatcher().resolve
+
+        self.assertEqual(resolve('/echo'), (STATIC, 'echo', None, None, None))
+        self.assertEqual(resolve('/echo/'), (STATIC, 'echo', None, None, None))
+        self.assertEqual(resolve('/echo/info'), (STATIC, 'echo', None, None, 'info'))
+        self.assertEqual(resolve('/echo/iframe-a.b.html'),
+            (STATIC, 'echo', None, None, 'iframe-a.b.html'))
+
+    def test_raw(self):
+        self.assertEqual(Dispatcher().resolve('/echo/websocket'),
+            (RAW, 'echo', None, None, None))
+
+    def test_dynamic(self):
+        self.assertEqual(Dispatcher().resolve('/echo/000/abc/xhr_send'),
+            (DYNAMIC, 'echo', '000', 'abc', 'xhr_send'))
+
+    def test_invalid(self):
+        resolve = Dispatcher().resolve
+
+        for path in ['', '/', '//info', '/echo//', '/echo/a/b',
+                '/echo/0.0/abc/xhr', '/echo/000/a.b/xhr', '/echo/000/abc/',
+                '/echo/000/abc/xhr/more']:
+            self.assertEqual(resolve(path), None, path)
+
+    def test_cache(self):
+        dispatcher = Dispatcher(cache_size=4)
+
+        for path in ['/a', '/b', '/a', '/c', '/a', '/d', '/e']:
+            dispatcher.resolve(path)
+
+        # /a stays cached while it is used, /b was dropped
+        self.assertTrue('/a' in dispatcher.recent or '/a' in dispatcher.older)
+        self.assertFalse('/b' in dispatcher.recent or '/b' in dispatcher.older)
+        self.assertEqual((dispatcher.hits, dispatcher.misses), (2, 5))
+
+class StaticRouteTest(unittest.TestCase):
+
+    def test_fixed(self):
+        self.assertIs(static_route(None), static.Greeting)
+        self.assertIs(static_route('info'), static.InfoHandler)
+
+    def test_iframe(self):
+        for suffix in ['iframe.html', 'iframe-a.b.html', 'iframe0.3_x.html']:
+            self.assertIs(static_route(suffix), static.IFrameHandler, suffix)
+
+    def test_missing(self):
+        for suffix in ['infos', 'iframe', 'iframe.htm', 'iframeA.html',
+                'iframe a.html', 'xiframe.html', 'iframe.html.html5']:
+            self.assertRaises(KeyError, static_route, suffix)
+
+class Counting(SockJSConnection):
+    opened = 0
+
+    def on_open(self, session):
+        Counting.opened += 1
+
+class RouteDynamicTest(unittest.TestCase):
+
+    def setUp(self):
+        Counting.opened = 0
+        self.router = SockJSRouter({'count': Counting})
+        self.server = SockJSServer(('127.0.0.1', 0), self.router,
+            access_log=False, log=None)
+
+    def tearDown(self):
+        self.server.kill()
+
+    # Only the request which creates the session opens it
+    def test_opened_once(self):
+        for i in xrange(5):
+            downlink = self.router.route_dynamic(self.server, 'count', 'a',
+                '000', 'xhr')
+
+        session = downlink.session
+        self.assertEqual(Counting.opened, 1)
+        self.assertEqual(len(session._timeout_links), 1)
+
+if __name__ == '__main__':
+    nose.main()
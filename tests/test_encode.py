@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+String escaping and message encoding.
+"""
+import json
+import unittest2 as unittest
+import nose
+
+from gevent_sockjs.protocol import Encoded, quote, encode, encode_batch
+
+# The characters the SockJS spec wants escaped, by range
+WIDE_RANGES = [
+    (0x200c, 0x200f),
+    (0x2028, 0x202f),
+    (0x2060, 0x206f),
+    (0xfff0, 0xffff),
+]
+
+class QuoteTest(unittest.TestCase):
+
+    def assertQuoted(self, string, expected):
+        quoted = quote(string)
+
+        self.assertEqual(quoted, expected)
+        self.assertTrue(isinstance(quoted, str))
+
+        if isinstance(string, str):
+            string = string.decode('utf-8', 'replace')
+        self.assertEqual(json.loads(quoted), string)
+
+    def test_plain(self):
+        self.assertQuoted('hello', '"hello"')
+        self.assertQuoted(u'hello', '"hello"')
+        self.assertQuoted(u'', '""')
+
+    def test_quote_and_backslash(self):
+        self.assertQuoted('say "hi" \\o/', '"say \\"hi\\" \\\\o/"')
+        self.assertQuoted(u'\\"', '"\\\\\\""')
+
+    def test_control(self):
+        self.assertQuoted(u'a\nb\rc\td', '"a\\nb\\rc\\td"')
+        self.assertQuoted(u'\x00\x01\x08\x0c\x1f',
+            '"\\u0000\\u0001\\b\\f\\u001f"')
+
+        for i in range(0x20):
+            quoted = quote(chr(i))
+            self.assertEqual(json.loads(quoted), unichr(i))
+            self.assertTrue(quoted[1] == '\\', i)
+
+    def test_wide_ranges(self):
+        for first, last in WIDE_RANGES:
+            for i in (first, first + 1, last):
+                self.assertQuoted(unichr(i), '"\\u%04x"' % i)
+
+            # Their neighbours go out as UTF-8
+            for i in (first - 1, last + 1):
+                if i <= 0xffff:
+                    self.assertQuoted(unichr(i),
+                        '"' + unichr(i).encode('utf-8') + '"')
+
+    # A wide character escapes every non-ASCII character with it
+    def test_wide_with_unicode(self):
+        self.assertQuoted(u'caf\xe9\u2028"', '"caf\\u00e9\\u2028\\""')
+
+    def test_surrogates(self):
+        self.assertQuoted(u'\ud800', '"\\ud800"')
+        self.assertQuoted(u'a\udfffb', '"a\\udfffb"')
+
+        # Characters outside the BMP are fine either way
+        quoted = quote(u'\U0001f600')
+        self.assertEqual(json.loads(quoted), u'\U0001f600')
+
+    def test_unicode(self):
+        self.assertQuoted(u'caf\xe9', '"caf\xc3\xa9"')
+        self.assertQuoted(u'caf\xe9\n', '"caf\xc3\xa9\\n"')
+
+    def test_utf8_str(self):
+        self.assertQuoted('caf\xc3\xa9', '"caf\xc3\xa9"')
+        self.assertQuoted('caf\xc3\xa9 "x"', '"caf\xc3\xa9 \\"x\\""')
+        self.assertQuoted('line\xe2\x80\xa8break', '"line\\u2028break"')
+
+    # Replaced with U+FFFD, which the spec wants escaped
+    def test_invalid_utf8_str(self):
+        self.assertQuoted('a\xff', '"a\\ufffd"')
+
+class EncodeTest(unittest.TestCase):
+
+    def test_batch_of_str(self):
+        self.assertEqual(encode_batch(['a', 'b']), '["a","b"]')
+        self.assertEqual(encode_batch([]), '[]')
+
+    def test_batch_escaped(self):
+        self.assertEqual(encode_batch(['a"', u'\u2028', 'caf\xc3\xa9']),
+            '["a\\"","\\u2028","caf\xc3\xa9"]')
+
+    def test_batch_with_encoded(self):
+        shared = Encoded({'x': [1, u'\u2028']})
+
+        self.assertEqual(encode_batch(['a', shared, u'b\n']),
+            '["a",{"x":[1,"\\u2028"]},"b\\n"]')
+
+        # A lone broadcast is its pre-built array
+        self.assertIs(encode_batch([shared]), shared.array)
+        self.assertEqual(encode(shared), '[{"x":[1,"\\u2028"]}]')
+
+    def test_batch_of_values(self):
+        self.assertEqual(json.loads(encode_batch([1, 'a', {'b': None}])),
+            [1, u'a', {u'b': None}])
+
+    def test_encoded_from_json(self):
+        stored = Encoded.from_json('{"x":1}')
+
+        self.assertEqual(encode_batch(['a', stored]), '["a",{"x":1}]')
+        self.assertEqual(stored.value, {u'x': 1})
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Pre-encoded CORS, cookie and cache headers.
+"""
+import unittest2 as unittest
+import nose
+
+from gevent_sockjs.headers import HeaderCache, session_cookie
+
+NOW = 1300000000.5
+
+class HeaderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = HeaderCache()
+
+    def lines(self, *args, **kwargs):
+        kwargs.setdefault('now', NOW)
+        head = ''.join(self.cache.headers(*args, **kwargs))
+
+        self.assertTrue(head.endswith('\r\n'))
+        return head.split('\r\n')[:-1]
+
+    def test_date_only(self):
+        self.assertEqual(self.lines(),
+            ['Date: Sun, 13 Mar 2011 07:06:40 GMT'])
+
+    def test_cors(self):
+        self.assertEqual(self.lines('http://example.com')[1:], [
+            'access-control-allow-origin: http://example.com',
+            'access-control-allow-credentials: true',
+        ])
+
+    def test_dummy_cookie(self):
+        self.assertEqual(self.lines(cookie='')[1:],
+            ['Set-Cookie: JSESSIONID=dummy; Path=/'])
+        self.assertEqual(self.lines(cookie='other=1')[1:],
+            ['Set-Cookie: JSESSIONID=dummy; Path=/'])
+
+    # Only the JSESSIONID is echoed, the site's other cookies are
+    # left alone
+    def test_echo_session_cookie(self):
+        for cookie in ['JSESSIONID=abc; tracking=xyz; other=1',
+                'tracking=xyz;JSESSIONID=abc', 'a=1; JSESSIONID="abc"',
+                'XJSESSIONID=no; JSESSIONID=abc']:
+            self.assertEqual(self.lines(cookie=cookie)[1:],
+                ['Set-Cookie: JSESSIONID=abc; Path=/'], cookie)
+
+    def test_session_cookie(self):
+        self.assertEqual(session_cookie(None), 'dummy')
+        self.assertEqual(session_cookie('JSESSIONID='), 'dummy')
+        self.assertEqual(session_cookie('a=1;  JSESSIONID=abc '), 'abc')
+
+    def test_caching(self):
+        self.assertEqual(self.lines(caching=True)[1:], [
+            'Cache-Control: max-age=31536000, public',
+            'Expires: Mon, 12 Mar 2012 07:06:40 GMT',
+            'access-control-max-age: 31536000',
+        ])
+
+    # Clients with different cookies but the same JSESSIONID share
+    # a block
+    def test_cached(self):
+        first = self.cache.block('*', 'JSESSIONID=abc; a=1')
+        self.assertIs(self.cache.block('*', 'b=2; JSESSIONID=abc'), first)
+
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+
+    # The Date and Expires move on with the second, the cached
+    # blocks stay
+    def test_next_second(self):
+        first = self.lines('*', caching=True, now=NOW)
+        second = self.lines('*', caching=True, now=NOW + 1)
+
+        self.assertNotEqual(first, second)
+        self.assertTrue('Expires: Mon, 12 Mar 2012 07:06:41 GMT' in second)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_bounded(self):
+        cache = HeaderCache(max_entries=2)
+
+        for origin in ['a', 'b', 'c']:
+            cache.block(origin)
+
+        self.assertEqual(len(cache.blocks), 1)
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+The server wide heartbeat scheduler and waking idle sessions.
+"""
+import unittest2 as unittest
+import gevent
+import nose
+
+from gevent_sockjs.heartbeat import HeartbeatScheduler
+from gevent_sockjs.session import MemorySession
+
+class HeartbeatSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = HeartbeatScheduler()
+        self.session = MemorySession(None)
+        self.beat = self.scheduler.add(self.session, 10)
+        self.start = self.beat.last_sent
+
+    def test_not_due(self):
+        self.scheduler.run(self.start + 5)
+
+        self.assertFalse(self.beat.due)
+        self.assertEqual(len(self.scheduler), 1)
+
+    def test_due(self):
+        self.scheduler.run(self.start + 11)
+
+        self.assertTrue(self.beat.due)
+        self.assertEqual(self.beat.expires_at, self.start + 21)
+        self.assertEqual(len(self.scheduler), 1)
+
+    def test_skip_recently_sent(self):
+        self.beat.last_sent = self.start + 8
+        self.scheduler.run(self.start + 11)
+
+        self.assertFalse(self.beat.due)
+        self.assertEqual(self.beat.expires_at, self.start + 18)
+
+    def test_remove(self):
+        self.scheduler.remove(self.beat)
+        self.scheduler.run(self.start + 11)
+
+        self.assertFalse(self.beat.due)
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_wakes_reader(self):
+        reader = gevent.spawn(self.session.get_messages)
+        gevent.sleep(0)
+
+        self.scheduler.run(self.start + 11)
+
+        self.assertEqual(reader.get(timeout=1), [])
+        self.assertEqual(self.scheduler.woken, 1)
+
+class WakeTest(unittest.TestCase):
+
+    def test_nobody_waiting(self):
+        session = MemorySession(None)
+        session.add_message('a')
+
+        self.assertFalse(session.wake())
+        self.assertEqual(session.get_messages(), ['a'])
+
+    def test_wake_with_messages(self):
+        session = MemorySession(None)
+        reader = gevent.spawn(session.get_messages)
+        gevent.sleep(0)
+
+        session.wake()
+        session.add_message('a')
+
+        self.assertEqual(reader.get(timeout=1), ['a'])
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Keep-alive connection accounting.
+"""
+import httplib
+import unittest2 as unittest
+import gevent
+import gevent.socket
+import nose
+
+from gevent_sockjs.handler import KeepAlive
+from gevent_sockjs.router import SockJSRouter, SockJSConnection
+from gevent_sockjs.server import SockJSServer
+
+class KeepAliveTest(unittest.TestCase):
+
+    def test_unbounded(self):
+        keepalive = KeepAlive()
+        keepalive.idle = 10000
+
+        self.assertFalse(keepalive.full())
+
+    def test_max_idle(self):
+        keepalive = KeepAlive(max_idle=2)
+
+        keepalive.idle = 1
+        self.assertFalse(keepalive.full())
+
+        keepalive.idle = 2
+        self.assertTrue(keepalive.full())
+
+    def test_reuse_rate(self):
+        keepalive = KeepAlive()
+        self.assertEqual(keepalive.reuse_rate(), 0.0)
+
+        keepalive.requests = 4
+        keepalive.reused = 3
+        self.assertEqual(keepalive.reuse_rate(), 0.75)
+
+class Echo(SockJSConnection):
+
+    def on_message(self, message):
+        self.send(message)
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SockJSServer(('127.0.0.1', 0),
+            SockJSRouter({'echo': Echo}), max_idle_connections=1,
+            access_log=False, log=None)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def connect(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.server.server_port)
+        conn.sock = gevent.socket.create_connection(
+            ('127.0.0.1', self.server.server_port))
+        return conn
+
+    def get(self, conn, path, method='GET', body=None):
+        conn.request(method, path, body)
+
+        response = conn.getresponse()
+        response.read()
+        return response
+
+    def test_reused(self):
+        conn = self.connect()
+
+        first = self.get(conn, '/echo/000/a/xhr', 'POST')
+        second = self.get(conn, '/echo/000/a/xhr_send', 'POST', '["x"]')
+
+        self.assertEqual(first.status, 200)
+        self.assertEqual(second.status, 204)
+        self.assertEqual(second.getheader('connection'), None)
+
+        keepalive = self.server.keepalive
+        self.assertEqual((keepalive.requests, keepalive.reused), (2, 1))
+        self.assertEqual(keepalive.reuse_rate(), 0.5)
+
+    def test_max_idle(self):
+        idle = self.connect()
+        self.assertEqual(self.get(idle, '/echo/info').status, 200)
+
+        # Let the first connection wait for its next request
+        gevent.sleep(0.01)
+        self.assertEqual(self.server.keepalive.idle, 1)
+
+        response = self.get(self.connect(), '/echo/info')
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('connection'), 'close')
+        self.assertEqual(self.server.keepalive.refused, 1)
+
+if __name__ == '__main__':
+    nose.main()
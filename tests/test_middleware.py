@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+SockJSRouter as WSGI middleware.
+"""
+import httplib
+import json
+import unittest2 as unittest
+import gevent.socket
+import nose
+
+from gevent_sockjs.router import SockJSRouter, SockJSConnection
+from gevent_sockjs.server import SockJSServer
+
+def site(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['site ' + environ['PATH_INFO']]
+
+class Handler(object):
+    """
+    Stands in for the SockJSHandler of the connection.
+    """
+
+    server = object()
+
+    def __init__(self):
+        self.dispatched = []
+
+    def dispatch(self, router, url):
+        self.dispatched.append(url)
+
+class MiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = SockJSRouter({'echo': SockJSConnection}, app=site)
+        self.statuses = []
+
+    def call(self, path, router=None, **environ):
+        environ['PATH_INFO'] = path
+        return (router or self.router)(environ, self.start_response)
+
+    def start_response(self, status, headers):
+        self.statuses.append(status)
+
+    def test_serves(self):
+        resolve = self.router.dispatcher.resolve
+
+        self.assertTrue(self.router.serves(resolve('/echo/info')))
+        self.assertFalse(self.router.serves(resolve('/other/info')))
+        self.assertFalse(self.router.serves(resolve('/echo/a/b')))
+
+    def test_passed_on(self):
+        handler = Handler()
+
+        for path in ['/', '/index.html', '/other/info', '/echo/a/b']:
+            self.assertEqual(self.call(path, **{'sockjs.handler': handler}),
+                ['site ' + path])
+
+        self.assertEqual(handler.dispatched, [])
+
+    def test_inline(self):
+        handler = Handler()
+
+        self.assertEqual(self.call('/echo/000/abc/xhr_streaming',
+            **{'sockjs.handler': handler}), [])
+
+        self.assertEqual(handler.dispatched,
+            [('dynamic', 'echo', '000', 'abc', 'xhr_streaming')])
+        self.assertFalse(hasattr(self.router, 'server'))
+        self.assertEqual(self.statuses, [])
+
+    def test_no_app(self):
+        router = SockJSRouter({'echo': SockJSConnection})
+
+        self.call('/index.html', router)
+        self.assertEqual(self.statuses, ['404 NOT FOUND'])
+
+    # Served by a plain pywsgi server, there's no connection to write to
+    def test_no_handler(self):
+        self.call('/echo/info')
+        self.assertEqual(self.statuses, ['500 INTERNAL SERVER ERROR'])
+
+class Echo(SockJSConnection):
+
+    def on_message(self, message):
+        self.send(message)
+
+class Mount(object):
+    """
+    An outer application serving the router under ``/sockjs`` and
+    the site everywhere else.
+    """
+
+    def __init__(self, router):
+        self.router = router
+
+    def __call__(self, environ, start_response):
+        path = environ['PATH_INFO']
+
+        if not path.startswith('/sockjs/'):
+            return site(environ, start_response)
+
+        environ['SCRIPT_NAME'] += '/sockjs'
+        environ['PATH_INFO'] = path[len('/sockjs'):]
+        return self.router(environ, start_response)
+
+class SharedFile(object):
+    """
+    The connection's file, left open by the responses read off it.
+    """
+
+    def __init__(self, rfile):
+        self.rfile = rfile
+
+    def __getattr__(self, name):
+        return getattr(self.rfile, name)
+
+    def close(self):
+        pass
+
+class Connection(object):
+    """
+    A client socket whose responses are read off one buffered file,
+    so pipelined responses aren't lost between them.
+    """
+
+    def __init__(self, port):
+        self.sock = gevent.socket.create_connection(('127.0.0.1', port))
+        self.sock.settimeout(5)
+        self.rfile = self.sock.makefile('rb')
+
+    def makefile(self, mode, bufsize=None):
+        return SharedFile(self.rfile)
+
+    def send(self, *requests):
+        self.sock.sendall(''.join(requests))
+
+    def response(self):
+        response = httplib.HTTPResponse(self)
+        response.begin()
+        return response.status, response.read()
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+def request(method, path, body=''):
+    return '%s %s HTTP/1.1\r\nHost: localhost\r\n' \
+        'Content-Length: %d\r\n\r\n%s' % (method, path, len(body), body)
+
+class MountedServerTest(unittest.TestCase):
+    """
+    A router inside an outer application, under a real server.
+    """
+
+    def setUp(self):
+        self.router = SockJSRouter({'echo': Echo}, app=site)
+        self.server = SockJSServer(('127.0.0.1', 0), Mount(self.router),
+            access_log=False, log=None)
+        self.server.start()
+
+        self.conn = Connection(self.server.server_port)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.stop()
+
+    def get(self, method, path, body=''):
+        self.conn.send(request(method, path, body))
+        return self.conn.response()
+
+    def test_routes(self):
+        self.assertIs(self.server.router, None)
+
+        status, body = self.get('GET', '/sockjs/echo/info')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['websocket'], True)
+
+        self.assertEqual(self.get('POST', '/sockjs/echo/000/a/xhr'),
+            (200, 'o\n'))
+        self.assertEqual(self.get('POST', '/sockjs/echo/000/a/xhr_send',
+            '["x"]'), (204, ''))
+        self.assertEqual(self.get('POST', '/sockjs/echo/000/a/xhr'),
+            (200, 'a["x"]\n'))
+
+        status, body = self.get('GET', '/sockjs/echo/iframe.html')
+        self.assertEqual(status, 200)
+        self.assertTrue(body.startswith('<!DOCTYPE html>'))
+
+        self.assertEqual(self.get('GET', '/index.html'),
+            (200, 'site /index.html'))
+
+        # The router keeps nothing of the requests it served
+        self.assertFalse(hasattr(self.router, 'server'))
+
+    # Requests sent back to back on the connection are answered in
+    # order, by the router and the outer application alike.
+    def test_pipelined(self):
+        self.conn.send(
+            request('GET', '/sockjs/echo/info'),
+            request('POST', '/sockjs/echo/000/b/xhr'),
+            request('GET', '/index.html'),
+            request('POST', '/sockjs/echo/000/b/xhr_send', '["y"]'),
+            request('POST', '/sockjs/echo/000/b/xhr'),
+        )
+
+        status, body = self.conn.response()
+        self.assertEqual(status, 200)
+        self.assertTrue('"entropy"' in body)
+
+        self.assertEqual(self.conn.response(), (200, 'o\n'))
+        self.assertEqual(self.conn.response(), (200, 'site /index.html'))
+        self.assertEqual(self.conn.response(), (204, ''))
+        self.assertEqual(self.conn.response(), (200, 'a["y"]\n'))
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Long polls parked on their session.
+"""
+import time
+import unittest2 as unittest
+import gevent
+import nose
+
+from gevent_sockjs.parking import ParkingLot
+from gevent_sockjs.session import MemorySession
+
+class ParkingLotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lot = ParkingLot()
+        self.session = MemorySession(None)
+
+    def test_message(self):
+        gevent.spawn_later(0.01, self.session.add_message, 'a')
+
+        self.assertTrue(self.lot.wait(self.session, 10))
+        self.assertEqual(self.session.get_messages(block=False), ['a'])
+        self.assertEqual(len(self.lot), 0)
+        self.assertEqual(self.session.listener, None)
+
+    def test_close(self):
+        gevent.spawn_later(0.01, self.session.kill)
+
+        self.assertTrue(self.lot.wait(self.session, 10))
+        self.assertTrue(self.session.is_expired())
+
+    def test_timeout(self):
+        poll = gevent.spawn(self.lot.wait, self.session, 5)
+        gevent.sleep(0)
+
+        # Not due yet
+        self.lot.run(time.time() + 1)
+        gevent.sleep(0)
+        self.assertFalse(poll.ready())
+
+        self.lot.run(time.time() + 6)
+        self.assertEqual(poll.get(timeout=1), False)
+        self.assertEqual(self.lot.timed_out, 1)
+
+    def test_resumed_once(self):
+        poll = gevent.spawn(self.lot.wait, self.session, 5)
+        gevent.sleep(0)
+
+        self.session.add_message('a')
+        self.lot.run(time.time() + 6)
+
+        self.assertEqual(poll.get(timeout=1), True)
+        self.assertEqual((self.lot.woken, self.lot.timed_out), (1, 0))
+
+if __name__ == '__main__':
+    nose.main()
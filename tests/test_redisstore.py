@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+RedisStore and RedisSession against the in-process stand-in
+server, no real Redis needed.
+"""
+import unittest2 as unittest
+import gevent
+import nose
+
+from gevent_sockjs.protocol import Encoded, encode_batch
+from gevent_sockjs.redisstore import RedisStore, RedisSession
+from redis_standin import RedisStandin
+
+class FakeServer(object):
+    def __init__(self, store):
+        self.session_store = store
+
+class RedisStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.standin = RedisStandin()
+        self.standin.start()
+        self.store = RedisStore(self.standin.address, pool_size=2)
+
+    def tearDown(self):
+        self.store.close()
+        self.standin.stop()
+
+    def rpushes(self):
+        return [c for c in self.standin.log if c[0] == 'RPUSH']
+
+    # Messages added in the same tick go out as one pipeline, with
+    # one RPUSH per session list.
+    def test_pipelined_push(self):
+        a = RedisSession(FakeServer(self.store), 'a')
+        b = RedisSession(FakeServer(self.store), 'b')
+
+        for i in range(10):
+            a.add_message(i)
+        b.add_message('x')
+
+        self.assertEqual(self.store.round_trips, 0)
+        gevent.sleep(0.05)
+
+        self.assertEqual(self.store.round_trips, 1)
+        self.assertEqual(len(self.rpushes()), 2)
+        self.assertEqual(self.standin.ttls[a.key], self.store.ttl)
+
+    def test_drain(self):
+        session = RedisSession(FakeServer(self.store), 'drain')
+
+        session.add_message('a')
+        session.add_message({'b': 1})
+        gevent.sleep(0.05)
+
+        trips = self.store.round_trips
+        messages = session.get_messages()
+        self.assertEqual(self.store.round_trips, trips + 1)
+
+        # Still encoded, spliced into frames as they are
+        self.assertEqual(messages, ['"a"', '{"b":1}'])
+        self.assertTrue(all(isinstance(m, Encoded) for m in messages))
+        self.assertEqual(encode_batch(messages), '["a",{"b":1}]')
+        self.assertEqual([m.value for m in messages], ['a', {'b': 1}])
+
+        self.assertEqual(session.get_messages(block=False), [])
+
+    def test_blocking_drain(self):
+        session = RedisSession(FakeServer(self.store), 'blocking')
+
+        waiter = gevent.spawn(session.get_messages, timeout=2)
+        gevent.sleep(0.05)
+
+        session.add_message('late')
+        self.assertEqual(waiter.get(timeout=3), ['"late"'])
+
+    def test_blocking_timeout(self):
+        session = RedisSession(FakeServer(self.store), 'idle')
+        self.assertEqual(session.get_messages(timeout=0.1), [])
+
+    def test_post_delete(self):
+        session = RedisSession(FakeServer(self.store), 'gone')
+
+        session.add_message('a')
+        session.post_delete()
+        gevent.sleep(0.05)
+
+        self.assertFalse(session.key in self.standin.data)
+
+    # Broadcast frames go in and come back out as they are
+    def test_encoded_once(self):
+        session = RedisSession(FakeServer(self.store), 'encoded')
+
+        session.add_message(Encoded(u'caf\xe9'))
+        gevent.sleep(0.05)
+
+        self.assertEqual(session.get_messages(block=False), ['"caf\xc3\xa9"'])
+
+    def test_failed_flush(self):
+        self.standin.stop()
+
+        session = RedisSession(FakeServer(self.store), 'lost')
+        session.add_message('a')
+        session.add_message('b')
+        gevent.sleep(0.1)
+
+        self.assertEqual(self.store.lost, 2)
+        self.assertEqual(self.store.pending, [])
+
+        # The next flush goes ahead as usual
+        session.add_message('c')
+        gevent.sleep(0.1)
+        self.assertEqual(self.store.lost, 3)
+
+    # Writers killed while blocked in BLPOP give their connections
+    # back to the pool
+    def test_killed_drain(self):
+        store = RedisStore(self.standin.address, blocking_pool_size=2)
+
+        try:
+            waiters = [gevent.spawn(store.drain, 'killed-%d' % i)
+                for i in range(2)]
+            gevent.sleep(0.05)
+            self.assertEqual(store.blocking_pool.opened, 2)
+
+            gevent.killall(waiters)
+            self.assertEqual(store.blocking_pool.opened, 0)
+
+            waiter = gevent.spawn(store.drain, 'killed-0', timeout=0.1)
+            self.assertEqual(waiter.get(timeout=3), [])
+        finally:
+            store.close()
+
+    def test_pool_reuse(self):
+        session = RedisSession(FakeServer(self.store), 'pool')
+
+        for i in range(20):
+            session.add_message(i)
+            gevent.sleep(0.01)
+            session.get_messages(block=False)
+
+        self.assertTrue(self.standin.connections <= 2)
+
+if __name__ == '__main__':
+    nose.main()
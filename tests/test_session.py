@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+Outgoing queue limits, replay buffer and batching of MemorySession.
+"""
+import unittest2 as unittest
+import gevent
+import nose
+
+from gevent_sockjs.session import MemorySession, QueueLimits, ReplayBuffer, \
+    Batching
+from gevent_sockjs.sessionpool import SessionPool
+
+class QueueLimitsTest(unittest.TestCase):
+
+    def session(self, pool=None, **limits):
+        session = MemorySession(None)
+        session.limits = QueueLimits(**limits)
+        if pool is not None:
+            pool.add(session)
+        return session
+
+    def test_unbounded(self):
+        session = MemorySession(None)
+        for i in range(100):
+            session.add_message(i)
+
+        self.assertEqual(session.get_messages(), range(100))
+        self.assertEqual(session.dropped, 0)
+
+    def test_drop_oldest(self):
+        session = self.session(max_messages=3)
+        for i in range(5):
+            session.add_message(i)
+
+        self.assertEqual(session.get_messages(), [2, 3, 4])
+        self.assertEqual(session.dropped, 2)
+
+    # A message larger than the limit is dropped, the queue is left
+    # as it was
+    def test_drop_oldest_oversize(self):
+        session = self.session(max_bytes=5)
+        session.add_message('ab')
+        session.add_message('cd')
+        session.add_message('toolong')
+
+        self.assertEqual(session.dropped, 1)
+        self.assertEqual(session.get_messages(), ['ab', 'cd'])
+
+    def test_block_oversize(self):
+        pool = SessionPool(max_bytes=4)
+        session = self.session(pool, overflow=QueueLimits.BLOCK,
+            block_timeout=1.0)
+        session.add_message('ab')
+
+        # Returns straight away rather than waiting for room
+        sender = gevent.spawn(session.add_message, 'toolong')
+        sender.join(timeout=0.1)
+
+        self.assertTrue(sender.ready())
+        self.assertEqual(session.dropped, 1)
+        self.assertEqual(session.get_messages(), ['ab'])
+
+    def test_drop_newest(self):
+        session = self.session(max_bytes=5, overflow=QueueLimits.DROP_NEWEST)
+        for message in ['ab', 'cd', 'ef']:
+            session.add_message(message)
+
+        self.assertEqual(session.get_messages(), ['ab', 'cd'])
+        self.assertEqual(session.dropped, 1)
+        self.assertEqual(session.queued_bytes, 0)
+
+    def test_block(self):
+        session = self.session(max_messages=1, overflow=QueueLimits.BLOCK,
+            block_timeout=1.0)
+        session.add_message('a')
+
+        sender = gevent.spawn(session.add_message, 'b')
+        gevent.sleep(0.01)
+        self.assertFalse(sender.ready())
+
+        self.assertEqual(session.get_messages(), ['a'])
+        sender.join(timeout=1)
+        self.assertEqual(session.get_messages(), ['b'])
+        self.assertEqual(session.dropped, 0)
+
+    def test_block_timeout(self):
+        session = self.session(max_messages=1, overflow=QueueLimits.BLOCK,
+            block_timeout=0.01)
+        session.add_message('a')
+        session.add_message('b')
+
+        self.assertEqual(session.get_messages(), ['a'])
+        self.assertEqual(session.dropped, 1)
+
+    def test_close(self):
+        session = self.session(max_messages=2, overflow=QueueLimits.CLOSE)
+        for i in range(3):
+            session.add_message(i)
+
+        self.assertTrue(session.is_expired())
+        self.assertEqual(session.get_close_reason()[0], 3001)
+        self.assertEqual(session.dropped, 3)
+
+    def test_pool_budget(self):
+        pool = SessionPool(max_bytes=6)
+        a = self.session(pool)
+        b = self.session(pool)
+
+        a.add_message('abcd')
+        b.add_message('ef')
+        b.add_message('gh')
+
+        self.assertEqual(pool.budget.used, 6)
+        self.assertEqual(b.get_messages(), ['gh'])
+        self.assertEqual(pool.budget.dropped, 1)
+
+        a.get_messages()
+        self.assertEqual(pool.budget.used, 0)
+
+class ReplayBufferTest(unittest.TestCase):
+
+    def test_ack(self):
+        replay = ReplayBuffer(4)
+        self.assertEqual(replay.push('["a"]'), 1)
+        self.assertEqual(replay.push('["b","c"]'), 2)
+
+        self.assertEqual(replay.pending(), (2, '["a","b","c"]'))
+
+        self.assertTrue(replay.ack(1))
+        self.assertEqual(replay.pending(), (2, '["b","c"]'))
+
+        self.assertTrue(replay.ack(2))
+        self.assertFalse(replay.frames)
+
+    # Acknowledging a frame older than the buffer holds leaves a gap
+    # the client can't recover from.
+    def test_evicted(self):
+        replay = ReplayBuffer(2)
+        for i in range(4):
+            replay.push('[%d]' % i)
+
+        self.assertFalse(replay.ack(1))
+        self.assertTrue(replay.ack(2))
+
+class BatchingTest(unittest.TestCase):
+
+    def burst(self, session, messages, delay=0.001):
+        for msg in messages:
+            session.add_message(msg)
+            gevent.sleep(delay)
+
+    def test_unbatched(self):
+        session = MemorySession(None)
+        gevent.spawn(self.burst, session, 'abc')
+
+        self.assertEqual(session.get_batch(None, timeout=1), ['a'])
+
+    def test_window(self):
+        session = MemorySession(None)
+        gevent.spawn(self.burst, session, 'abc')
+
+        batch = session.get_batch(Batching(window=0.5), timeout=1)
+        self.assertEqual(batch, ['a', 'b', 'c'])
+
+    def test_max_bytes(self):
+        session = MemorySession(None)
+        gevent.spawn(self.burst, session, ['ab', 'cd', 'ef', 'gh'])
+
+        batch = session.get_batch(Batching(window=0.5, max_bytes=4), timeout=1)
+        self.assertEqual(batch, ['ab', 'cd'])
+
+    def test_nothing_queued(self):
+        session = MemorySession(None)
+        self.assertEqual(session.get_batch(Batching(), timeout=0.01), [])
+
+class CloseWakeTest(unittest.TestCase):
+
+    def test_readers(self):
+        session = MemorySession(None)
+        readers = [gevent.spawn(session.get_messages) for i in range(3)]
+        gevent.sleep(0)
+
+        session.kill()
+
+        for reader in readers:
+            self.assertEqual(reader.get(timeout=1), [])
+
+    def test_blocked_sender(self):
+        session = MemorySession(None)
+        session.limits = QueueLimits(max_messages=1,
+            overflow=QueueLimits.BLOCK, block_timeout=10)
+        session.add_message('a')
+
+        sender = gevent.spawn(session.add_message, 'b')
+        gevent.sleep(0)
+
+        session.kill()
+
+        sender.join(timeout=1)
+        self.assertTrue(sender.ready())
+        self.assertEqual(session.dropped, 1)
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+"""
+The expiry wheel and the session pool.
+"""
+import time
+import httplib
+import unittest2 as unittest
+import gevent
+import gevent.socket
+import nose
+
+from datetime import timedelta
+
+from gevent_sockjs.sessionpool import TimingWheel, SessionPool
+from gevent_sockjs.session import MemorySession
+from gevent_sockjs.router import SockJSRouter, SockJSConnection
+from gevent_sockjs.server import SockJSServer
+
+START = 1000
+
+class Item(object):
+
+    def __init__(self, name, expires_at):
+        self.name = name
+        self.expires_at = expires_at
+        self.wheel_slot = None
+
+    def __repr__(self):
+        return self.name
+
+class TimingWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        # Spans of 1, 4 and 16 ticks, anything over 64 ticks away
+        # goes to the overflow
+        self.wheel = TimingWheel(resolution=1.0, slots=4, levels=3, now=START)
+
+    def item(self, name, delay):
+        item = Item(name, START + delay)
+        self.wheel.schedule(item)
+        return item
+
+    def pop_all(self, now):
+        self.wheel.advance(now)
+        popped = []
+
+        item = self.wheel.pop_expired()
+        while item is not None:
+            popped.append(item)
+            item = self.wheel.pop_expired()
+
+        return popped
+
+    def run_until(self, end):
+        """
+        Advance a tick at a time, the tick each item came out on.
+        """
+        popped = {}
+
+        for now in xrange(START + 1, START + end + 1):
+            for item in self.pop_all(now):
+                popped[item.name] = now - START
+
+        return popped
+
+    def test_schedule(self):
+        self.item('a', 2)
+
+        self.assertEqual(self.pop_all(START + 1), [])
+        self.assertEqual(len(self.wheel), 1)
+
+        self.assertEqual([i.name for i in self.pop_all(START + 2)], ['a'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_reschedule(self):
+        item = self.item('a', 2)
+
+        item.expires_at = START + 7
+        self.wheel.schedule(item)
+        self.assertEqual(len(self.wheel), 1)
+
+        self.assertEqual(self.run_until(10), {'a': 7})
+
+    def test_remove(self):
+        item = self.item('a', 2)
+
+        self.wheel.remove(item)
+        self.wheel.remove(item)
+
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(item.wheel_slot, None)
+        self.assertEqual(self.run_until(5), {})
+
+    # Items in the coarser levels and the overflow fall down to
+    # level 0 as their bucket comes up, and come out on their tick
+    def test_cascade(self):
+        delays = {
+            'level0' : 3,
+            'level1' : 11,
+            'level2' : 37,
+            'level3' : 63,
+            'overflow' : 150,
+            'far' : 300,
+        }
+
+        for name, delay in delays.items():
+            self.item(name, delay)
+
+        self.assertTrue(self.wheel.wheels[0][(START + 3) % 4])
+        self.assertTrue(self.wheel.overflow)
+
+        self.assertEqual(self.run_until(300), delays)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_fractional_deadline(self):
+        self.wheel.schedule(Item('a', START + 2.5))
+
+        self.assertEqual(self.run_until(5), {'a': 3})
+
+    def test_due(self):
+        late = self.item('late', -5)
+        self.assertIs(late.wheel_slot, self.wheel.due)
+
+        flagged = self.item('flagged', 20)
+        self.wheel.expire(flagged)
+
+        # Handed back on the next advance, even without moving
+        popped = self.pop_all(START)
+        self.assertEqual(sorted(i.name for i in popped), ['flagged', 'late'])
+        self.assertEqual(len(self.wheel), 0)
+
+    # Items stay scheduled until popped, and can still move
+    def test_reschedule_expired(self):
+        item = self.item('a', 2)
+        self.wheel.advance(START + 5)
+
+        item.expires_at = START + 8
+        self.wheel.schedule(item)
+
+        self.assertEqual(self.wheel.pop_expired(), None)
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(self.run_until(10), {'a': 8})
+
+    def test_count(self):
+        items = [self.item(str(i), i * 7) for i in xrange(1, 21)]
+        self.assertEqual(len(self.wheel), 20)
+
+        self.wheel.expire(items[0])
+        self.wheel.expire(Item('new', START))
+        self.assertEqual(len(self.wheel), 21)
+
+        self.wheel.remove(items[1])
+        self.assertEqual(len(self.wheel), 20)
+        self.assertEqual(len(self.wheel.items()), 20)
+
+        # Deadlines 7 to 70 come out, less the removed one, plus the new one
+        self.pop_all(START + 70)
+        self.assertEqual(len(self.wheel), 10)
+
+        self.wheel.clear()
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.wheel.items(), [])
+        self.assertEqual(items[-1].wheel_slot, None)
+
+class ShardingTest(unittest.TestCase):
+
+    def test_partitioned(self):
+        pool = SessionPool(shards=4)
+        ids = ['session-%d' % i for i in xrange(100)]
+
+        for session_id in ids:
+            pool.add(MemorySession(None, session_id))
+
+        self.assertEqual(len(pool), 100)
+        self.assertEqual(sum(len(shard.sessions) for shard in pool.shards), 100)
+
+        for session_id in ids:
+            shard = pool.shard(session_id)
+            session = pool.get(session_id)
+
+            self.assertIs(shard.sessions[session_id], session)
+            self.assertIs(session.pool, shard)
+
+        # Every shard got some, and indexes only its own sessions
+        for shard in pool.shards:
+            self.assertTrue(shard.sessions)
+            self.assertEqual(len(shard.wheel), len(shard.sessions))
+
+        pool.remove(ids[0])
+        self.assertEqual(pool.get(ids[0]), None)
+        self.assertEqual(len(pool), 99)
+
+class SlicedCollectionTest(unittest.TestCase):
+
+    def pool(self, count, batch=10, budget=1.0):
+        """
+        A single shard pool of ``count`` sessions which all expired
+        a second ago.
+        """
+        pool = SessionPool(shards=1)
+        pool.gc_batch = batch
+        pool.gc_budget = budget
+
+        now = time.time()
+
+        for i in xrange(count):
+            session = MemorySession(None, 'session-%d' % i)
+            session.expires_at = now - 1
+            pool.add(session)
+
+        return pool
+
+    def test_batches(self):
+        pool = self.pool(35)
+        slices = pool.gc_slices()
+
+        sizes = []
+        for shard in slices:
+            sizes.append(35 - sum(sizes) - len(pool))
+
+        self.assertEqual(sizes, [10, 10, 10, 5])
+        self.assertEqual(len(pool), 0)
+
+    # Out of time budget, a slice stops after one session
+    def test_time_budget(self):
+        pool = self.pool(5, budget=-1)
+
+        self.assertEqual(len(list(pool.gc_slices())), 5)
+        self.assertEqual(len(pool), 0)
+
+    def test_persisted_between_slices(self):
+        pool = self.pool(30)
+        shard = pool.shards[0]
+        slices = pool.gc_slices()
+
+        next(slices)
+        self.assertEqual(len(pool), 20)
+
+        # Still waiting in a detached bucket of the wheel
+        survivor = [s for s in shard.sessions.values() if s.wheel_slot][0]
+        survivor.persist()
+
+        list(slices)
+
+        self.assertEqual(pool.items(), [(survivor.session_id, survivor)])
+        self.assertEqual(len(shard.wheel), 1)
+
+    def test_expired_between_slices(self):
+        pool = self.pool(20)
+        live = MemorySession(None, 'live')
+        pool.add(live)
+
+        slices = pool.gc_slices()
+        next(slices)
+
+        live.expire()
+        list(slices)
+
+        # Flagged for the next collection, not this one
+        self.assertEqual(pool.items(), [('live', live)])
+
+        list(pool.gc_slices())
+        self.assertEqual(len(pool), 0)
+
+    # Added while a collection is under way
+    def test_added_between_slices(self):
+        pool = self.pool(20)
+
+        slices = pool.gc_slices()
+        next(slices)
+
+        pool.add(MemorySession(None, 'new'))
+        list(slices)
+
+        self.assertEqual([sid for sid, s in pool.items()], ['new'])
+
+class CollectedTest(unittest.TestCase):
+
+    # Readers parked on a session which timed out are woken, and its
+    # timeout callbacks run
+    def test_woken_and_signalled(self):
+        pool = SessionPool(shards=1)
+        session = MemorySession(None, 'idle')
+        pool.add(session)
+
+        timed_out = []
+        session.link_timeout(timed_out.append)
+
+        reader = gevent.spawn(session.get_messages, timeout=5)
+        gevent.sleep(0)
+
+        pool.gc(time.time() + 10)
+
+        self.assertEqual(reader.get(timeout=1), [])
+        self.assertEqual(timed_out, [session])
+        self.assertTrue(session.is_expired())
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(len(pool.shards[0].wheel), 0)
+
+class ShortSession(MemorySession):
+    expires = timedelta(seconds=0.3)
+
+class FinePool(SessionPool):
+    gc_resolution = 0.05
+
+class Echo(SockJSConnection):
+
+    def on_message(self, message):
+        self.send(message)
+
+class UsedSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SockJSServer(('127.0.0.1', 0),
+            SockJSRouter({'echo': Echo}), session_backend=ShortSession,
+            access_log=False, log=None)
+        self.server.session_pool = self.pool = FinePool()
+        self.server.start()
+
+        self.conn = httplib.HTTPConnection('127.0.0.1', self.server.server_port)
+        self.conn.sock = gevent.socket.create_connection(
+            ('127.0.0.1', self.server.server_port))
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.stop()
+
+    def post(self, path, body=None):
+        self.conn.request('POST', path, body)
+        response = self.conn.getresponse()
+        return response.status, response.read()
+
+    # Polled well past its timeout, collected once the polls stop
+    def test_polled(self):
+        self.assertEqual(self.post('/echo/000/a/xhr'), (200, 'o\n'))
+
+        for i in xrange(10):
+            gevent.sleep(0.1)
+            self.pool.gc()
+
+            self.assertEqual(self.post('/echo/000/a/xhr_send', '["x"]'),
+                (204, ''))
+            self.assertEqual(self.post('/echo/000/a/xhr'),
+                (200, 'a["x"]\n'))
+
+        gevent.sleep(0.5)
+        self.pool.gc()
+
+        self.assertEqual(self.pool.get('a'), None)
+        self.assertEqual(self.post('/echo/000/a/xhr_send', '["x"]')[0], 404)
+
+    # A session with an open connection isn't collected
+    def test_locked(self):
+        session = ShortSession(None, 'open')
+        self.pool.add(session)
+        session.lock()
+
+        self.pool.gc(time.time() + 1)
+        self.assertIs(self.pool.get('open'), session)
+
+        session.unlock()
+        self.pool.gc(time.time() + 1)
+        self.assertEqual(self.pool.get('open'), None)
+
+class ShutdownTest(unittest.TestCase):
+
+    def test_forever_sessions(self):
+        pool = SessionPool(shards=2)
+
+        sessions = [MemorySession(None, 'session-%d' % i) for i in xrange(4)]
+        for session in sessions:
+            pool.add(session)
+
+        sessions[0].persist(forever=True)
+        sessions[1].persist(forever=True)
+        sessions[1].persist()
+
+        forever = sum(len(shard.forever) for shard in pool.shards)
+        self.assertEqual(forever, 1)
+
+        timed_out = []
+        for session in sessions:
+            session.link_timeout(timed_out.append)
+
+        pool.shutdown()
+        gevent.sleep(0)
+
+        for session in sessions:
+            self.assertTrue(session.expired, session.session_id)
+        self.assertEqual(len(timed_out), 4)
+
+        forever = sum(len(shard.forever) for shard in pool.shards)
+        self.assertEqual(forever, 0)
+
+if __name__ == '__main__':
+    nose.main()
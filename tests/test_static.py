@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+The pre-rendered iframe page.
+"""
+import hashlib
+import unittest2 as unittest
+import gevent.socket
+import nose
+
+from gevent_sockjs.static import IFramePage
+from gevent_sockjs.router import SockJSRouter, SockJSConnection
+from gevent_sockjs.server import SockJSServer
+
+URL = 'http://cdn.sockjs.org/sockjs-0.3.min.js'
+
+class IFramePageTest(unittest.TestCase):
+
+    def test_rendered(self):
+        page = IFramePage(URL)
+
+        self.assertTrue('<script src="%s"></script>' % URL in page.body)
+        self.assertEqual(page.etag, '"%s"' % hashlib.md5(page.body).hexdigest())
+
+    def test_matches(self):
+        page = IFramePage(URL)
+
+        self.assertTrue(page.matches(page.etag))
+        self.assertTrue(page.matches('"other", W/' + page.etag))
+        self.assertTrue(page.matches('*'))
+        self.assertFalse(page.matches('"other"'))
+        self.assertFalse(page.matches(page.etag.strip('"')))
+        self.assertFalse(page.matches(''))
+
+    def test_responses(self):
+        page = IFramePage(URL)
+        ok, not_modified = page.responses()
+
+        status, head, body = ok
+        self.assertEqual(status, '200 OK')
+        self.assertTrue('ETag: %s\r\n' % page.etag in head)
+        self.assertTrue('Content-Length: %d\r\n' % len(page.body) in head)
+        self.assertEqual(body, page.body)
+
+        status, head, body = not_modified
+        self.assertEqual(status, '304 NOT MODIFIED')
+        self.assertTrue(head.endswith('\r\n'))
+        self.assertFalse('Content-Type' in head)
+        self.assertEqual(body, '')
+
+        # Served from the cache until the refresh interval is up
+        self.assertTrue(page.responses()[0] is ok)
+
+class IFrameServerTest(unittest.TestCase):
+
+    def serve(self, request, **kwargs):
+        server = SockJSServer(('127.0.0.1', 0),
+            SockJSRouter({'echo': SockJSConnection}), access_log=False,
+            log=None, **kwargs)
+        server.start()
+
+        try:
+            sock = gevent.socket.create_connection(
+                ('127.0.0.1', server.server_port))
+            sock.settimeout(5)
+            sock.sendall(request)
+
+            # Read until the server closes the connection
+            response = []
+            data = sock.recv(4096)
+            while data:
+                response.append(data)
+                data = sock.recv(4096)
+
+            return ''.join(response).split('\r\n\r\n', 1)
+        finally:
+            server.stop()
+
+    # The status line follows the request's version, the Date is
+    # added as it is written
+    def test_version(self):
+        head, body = self.serve('GET /echo/iframe.html HTTP/1.0\r\n\r\n')
+
+        self.assertTrue(head.startswith('HTTP/1.0 200 OK\r\n'))
+        self.assertTrue('\r\nDate: ' in head)
+        self.assertEqual(body, IFramePage(URL).body)
+
+    def test_closing(self):
+        head, body = self.serve('GET /echo/iframe.html HTTP/1.1\r\n'
+            'Host: localhost\r\n\r\n', max_idle_connections=0)
+
+        self.assertTrue(head.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertTrue('\r\nConnection: close\r\n' in head)
+
+if __name__ == '__main__':
+    nose.main()
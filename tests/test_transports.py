@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""
+Greenlets of the transports.
+"""
+import unittest2 as unittest
+import gevent
+import nose
+
+from gevent.queue import Queue
+
+from gevent_sockjs.session import MemorySession
+from gevent_sockjs.transports import GreenletGauge, RawWebSocket, WebSocket, \
+    XHRStreaming, HTMLFile
+from gevent_sockjs.writer import FrameWriter
+
+class ClosedSocket(object):
+    """
+    A websocket whose client is already gone.
+    """
+
+    def __init__(self):
+        self.closed = False
+
+    def receive(self):
+        return None
+
+    def send(self, message):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class QueueSocket(object):
+    """
+    A websocket whose incoming messages are put on a queue, None
+    for the client closing it.
+    """
+
+    def __init__(self):
+        self.incoming = Queue()
+        self.sent = []
+
+    def receive(self):
+        return self.incoming.get()
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def close(self):
+        pass
+
+class SendSocket(object):
+    """
+    A connection socket keeping what each write sent.
+    """
+
+    def __init__(self):
+        self.writes = []
+
+    def sendall(self, data):
+        self.writes.append(data)
+
+class StreamHandler(object):
+    """
+    The parts of the handler a streaming transport writes through.
+    """
+
+    def __init__(self, query='', request_version='HTTP/1.0'):
+        self.environ = {'QUERY_STRING': query}
+        self.request_version = request_version
+        self.headers = []
+        self.close_connection = False
+        self.errors = []
+
+        self.socket = SendSocket()
+        self.writer = FrameWriter(self.socket)
+
+    def enable_cookie(self):
+        pass
+
+    def enable_cors(self):
+        pass
+
+    def enable_nocache(self):
+        pass
+
+    def start_response(self, status, headers):
+        self.status = status
+
+    def raw_headers(self):
+        return 'HEADERS'
+
+    def frame_writer(self, chunked=False, compressor=None):
+        self.writer.chunked = chunked
+        return self.writer
+
+    def compressor(self):
+        return None
+
+    def do500(self, message=None):
+        self.errors.append(message)
+
+class EchoConnection(object):
+
+    def __init__(self, session):
+        self.session = session
+
+    def on_message(self, message):
+        self.session.add_message(message)
+
+class GreenletGaugeTest(unittest.TestCase):
+
+    def test_counts(self):
+        gauge = GreenletGauge()
+        greenlet = gauge.spawn('XHRPolling', gevent.sleep, 0.01)
+
+        self.assertEqual(gauge.live, {'XHRPolling': 1})
+
+        greenlet.join()
+        gevent.sleep(0)
+
+        self.assertEqual(gauge.live, {'XHRPolling': 0})
+        self.assertEqual(gauge.spawned, {'XHRPolling': 1})
+
+    # The writer used to wait for a message forever once the
+    # client had gone.
+    def test_writer_exits_on_disconnect(self):
+        gauge = GreenletGauge()
+        transport = RawWebSocket(MemorySession(None), None)
+        transport.gauge = gauge
+
+        greenlets = transport(ClosedSocket(), None, None)
+        gevent.joinall(greenlets, timeout=1)
+
+        self.assertTrue(all(g.ready() for g in greenlets))
+        gevent.sleep(0)
+        self.assertEqual(gauge.total(), 0)
+
+class WebSocketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = MemorySession(None)
+        self.gauge = GreenletGauge()
+        self.socket = QueueSocket()
+
+        self.transport = WebSocket(self.session, EchoConnection(self.session))
+        self.transport.gauge = self.gauge
+
+        self.handler = gevent.spawn(self.transport, self.socket, None, None)
+        gevent.sleep(0)
+
+    def test_idle_connection(self):
+        # Only the handler's greenlet while nothing is sent
+        self.assertEqual(self.gauge.total(), 0)
+        self.assertEqual(self.socket.sent, ['o'])
+
+        self.socket.incoming.put(None)
+        self.handler.join(timeout=1)
+        self.assertTrue(self.session.is_expired())
+
+    def test_echo(self):
+        self.socket.incoming.put('["a", "b"]')
+        gevent.sleep(0.01)
+
+        self.assertEqual(self.socket.sent, ['o', 'a["a","b"]'])
+        self.assertEqual(self.gauge.total(), 0)
+        self.assertEqual(self.gauge.spawned, {'WebSocket': 1})
+
+    def test_server_close(self):
+        self.session.kill()
+        gevent.sleep(0.01)
+
+        self.assertEqual(self.socket.sent, ['o', 'c[3000,"Go away!"]'])
+
+        self.socket.incoming.put(None)
+        self.handler.join(timeout=1)
+        self.assertTrue(self.handler.ready())
+
+class StreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session = MemorySession(None)
+        self.gauge = GreenletGauge()
+
+    def stream(self, handler=None, transport_cls=XHRStreaming, **attrs):
+        """
+        Start a transport on the session, with ``attrs`` set on it.
+        """
+        if handler is None:
+            handler = StreamHandler()
+
+        transport = transport_cls(self.session, None)
+        transport.gauge = self.gauge
+        transport.__dict__.update(attrs)
+
+        greenlets = transport(handler, 'POST', None)
+        gevent.sleep(0)
+        return transport, handler, greenlets
+
+    def frames(self, handler):
+        # The headers and the prelude come first
+        return handler.socket.writes[2:]
+
+class StreamingTest(StreamTestCase):
+
+    # Headers, frames and the close all come from one greenlet
+    def test_single_writer(self):
+        transport, handler, greenlets = self.stream()
+
+        self.assertEqual(len(greenlets), 1)
+        self.assertEqual(self.gauge.live, {'XHRStreaming': 1})
+        self.assertTrue(handler.close_connection)
+        self.assertEqual(handler.socket.writes[:2],
+            ['HEADERS', 'h' * 2048 + '\n'])
+
+        self.session.add_message('a')
+        self.session.add_message('b')
+        gevent.sleep(0.01)
+        self.session.kill()
+        gevent.joinall(greenlets, timeout=1)
+
+        self.assertEqual(self.frames(handler),
+            ['o\n', 'a["a","b"]\n', 'c[3000,"Go away!"]\n'])
+        self.assertEqual(self.gauge.spawned, {'XHRStreaming': 1})
+        self.assertEqual(self.gauge.total(), 0)
+
+    def test_chunked(self):
+        transport, handler, greenlets = self.stream(
+            StreamHandler(request_version='HTTP/1.1'))
+
+        self.session.kill()
+        gevent.joinall(greenlets, timeout=1)
+
+        self.assertFalse(handler.close_connection)
+        self.assertEqual(self.frames(handler),
+            ['2\r\no\n\r\n', '13\r\nc[3000,"Go away!"]\n\r\n', '0\r\n\r\n'])
+
+    def test_heartbeat(self):
+        transport, handler, greenlets = self.stream(heartbeat_interval=0.01)
+        gevent.sleep(0.05)
+
+        self.session.kill()
+        gevent.joinall(greenlets, timeout=1)
+
+        self.assertTrue('h\n' in self.frames(handler))
+
+    def test_already_open(self):
+        self.session.incr_hits()
+        self.session.lock()
+
+        transport, handler, greenlets = self.stream()
+        gevent.joinall(greenlets, timeout=1)
+
+        self.assertEqual(self.frames(handler),
+            ['c[2010,"Another connection still open"]\n'])
+        self.assertTrue(self.session.is_network_error())
+
+    # Once response_limit bytes of frames are out the response ends,
+    # what is still queued waits for the next one
+    def test_response_limit(self):
+        transport, handler, greenlets = self.stream(response_limit=20)
+
+        for i in xrange(5):
+            self.session.add_message('x' * 10)
+            gevent.sleep(0)
+
+        gevent.joinall(greenlets, timeout=1)
+        self.assertTrue(all(g.ready() for g in greenlets))
+
+        frames = self.frames(handler)
+        self.assertEqual(frames[0], 'o\n')
+        self.assertTrue(sum(len(f) for f in frames) >= 20)
+        self.assertFalse(self.session.is_locked())
+        self.assertFalse(self.session.is_expired())
+
+        sent = ''.join(frames).count('x' * 10)
+        self.assertTrue(0 < sent < 5)
+
+        # The client reconnects for the rest
+        transport, handler, greenlets = self.stream()
+        self.session.kill()
+        gevent.joinall(greenlets, timeout=1)
+
+        rest = ''.join(self.frames(handler))
+        self.assertFalse(rest.startswith('o'))
+        self.assertEqual(sent + rest.count('x' * 10), 5)
+
+class HTMLFileTest(StreamTestCase):
+
+    def test_callback_required(self):
+        transport, handler, greenlets = self.stream(transport_cls=HTMLFile)
+
+        self.assertEqual(greenlets, [])
+        self.assertEqual(handler.errors, ['"callback" parameter required'])
+        self.assertEqual(handler.socket.writes, [])
+
+    def test_invalid_callback(self):
+        for callback in ['a(b', 'x%20y', '%3C/script%3E', 'a%3Bb']:
+            handler = StreamHandler('c=' + callback)
+            transport, handler, greenlets = self.stream(handler, HTMLFile)
+
+            self.assertEqual(greenlets, [], callback)
+            self.assertEqual(handler.errors, ['invalid "callback" parameter'])
+
+    def test_frames(self):
+        handler = StreamHandler('c=window.cb_1')
+        transport, handler, greenlets = self.stream(handler, HTMLFile)
+
+        prelude = handler.socket.writes[1]
+        self.assertTrue('window.cb_1' in prelude)
+        self.assertTrue(len(prelude) >= HTMLFile.padding)
+
+        self.session.add_message('</script>')
+        gevent.sleep(0.01)
+        self.session.kill()
+        gevent.joinall(greenlets, timeout=1)
+
+        self.assertEqual(self.frames(handler), [
+            '<script>\np("o");\n</script>\r\n',
+            '<script>\np("a[\\"<\\/script>\\"]");\n</script>\r\n',
+            '<script>\np("c[3000,\\"Go away!\\"]");\n</script>\r\n',
+        ])
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Vectored frame writes.
+"""
+import unittest2 as unittest
+import nose
+
+from gevent_sockjs.writer import FrameWriter
+
+class JoiningSocket(object):
+    """
+    A socket without sendmsg, as on Python 2.
+    """
+
+    def __init__(self):
+        self.data = []
+
+    def sendall(self, data):
+        self.data.append(data)
+
+class VectorSocket(object):
+    """
+    A socket with sendmsg which writes at most ``limit`` bytes a
+    call, to exercise short writes.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = []
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        data = ''.join(buf.tobytes() for buf in buffers)[:self.limit]
+        self.data.append(data)
+        return len(data)
+
+class FrameWriterTest(unittest.TestCase):
+
+    def test_joined(self):
+        sock = JoiningSocket()
+        writer = FrameWriter(sock)
+
+        self.assertEqual(writer.frame('a', '["x"]', '\n'), 7)
+        self.assertEqual(sock.data, ['a["x"]\n'])
+
+    def test_chunked(self):
+        sock = JoiningSocket()
+        writer = FrameWriter(sock, chunked=True)
+
+        writer.frame('a', '["x"]', '\n')
+        writer.end()
+
+        self.assertEqual(sock.data, ['7\r\na["x"]\n\r\n', '0\r\n\r\n'])
+        self.assertEqual(writer.writes, 2)
+
+    def test_vectored(self):
+        sock = VectorSocket(limit=1000)
+        writer = FrameWriter(sock)
+
+        writer.frame('a', '["x"]', '\n')
+
+        self.assertEqual(sock.calls, 1)
+        self.assertEqual(sock.data, ['a["x"]\n'])
+
+    def test_short_writes(self):
+        sock = VectorSocket(limit=3)
+        writer = FrameWriter(sock, chunked=True)
+        payload = '["' + 'x' * 20 + '"]'
+
+        self.assertEqual(writer.frame('a', payload, '\n'), 32)
+        self.assertEqual(''.join(sock.data), '1a\r\na' + payload + '\n\r\n')
+        self.assertEqual(writer.written, 32)
+
+if __name__ == '__main__':
+    nose.main()